@@ -0,0 +1,277 @@
+import asyncio
+from collections import deque
+from queue import Full
+
+import httpx
+import ollama
+import openai
+
+from config_loader import config
+from conversation_store import ConversationStore, compact_history_in_task, ollama_usage, openai_usage
+from ollama_client import (
+    _apply_voice,
+    _cache_key,
+    _create_chunking,
+    _feed_stream_content,
+    _finish_turn,
+    _flush_stream,
+    _new_segmenter,
+    _ollama_chat_options,
+    _openai_stream_options,
+    _prompt_epoch,
+    _start_turn,
+    _unpack_prompt,
+)
+from latency_tracer import trace
+from llm_cache import create_response_cache
+from pipeline_channel import BACKPRESSURE_POLL_SECONDS, wait_for_capacity
+import supervisor
+
+LLM_CONFIG = config.get('llm') or {}
+USE_ASYNC_CLIENT = LLM_CONFIG.get('async_client', False)
+MAX_CONCURRENT_REQUESTS = LLM_CONFIG.get('max_concurrent_requests', 8)
+# 同一会话发来新问题时，是否中断该会话仍在生成的上一条回答
+INTERRUPT_ON_NEW_PROMPT = LLM_CONFIG.get('interrupt_on_new_prompt', True)
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=LLM_CONFIG.get('max_connections', 16),
+        max_keepalive_connections=LLM_CONFIG.get('max_keepalive_connections', 8),
+        keepalive_expiry=LLM_CONFIG.get('keepalive_seconds', 60),
+    )
+
+
+class AsyncLLMClient:
+    """
+    基于 openai.AsyncOpenAI / ollama.AsyncClient 的异步流式客户端。
+    所有请求共用一个保持长连接的 httpx 连接池；取消任务时会关闭上游 HTTP 流。
+    """
+
+    def __init__(self, provider, model_config):
+        self.provider = provider
+        self.model_name = model_config['name']
+        timeout = httpx.Timeout(LLM_CONFIG.get('timeout_seconds', 60), connect=10)
+        if provider == 'openai':
+            self._http = httpx.AsyncClient(limits=_http_limits(), timeout=timeout)
+            self._client = openai.AsyncOpenAI(
+                api_key=model_config['api_key'], base_url=model_config['base_url'], http_client=self._http,
+            )
+        else:
+            # ollama.AsyncClient 会把多余的参数传给内部的 httpx.AsyncClient
+            self._client = ollama.AsyncClient(host=model_config.get('host'), limits=_http_limits(), timeout=timeout)
+            self._http = None
+
+    async def stream(self, messages, usage=None):
+        """
+        逐段产出回答文本。传入 usage 字典时，服务端报告的 token 用量会写入其中。
+        """
+        if self.provider == 'openai':
+            stream = await self._client.chat.completions.create(
+                model=self.model_name, messages=messages, stream=True, temperature=0.7, **_openai_stream_options(),
+            )
+            try:
+                async for chunk in stream:
+                    if usage is not None and getattr(chunk, 'usage', None) is not None:
+                        usage.update(openai_usage(chunk.usage))
+                    if chunk.choices:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+        else:
+            stream = await self._client.chat(model=self.model_name, messages=messages, stream=True,
+                                             **_ollama_chat_options())
+            try:
+                async for chunk in stream:
+                    if usage is not None and chunk.get('done'):
+                        usage.update(ollama_usage(chunk))
+                    yield chunk['message']['content']
+            finally:
+                await stream.aclose()
+
+    async def complete(self, messages):
+        """
+        非流式请求，返回完整的回答文本（用于生成历史摘要）。
+        """
+        if self.provider == 'openai':
+            response = await self._client.chat.completions.create(
+                model=self.model_name, messages=messages, temperature=0.3,
+            )
+            return response.choices[0].message.content
+        response = await self._client.chat(model=self.model_name, messages=messages, **_ollama_chat_options())
+        return response['message']['content']
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+        elif hasattr(self._client, '_client'):
+            await self._client._client.aclose()
+
+
+class _Outbox:
+    """
+    与 ollama_client 共用的同步辅助函数通过 put() 写入消息，这里只在本地暂存；
+    协程随后调用 flush() 以非阻塞方式送入通道，通道已满时让出事件循环，不阻塞其他会话。
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.items = deque()
+
+    def put(self, item):
+        self.items.append(item)
+
+    async def flush(self):
+        """
+        返回等待通道空出位置的秒数。
+        """
+        waited = 0.0
+        while self.items:
+            try:
+                # 可丢弃的消息在通道已满时由通道直接丢弃，其余的等待下游消费
+                self.channel.put_nowait(self.items[0])
+            except Full:
+                await asyncio.sleep(BACKPRESSURE_POLL_SECONDS)
+                waited += BACKPRESSURE_POLL_SECONDS
+                continue
+            self.items.popleft()
+        return waited
+
+
+async def _flush(*outboxes):
+    return sum([await outbox.flush() for outbox in outboxes if outbox is not None])
+
+
+async def _answer(client, semaphore, session, prompt, text_queue, ui_queue, store, epoch=None, cache=None,
+                  chunking=None):
+    segmenter = _new_segmenter(chunking)
+    text_out = _Outbox(text_queue)
+    ui_out = _Outbox(ui_queue) if ui_queue else None
+    turn = _start_turn(session, text_out, epoch)
+    messages, context = store.build_messages(session, prompt)
+    reply, usage = [], {}
+    paused = 0.0
+    cancelled = False
+
+    async def upstream():
+        # 只有真正请求上游时才占用并发名额，命中缓存或合并到进行中请求的回答不受限制
+        async with semaphore:
+            async for content in client.stream(messages, usage):
+                yield content
+
+    if cache is None:
+        stream = upstream()
+    else:
+        stream = cache.stream_async(_cache_key(client.provider, client.model_name, messages), upstream, turn)
+    try:
+        print(f"\n[用户 {session or ''}]: {prompt}")
+        async for content in stream:
+            if content:
+                reply.append(content)
+                _feed_stream_content(segmenter, content, text_out, ui_out, session, turn, chunking)
+                paused += await _flush(text_out, ui_out)
+            # TTS 处理不过来时暂停读取上游的流，而不是让文本在队列中无限堆积
+            paused += await wait_for_capacity(text_queue)
+    except asyncio.CancelledError:
+        cancelled = True
+        print(f"\n[LLM]: 会话 {session} 的回答已取消，上游请求已中断。")
+    except Exception as e:
+        print(f"\n调用 {client.provider} 接口时出错: {e}")
+    finally:
+        await stream.aclose()
+        # 被取消的回答不再补发残留文本，但仍需发送结束标记让下游结束本轮
+        if not cancelled:
+            _flush_stream(segmenter, text_out, ui_out, session, turn, chunking)
+        _finish_turn(session, text_out, ui_out, turn)
+        paused += await _flush(text_out, ui_out)
+        print()
+        if paused:
+            trace('llm_backpressure', turn=turn, seconds=round(paused, 3))
+        # 被中断的回答只保留已经生成（并已开始播放）的部分
+        store.finish_turn(session, turn, prompt, ''.join(reply), context, usage)
+        # 摘要在独立的任务中生成，本任务被取消（新问题、停止）时不受影响
+        compact_history_in_task(store, session, client.complete)
+
+
+async def _serve(client, input_queue, text_queue, system_prompt, ui_queue, feedback=None):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    store = ConversationStore(system_prompt)
+    cache = create_response_cache()
+    chunking = _create_chunking(feedback)
+    tasks = {}
+    # 监督：进行中的回答 -> 提示词的中转序号
+    active = {}
+    last_relay_seq = -1
+
+    def report_health(task=None):
+        if task is not None:
+            active.pop(task, None)
+        marks = [seq for seq in active.values() if seq is not None]
+        if marks:
+            supervisor.report(len(active), min(marks))
+        elif last_relay_seq >= 0:
+            supervisor.report(len(active), last_relay_seq + 1)
+
+    async def cancel(session):
+        task = tasks.pop(session, None)
+        if task is not None and not task.done():
+            task.cancel()
+            # 等待被取消的任务发出结束标记，保证同一会话的文本顺序
+            await asyncio.gather(task, return_exceptions=True)
+
+    while True:
+        item = await loop.run_in_executor(None, input_queue.get)
+        if item is None:
+            break
+        if supervisor.relay_seq(item) is not None:
+            last_relay_seq = item['relay_seq']
+        session, prompt = _unpack_prompt(item)
+        if isinstance(item, dict) and item.get('cancel'):
+            await cancel(session)
+            continue
+        if prompt is None:
+            continue
+
+        previous = tasks.get(session)
+        if previous is not None and not previous.done():
+            if INTERRUPT_ON_NEW_PROMPT:
+                await cancel(session)
+            else:
+                await asyncio.gather(previous, return_exceptions=True)
+        # 此时该会话上一轮的文本已全部发出，音色切换只影响本轮及之后的回答
+        voice_out = _Outbox(text_queue)
+        _apply_voice(item, voice_out)
+        await voice_out.flush()
+        task = tasks[session] = asyncio.create_task(
+            _answer(client, semaphore, session, prompt, text_queue, ui_queue, store, _prompt_epoch(item), cache, chunking)
+        )
+        if supervisor.supervised():
+            active[task] = supervisor.relay_seq(item)
+            task.add_done_callback(report_health)
+            report_health()
+
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    # 退出前等待进行中的历史压缩，关闭连接池后摘要请求会失败
+    await asyncio.gather(*store._tasks, return_exceptions=True)
+    await client.aclose()
+
+
+def _run(provider, input_queue, text_queue, model_config, system_prompt, ui_queue, feedback=None):
+    try:
+        client = AsyncLLMClient(provider, model_config)
+    except Exception as e:
+        print(f"初始化异步 {provider} 客户端失败: {e}")
+    else:
+        print(f"异步 {provider} 客户端已启动，使用模型: {client.model_name}，最多同时处理 {MAX_CONCURRENT_REQUESTS} 个请求。")
+        asyncio.run(_serve(client, input_queue, text_queue, system_prompt, ui_queue, feedback))
+    text_queue.put(None)
+    if ui_queue: ui_queue.put(None)
+
+
+def serve_openai_async(input_queue, text_queue, online_model_config, system_prompt, ui_queue=None, feedback=None):
+    _run('openai', input_queue, text_queue, online_model_config, system_prompt, ui_queue, feedback)
+
+
+def serve_ollama_async(input_queue, text_queue, local_model_config, system_prompt, ui_queue=None, feedback=None):
+    _run('ollama', input_queue, text_queue, local_model_config, system_prompt, ui_queue, feedback)
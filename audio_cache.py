@@ -0,0 +1,198 @@
+import dataclasses
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _fingerprint(obj):
+    """
+    计算音色向量/推理参数的稳定摘要，用于构造缓存键。
+    """
+    if obj is None:
+        return b""
+    if isinstance(obj, str):
+        return obj.encode("utf-8")
+    if isinstance(obj, (bytes, bytearray)):
+        return bytes(obj)
+    if hasattr(obj, "detach"):  # torch.Tensor
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        return obj.tobytes() + str(obj.dtype).encode() + str(obj.shape).encode()
+    return repr(obj).encode("utf-8")
+
+
+def _params_fingerprint(params):
+    if params is None:
+        return b""
+    if dataclasses.is_dataclass(params):
+        fields = dataclasses.asdict(params)
+        # 音色向量单独参与哈希，这里只保留其余的采样参数
+        fields.pop("spk_emb", None)
+        return repr(sorted(fields.items())).encode("utf-8")
+    return _fingerprint(params)
+
+
+class AudioCache:
+    """
+    以内容寻址的短语级音频缓存。
+    内存层按字节预算做 LRU 淘汰；可选的磁盘层以 .npy 文件保存并通过内存映射读取，重启后依然有效。
+    磁盘层同样有字节预算（max_disk_bytes，None 表示不限），按文件的最近使用时间淘汰。
+    """
+
+    def __init__(self, max_memory_bytes, disk_dir=None, max_disk_bytes=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_files = OrderedDict()  # 路径 -> 字节数，按最近使用时间排序
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @staticmethod
+    def make_key(text, spk_emb, params, audio_format=None):
+        """
+        audio_format 为输出音频的格式设置（见 audio_format.describe），格式不同的音频不会互相命中。
+        """
+        h = hashlib.sha256()
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+        h.update(hashlib.sha256(_fingerprint(spk_emb)).digest())
+        h.update(b"\0")
+        h.update(_params_fingerprint(params))
+        if audio_format is not None:
+            h.update(b"\0")
+            h.update(json.dumps(audio_format, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def _scan_disk(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._disk_files[path] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _touch_disk(self, path):
+        if path in self._disk_files:
+            self._disk_files.move_to_end(path)
+        try:
+            # 多个 TTS 进程共用磁盘目录，修改时间记录最近使用时间，重启后据此恢复淘汰顺序
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _add_disk(self, path):
+        size = self._disk_files.pop(path, None)
+        if size is not None:
+            self._disk_bytes -= size
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self._disk_files[path] = size
+        self._disk_bytes += size
+        self._evict_disk()
+
+    def _evict_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        while self._disk_bytes > self.max_disk_bytes and self._disk_files:
+            path, size = self._disk_files.popitem(last=False)
+            self._disk_bytes -= size
+            self.disk_evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                # 可能已被共用目录的其他进程删除；已经内存映射的文件在 POSIX 上仍可读取
+                pass
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        wav = self._entries.get(key)
+        if wav is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return wav
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                try:
+                    wav = np.load(path, mmap_mode="r")
+                except (OSError, ValueError) as e:
+                    print(f"[Audio Cache]: 读取磁盘缓存 '{path}' 失败: {e}")
+                else:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._touch_disk(path)
+                    self._remember(key, wav)
+                    return wav
+
+        self.misses += 1
+        return None
+
+    def put(self, key, wav):
+        wav = np.asarray(wav)
+        if wav.size == 0:
+            return
+        self._remember(key, wav)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                try:
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, wav)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print(f"[Audio Cache]: 写入磁盘缓存失败: {e}")
+                else:
+                    self._add_disk(path)
+
+    def _remember(self, key, wav):
+        if wav.nbytes > self.max_memory_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old.nbytes
+        self._entries[key] = wav
+        self._memory_bytes += wav.nbytes
+        while self._memory_bytes > self.max_memory_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "memory_bytes": self._memory_bytes,
+            "disk_files": len(self._disk_files),
+            "disk_bytes": self._disk_bytes,
+            "disk_evictions": self.disk_evictions,
+        }
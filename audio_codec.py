@@ -0,0 +1,108 @@
+"""
+WebUI 浏览器模式的音频分段编码。
+
+TTS 输出的 24 kHz 波形即使以 16 位存储（见 audio_format）每秒也有 48 KB，直接发给远程浏览器太重。这里把每段音频编码为独立的小文件
+（浏览器逐段解码播放）:
+    mp3    MPEG Layer III，语音约 50 kbps，需要 soundfile（libsndfile >= 1.1）
+    opus   Ogg/Opus，码率最低，需要 soundfile；Gradio 的流式音频组件目前只接受 mp3/wav，仅供基准测试与离线使用
+    wav    16 位 PCM，48 KB/s，不依赖第三方库
+所需的编码器不可用时自动退回 wav。
+"""
+import io
+import time
+import wave
+
+import numpy as np
+
+from audio_format import SAMPLE_RATE, to_storage
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# 格式 -> (soundfile 格式, 编码)；wav 使用标准库编码
+CODECS = {
+    'wav': (None, None),
+    'mp3': ('MP3', 'MPEG_LAYER_III'),
+    'opus': ('OGG', 'OPUS'),
+}
+
+
+def codec_available(codec):
+    if codec not in CODECS:
+        return False
+    fmt, subtype = CODECS[codec]
+    if fmt is None:
+        return True
+    return soundfile is not None and soundfile.check_format(fmt, subtype)
+
+
+def resolve_codec(codec):
+    if codec_available(codec):
+        return codec
+    print(f"[Audio Codec]: 编码格式 '{codec}' 不可用（需要安装 soundfile 且 libsndfile 支持该格式），改用 wav。")
+    return 'wav'
+
+
+def to_int16(audio):
+    # 音频通路的存储格式为 int16 时不复制
+    return to_storage(audio, np.int16)
+
+
+def encode_segment(pcm, codec, sample_rate=SAMPLE_RATE):
+    """
+    把一段 16 位 PCM 编码为独立的音频文件（字节串）。
+    """
+    fmt, subtype = CODECS[codec]
+    buffer = io.BytesIO()
+    if fmt is None:
+        with wave.open(buffer, 'wb') as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(sample_rate)
+            out.writeframes(pcm.tobytes())
+    else:
+        soundfile.write(buffer, pcm, sample_rate, format=fmt, subtype=subtype)
+    return buffer.getvalue()
+
+
+class SegmentEncoder:
+    """
+    逐段编码一轮回答的音频，并统计发送的字节数与编码耗时。
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.segments = 0
+        self.bytes = 0
+        self.samples = 0
+        self.encode_seconds = []
+
+    def encode(self, audio):
+        """
+        返回 (编码后的字节串, 编码耗时秒数)。
+        """
+        pcm = to_int16(audio)
+        started = time.perf_counter()
+        data = encode_segment(pcm, self.codec)
+        elapsed = time.perf_counter() - started
+        self.segments += 1
+        self.bytes += len(data)
+        self.samples += pcm.size
+        self.encode_seconds.append(elapsed)
+        return data, elapsed
+
+    def stats(self):
+        audio_seconds = self.samples / SAMPLE_RATE
+        encode_ms = sorted(1000 * s for s in self.encode_seconds)
+        return {
+            'codec': self.codec,
+            'segments': self.segments,
+            'audio_seconds': round(audio_seconds, 3),
+            'bytes': self.bytes,
+            'bytes_per_second': round(self.bytes / audio_seconds, 1) if audio_seconds else None,
+            'kbps': round(8 * self.bytes / audio_seconds / 1000, 1) if audio_seconds else None,
+            'encode_ms_p50': round(encode_ms[len(encode_ms) // 2], 3) if encode_ms else None,
+            'encode_ms_max': round(encode_ms[-1], 3) if encode_ms else None,
+        }
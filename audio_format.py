@@ -0,0 +1,208 @@
+"""
+流水线中音频波形的存储格式。
+
+ChatTTS 输出 24 kHz 的 float32 波形，每秒约 96 KB。波形在 TTS 进程中就转换为紧凑的存储格式，
+之后的音频通道（队列或共享内存）、播放器的环形缓冲区、短语音频缓存和 WebUI 的转发都保存这种格式，
+只有声卡的输出回调把读出的样本转换为 float32:
+    float32   与模型输出相同，不做转换
+    float16   每个样本 2 字节，保留浮点动态范围
+    int16     每个样本 2 字节，即 16 位 PCM，转换最快，编码为 mp3/wav 或写入文件时无需再转换
+此外在 TTS 进程中可选:
+    静音裁剪   按 10 ms 帧的峰值找出首尾的静音并裁掉（保留 keep_silence_ms），相邻句子拼接得更紧凑
+    重采样     sample_rate 与模型的采样率不同时，先低通滤波再线性插值，播放器与编码器按新的采样率工作
+流式合成的音频帧逐帧转换，不做静音裁剪（无法预知哪一帧是句子的结尾）；重采样由每个任务的 StreamResampler
+在帧之间保留滤波器与插值的状态，输出与整句一次重采样相同，帧的边界处不会产生咔嗒声。
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from config_loader import config
+
+AUDIO_CONFIG = config.get('audio') or {}
+MODEL_SAMPLE_RATE = 24000
+# 音频通路（TTS 之后）的采样率
+SAMPLE_RATE = int(AUDIO_CONFIG.get('sample_rate', MODEL_SAMPLE_RATE))
+SAMPLE_FORMATS = {'float32': np.float32, 'float16': np.float16, 'int16': np.int16}
+SAMPLE_FORMAT = AUDIO_CONFIG.get('sample_format', 'float32')
+if SAMPLE_FORMAT not in SAMPLE_FORMATS:
+    raise ValueError(f"audio.sample_format '{SAMPLE_FORMAT}' 无效，应为 {' / '.join(SAMPLE_FORMATS)}。")
+SAMPLE_DTYPE = np.dtype(SAMPLE_FORMATS[SAMPLE_FORMAT])
+TRIM_SILENCE = AUDIO_CONFIG.get('trim_silence', False)
+SILENCE_THRESHOLD = 10 ** (AUDIO_CONFIG.get('silence_threshold_db', -45) / 20)
+KEEP_SILENCE_MS = AUDIO_CONFIG.get('keep_silence_ms', 40)
+FRAME_MS = 10
+# 重采样低通滤波器的抽头数
+FILTER_TAPS = 31
+INT16_SCALE = np.float32(1 / 32768)
+
+
+def to_float32(audio):
+    """
+    转换为一维 float32 波形；已经是 float32 时不复制。
+    """
+    audio = np.asarray(audio).reshape(-1)
+    if audio.dtype == np.int16:
+        return np.multiply(audio, INT16_SCALE)
+    return audio.astype(np.float32, copy=False)
+
+
+def to_storage(audio, dtype=SAMPLE_DTYPE):
+    """
+    转换为一维的存储格式；已经是该格式时不复制。
+    """
+    audio = np.asarray(audio).reshape(-1)
+    dtype = np.dtype(dtype)
+    if audio.dtype == dtype:
+        return audio
+    if dtype == np.int16:
+        scaled = np.multiply(to_float32(audio), np.float32(32767))
+        return np.clip(scaled, -32767, 32767, out=scaled).astype(np.int16)
+    if audio.dtype == np.int16:
+        return np.multiply(audio, INT16_SCALE).astype(dtype, copy=False)
+    return audio.astype(dtype)
+
+
+def copy_to_float32(out, samples):
+    """
+    输出回调使用：把存储格式的样本写入声卡的 float32 缓冲区，不产生临时数组。
+    """
+    if samples.dtype == np.int16:
+        np.multiply(samples, INT16_SCALE, out=out)
+    else:
+        out[...] = samples
+
+
+def trim_silence(audio, sample_rate=MODEL_SAMPLE_RATE, threshold=SILENCE_THRESHOLD, keep_ms=KEEP_SILENCE_MS):
+    """
+    裁掉首尾峰值低于 threshold 的 10 ms 帧，两端各保留 keep_ms 毫秒。整段都是静音时只保留 2 × keep_ms。
+    返回原数组的切片。
+    """
+    frame = max(1, sample_rate * FRAME_MS // 1000)
+    keep = sample_rate * keep_ms // 1000
+    n = audio.size // frame
+    if n == 0:
+        return audio
+    peaks = np.abs(audio[:n * frame].reshape(n, frame)).max(axis=1)
+    loud = np.flatnonzero(peaks > threshold)
+    if loud.size == 0:
+        return audio[:2 * keep]
+    start = max(loud[0] * frame - keep, 0)
+    end = min((loud[-1] + 1) * frame + keep, audio.size)
+    if loud[-1] == n - 1:
+        # 最后一帧之后不足一帧的样本同样属于有声部分
+        end = audio.size
+    return audio[start:end]
+
+
+@lru_cache(maxsize=8)
+def _lowpass_kernel(cutoff):
+    """
+    cutoff 为截止频率与采样率之比的窗函数 sinc 低通滤波器。
+    """
+    taps = np.arange(FILTER_TAPS) - (FILTER_TAPS - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hamming(FILTER_TAPS)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def resample(audio, src_rate, dst_rate):
+    """
+    对 float32 波形重采样。降采样前先低通滤波（截止于新的奈奎斯特频率的 90%），避免混叠。
+    """
+    if src_rate == dst_rate or audio.size == 0:
+        return audio
+    if dst_rate < src_rate:
+        audio = np.convolve(audio, _lowpass_kernel(0.45 * dst_rate / src_rate), mode='same')
+    n = max(int(round(audio.size * dst_rate / src_rate)), 1)
+    positions = np.arange(n, dtype=np.float64) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(audio.size), audio).astype(np.float32)
+
+
+class StreamResampler:
+    """
+    对分帧到达的波形做与 resample() 相同的重采样。低通滤波器需要当前样本之后的 FILTER_TAPS // 2 个样本，
+    线性插值需要下一个样本，所以每帧的最后几个样本留到下一帧（或 flush()）时才输出。
+    """
+
+    def __init__(self, src_rate=MODEL_SAMPLE_RATE, dst_rate=SAMPLE_RATE):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self._step = src_rate / dst_rate
+        self._kernel = _lowpass_kernel(0.45 * dst_rate / src_rate) if dst_rate < src_rate else None
+        half = FILTER_TAPS // 2
+        # 尚未滤波的输入（开头补零，与 np.convolve(mode='same') 的边界一致）
+        self._raw = np.zeros(half if self._kernel is not None else 0, dtype=np.float32)
+        # 已滤波但尚未用完的最后一个样本，及其在整段输入中的下标
+        self._held = np.zeros(0, dtype=np.float32)
+        self._offset = 0
+        self._received = 0
+        self._emitted = 0
+
+    def _filter(self, audio):
+        if self._kernel is None:
+            return audio
+        raw = np.concatenate([self._raw, audio])
+        if raw.size < FILTER_TAPS:
+            self._raw = raw
+            return raw[:0]
+        self._raw = raw[raw.size - (FILTER_TAPS - 1):]
+        return np.convolve(raw, self._kernel, mode='valid')
+
+    def _interpolate(self, filtered, count=None):
+        if filtered.size == 0 and count is None:
+            return filtered
+        buffered = np.concatenate([self._held, filtered])
+        if buffered.size == 0:
+            return buffered
+        last = self._offset + buffered.size - 1
+        end = int(last // self._step) + 1 if count is None else count
+        positions = np.arange(self._emitted, max(end, self._emitted), dtype=np.float64) * self._step
+        out = np.interp(positions - self._offset, np.arange(buffered.size), buffered).astype(np.float32)
+        self._emitted += positions.size
+        self._held = buffered[-1:]
+        self._offset = last
+        return out
+
+    def process(self, audio):
+        """
+        输入一帧 float32 波形，返回目前能够确定的输出样本。
+        """
+        audio = to_float32(audio)
+        if self.src_rate == self.dst_rate:
+            return audio
+        self._received += audio.size
+        return self._interpolate(self._filter(audio))
+
+    def flush(self):
+        """
+        输入结束：返回剩余的输出样本，总数与对整段输入调用 resample() 相同。
+        """
+        if self.src_rate == self.dst_rate or self._received == 0:
+            return np.zeros(0, dtype=np.float32)
+        tail = self._filter(np.zeros(FILTER_TAPS // 2 if self._kernel is not None else 0, dtype=np.float32))
+        count = max(int(round(self._received * self.dst_rate / self.src_rate)), 1)
+        return self._interpolate(tail, count)
+
+
+def prepare(audio, trim=TRIM_SILENCE, sample_rate=SAMPLE_RATE, dtype=SAMPLE_DTYPE, resampler=None):
+    """
+    TTS 进程输出音频前调用：模型的原始波形 -> （裁剪静音、重采样）-> 存储格式。
+    流式合成的音频帧传入该任务的 resampler（StreamResampler），在帧之间延续重采样的状态。
+    """
+    audio = to_float32(audio)
+    if trim:
+        audio = trim_silence(audio)
+    if resampler is not None:
+        audio = resampler.process(audio)
+    else:
+        audio = resample(audio, MODEL_SAMPLE_RATE, sample_rate)
+    return to_storage(audio, dtype)
+
+
+def describe():
+    """
+    影响输出音频内容的设置，用于批量模式的进度校验。
+    """
+    return {'sample_rate': SAMPLE_RATE, 'sample_format': SAMPLE_FORMAT, 'trim_silence': TRIM_SILENCE,
+            'silence_threshold': round(SILENCE_THRESHOLD, 6) if TRIM_SILENCE else None,
+            'keep_silence_ms': KEEP_SILENCE_MS if TRIM_SILENCE else None}
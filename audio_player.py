@@ -1,5 +1,20 @@
 import sounddevice as sd
+import numpy as np
 import queue
+import threading
+import time
+from collections import deque
+from config_loader import config
+from audio_ring import AudioRingBuffer
+from audio_format import SAMPLE_DTYPE, SAMPLE_RATE, to_float32, to_storage
+from latency_tracer import trace
+
+PLAYER_CONFIG = config.get('player') or {}
+BUFFER_SECONDS = PLAYER_CONFIG.get('buffer_seconds', 30)
+BLOCKSIZE = PLAYER_CONFIG.get('blocksize', 1024)
+# 流式合成时相邻的音频帧属于同一句话，不能做交叉淡化
+STREAM_SYNTHESIS = (config.get('tts') or {}).get('stream', False)
+CROSSFADE_MS = 0 if STREAM_SYNTHESIS else PLAYER_CONFIG.get('crossfade_ms', 0)
 
 def clear_queue(q):
     """
@@ -11,52 +26,243 @@ def clear_queue(q):
         except queue.Empty:
             break
 
-def play_audio_data(audio_queue, command_queue):
+class GaplessOutput:
+    """
+    无缝连续播放引擎：单个长期存在的 sd.OutputStream，由无锁环形缓冲区供数。
+    句子之间按采样点精确拼接，可选交叉淡化；CLEAR 由输出回调在下一个数据块内执行。
+    环形缓冲区按存储格式（audio.sample_format）保存样本，由输出回调转换为 float32。
+    交叉淡化只发生在句子之间：带 partial 标记的片段（同一句话还有后续音频）原样写入，不保留尾部。
+    为交叉淡化保留的尾部由播放线程和命令线程共同访问，读写都持有 _tail_lock。
+    """
+
+    def __init__(self, samplerate=SAMPLE_RATE, blocksize=BLOCKSIZE, buffer_seconds=BUFFER_SECONDS, crossfade_ms=CROSSFADE_MS):
+        self.ring = AudioRingBuffer(int(samplerate * buffer_seconds), dtype=SAMPLE_DTYPE)
+        self.samplerate = samplerate
+        self.generation = 0
+        self.xruns = 0
+        self._crossfade = int(samplerate * crossfade_ms / 1000)
+        self._tail = None
+        self._tail_lock = threading.Lock()
+        if self._crossfade:
+            ramp = np.linspace(0.0, 1.0, self._crossfade, dtype=np.float32)
+            self._fade_in, self._fade_out = ramp, ramp[::-1].copy()
+        self._stream = sd.OutputStream(
+            samplerate=samplerate, channels=1, dtype='float32',
+            blocksize=blocksize, callback=self._callback,
+        )
+        self._stream.start()
+
+    def _callback(self, outdata, frames, time_info, status):
+        if status.output_underflow:
+            self.xruns += 1
+        self.ring.read_into(outdata[:, 0])
+
+    def clear(self):
+        """
+        可在任意线程调用：丢弃环形缓冲区中的全部样本以及正在写入的片段。
+        """
+        with self._tail_lock:
+            self.generation += 1
+            self._tail = None
+        self.ring.request_clear()
+
+    def write(self, audio_data, generation, partial=False):
+        """
+        将一个音频片段写入环形缓冲区，缓冲区满时等待回调消费。
+        generation 为取出该片段前的代数；若期间发生过 CLEAR，则丢弃该片段。
+        partial 表示同一句话还有后续片段（共享内存通道切分的长句、流式合成的音频帧）。
+        """
+        audio_data = np.asarray(audio_data).reshape(-1)
+        if generation != self.generation:
+            return
+
+        if self._crossfade:
+            audio_data = self._apply_crossfade(to_float32(audio_data), generation, partial)
+            if audio_data is None:
+                return
+        # 句子的最后一个片段（可以为空，例如流式合成的结束消息）写完后，环形缓冲区记下句子的结束位置
+        self._write_samples(audio_data, generation, end_of_utterance=not partial)
+
+    def _write_samples(self, audio_data, generation, end_of_utterance=True):
+        audio_data = to_storage(audio_data, self.ring.dtype)
+        written = 0
+        while True:
+            if generation != self.generation:
+                # 写入过程中收到 CLEAR，已写入的部分也需要丢弃
+                self.ring.request_clear()
+                return
+            n = self.ring.write(audio_data[written:], end_of_utterance)
+            written += n
+            if written >= audio_data.size:
+                return
+            if n == 0:
+                time.sleep(0.01)
+
+    def _apply_crossfade(self, audio_data, generation, partial):
+        """
+        与上一句保留的尾部交叉淡化；期间发生过 CLEAR 时返回 None。
+        """
+        n = self._crossfade
+        with self._tail_lock:
+            if generation != self.generation:
+                return None
+            tail, self._tail = self._tail, None
+            if tail is not None and audio_data.size >= n:
+                head = tail * self._fade_out + audio_data[:n] * self._fade_in
+                audio_data = np.concatenate([head, audio_data[n:]])
+            elif tail is not None:
+                audio_data = np.concatenate([tail, audio_data])
+            # 句子的最后一个片段保留末尾一小段，等待与下一句交叉淡化
+            if not partial and audio_data.size > n:
+                self._tail = audio_data[-n:].copy()
+                audio_data = audio_data[:-n]
+        return audio_data
+
+    def flush_tail(self):
+        """
+        没有后续句子时，把为交叉淡化保留的尾部写出。
+        """
+        with self._tail_lock:
+            tail, self._tail = self._tail, None
+            generation = self.generation
+        if tail is not None:
+            self._write_samples(tail, generation)
+
+    def buffered_seconds(self):
+        return self.ring.fill() / self.samplerate
+
+    def metrics(self):
+        return {
+            "fill_seconds": round(self.buffered_seconds(), 3),
+            "fill_ratio": round(self.ring.fill() / self.ring.capacity, 4),
+            "underruns": self.ring.underruns,
+            "xruns": self.xruns,
+            "played_seconds": round(self.ring.samples_played / self.samplerate, 2),
+        }
+
+    def close(self):
+        self.flush_tail()
+        while self.ring.fill() > 0:
+            time.sleep(0.05)
+        self._stream.stop()
+        self._stream.close()
+
+class _PlaybackTimeline:
+    """
+    记录每个文本块在环形缓冲区中占用的采样区间，播放位置越过区间边界时上报
+    playback_start / playback_end 事件，时间戳按播放位置回推到采样点精度。
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.spans = deque()  # [chunk, turn, start_index, end_index, started]
+
+    def on_write(self, chunk, turn, start_index, end_index):
+        if self.spans and self.spans[-1][0] == chunk:
+            # 流式合成时同一文本块由多个音频帧组成
+            self.spans[-1][3] = end_index
+        else:
+            self.spans.append([chunk, turn, start_index, end_index, False])
+
+    def poll(self, idle=False):
+        read_index = self.output.ring.read_index
+        now = time.time()
+        while self.spans:
+            chunk, turn, start, end, started = self.spans[0]
+            if not started:
+                if read_index < start:
+                    break
+                trace('playback_start', ts=now - (read_index - start) / self.output.samplerate, chunk=chunk, turn=turn)
+                self.spans[0][4] = True
+            # 只有在后面已经有新文本块（或播放器空闲）时，才能确定当前文本块不会再有新的音频帧
+            if read_index >= end and (len(self.spans) > 1 or idle):
+                trace('playback_end', ts=now - (read_index - end) / self.output.samplerate, chunk=chunk, turn=turn)
+                self.spans.popleft()
+                continue
+            break
+
+    def clear(self):
+        self.spans.clear()
+
+def _listen_for_commands(command_queue, output, epochs):
+    while True:
+        command = command_queue.get()
+        # 会话级的 ("CLEAR", session) 也会清空本地声卡，因为声卡由所有会话共用
+        if command == "CLEAR" or (isinstance(command, tuple) and command[0] == "CLEAR"):
+            print("[Player]: 收到CLEAR命令，停止播放并清空队列。")
+            if isinstance(command, tuple) and len(command) > 2 and command[2] is not None:
+                # ("CLEAR", session, epoch)：之后才到达的旧代号音频同样丢弃
+                epochs[command[1]] = max(epochs.get(command[1], 0), command[2])
+            output.clear()
+
+def play_audio_data(audio_queue, command_queue, feedback=None):
     """
     健壮的音频播放逻辑，能处理所有状态并响应命令。
+    传入 feedback（自适应分块的 ChunkFeedback）时，持续报告缓冲区中尚未播放的秒数与欠载次数。
     """
     print("音频播放器进程已启动，等待音频或命令...")
+    try:
+        output = GaplessOutput()
+    except Exception as e:
+        print(f"打开音频输出流失败: {e}")
+        return
+
+    # 每个会话被清空时的代号，代号更小的音频属于清空之前的回答
+    epochs = {}
+    threading.Thread(target=_listen_for_commands, args=(command_queue, output, epochs), daemon=True).start()
+    timeline = _PlaybackTimeline(output)
+    playing = False
+    seen_generation = output.generation
     while True:
+        # 音频队列只在主线程中读取：共享内存通道返回的是槽位视图，不能与其他线程并发取出
+        if output.generation != seen_generation:
+            seen_generation = output.generation
+            clear_queue(audio_queue)
+            timeline.clear()
+        timeline.poll()
+        if feedback is not None:
+            feedback.record_buffer(output.buffered_seconds(), output.ring.underruns)
         try:
-            # 1. 首先以带超时的方式等待音频数据
-            # 超时机制确保我们能周期性地检查命令队列
+            generation = output.generation
             audio_data = audio_queue.get(timeout=0.1)
-
-            if audio_data is None:
-                print("音频播放器收到结束信号，即将关闭。")
-                break
-            
-            # 2. 收到音频数据，开始播放
-            sd.play(audio_data, samplerate=24000)
-            print("[Player]: 开始播放音频...")
-
-            # 3. 进入内部循环，监控播放状态和命令
-            while sd.get_stream().active:
-                try:
-                    # 检查命令队列
-                    command = command_queue.get_nowait()
-                    if command == "CLEAR":
-                        print("[Player]: 在播放期间收到CLEAR命令，停止并清空队列。")
-                        sd.stop()
-                        clear_queue(audio_queue)
-                        break 
-                except queue.Empty:
-                    sd.sleep(50)
-            
-            print("[Player]: 本次播放结束。")
-
         except queue.Empty:
-            try:
-                command = command_queue.get_nowait()
-                if command == "CLEAR":
-                    print("[Player]: 在空闲时收到CLEAR命令，清空队列。")
-                    clear_queue(audio_queue)
-            except queue.Empty:
-                pass
+            # 缓冲即将耗尽仍没有下一句，不再等待交叉淡化
+            if output.buffered_seconds() < 0.2:
+                output.flush_tail()
+            if playing and output.ring.fill() == 0:
+                timeline.poll(idle=True)
+                playing = False
+                print(f"[Player]: 本次播放结束。指标: {output.metrics()}")
             continue
 
+        if audio_data is None:
+            print("音频播放器收到结束信号，播放完剩余音频后关闭。")
+            break
+        chunk = turn = None
+        partial = False
+        if isinstance(audio_data, dict):
+            # 本地声卡由所有会话共用，这里只关心音频本身；仅含结束标记的消息直接跳过
+            chunk, turn = audio_data.get('chunk'), audio_data.get('turn')
+            partial = audio_data.get('partial', False)
+            epoch = audio_data.get('epoch')
+            if epoch is not None and epoch < epochs.get(audio_data.get('session'), 0):
+                continue
+            audio_data = audio_data.get('audio')
+            if audio_data is None:
+                continue
+
+        try:
+            if not playing:
+                print("[Player]: 开始播放音频...")
+                playing = True
+            start_index = output.ring.write_index
+            output.write(audio_data, generation, partial)
+            if chunk is not None:
+                timeline.on_write(chunk, turn, start_index, output.ring.write_index)
         except Exception as e:
             print(f"播放音频时发生未知错误: {e}")
             break
-            
-    print("音频播放器进程已关闭。")
\ No newline at end of file
+
+    output.close()
+    print(f"[Player]: 播放指标: {output.metrics()}")
+    print("音频播放器进程已关闭。")
@@ -0,0 +1,98 @@
+import numpy as np
+
+from audio_format import copy_to_float32
+
+
+class AudioRingBuffer:
+    """
+    单生产者/单消费者的无锁环形缓冲区。
+    写索引只由写线程修改，读索引只由输出回调修改；两者都是单调递增的整数，
+    在 GIL 下赋值是原子的，因此回调路径中无需加锁。
+    清空请求记录为“丢弃到某个写位置为止”，由回调在下一次取样时执行。
+    样本以 dtype（音频通路的存储格式）保存，读出时才转换为输出缓冲区的 float32。
+    写端在一句话的最后一个片段写完时标记结束位置；只有在句子中途数据耗尽才记为一次欠载，
+    播放到句子末尾后等待下一句不算欠载。
+    """
+
+    def __init__(self, capacity, dtype=np.float32):
+        self.capacity = int(capacity)
+        self._data = np.zeros(self.capacity, dtype=dtype)
+        self._write_idx = 0
+        self._read_idx = 0
+        self._clear_to = 0
+        # 最近一句话的结束位置，以及回调上一次是否已经没有数据可读
+        self._end_idx = 0
+        self._starved = True
+        self.underruns = 0
+        self.samples_played = 0
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def read_index(self):
+        return self._read_idx
+
+    @property
+    def write_index(self):
+        return self._write_idx
+
+    def fill(self):
+        return self._write_idx - self._read_idx
+
+    def space(self):
+        return self.capacity - self.fill()
+
+    def write(self, samples, end_of_utterance=False):
+        """
+        写入尽可能多的样本，返回实际写入的数量（缓冲区满时可能小于输入长度）。
+        end_of_utterance 表示 samples 是一句话的最后一段，全部写入时标记该句的结束位置（samples 可以为空）。
+        """
+        n = max(min(len(samples), self.space()), 0)
+        if n > 0:
+            start = self._write_idx % self.capacity
+            first = min(n, self.capacity - start)
+            self._data[start:start + first] = samples[:first]
+            if n > first:
+                self._data[:n - first] = samples[first:n]
+        if end_of_utterance and n == len(samples):
+            # 先于写索引更新：回调看到新的写索引时，结束位置一定已经就绪
+            self._end_idx = self._write_idx + n
+        self._write_idx += n
+        return n
+
+    def request_clear(self):
+        """
+        请求丢弃当前已写入的全部样本，可在任意线程调用。
+        """
+        self._clear_to = self._write_idx
+
+    def read_into(self, out):
+        """
+        由输出回调调用：将样本读入 out，不足部分补零。返回实际读出的样本数。
+        """
+        if self._clear_to > self._read_idx:
+            self._read_idx = min(self._clear_to, self._write_idx)
+            # 被清空的句子不会再有后续数据，不算欠载
+            self._starved = True
+
+        frames = len(out)
+        n = min(frames, self._write_idx - self._read_idx)
+        if n > 0:
+            start = self._read_idx % self.capacity
+            first = min(n, self.capacity - start)
+            copy_to_float32(out[:first], self._data[start:start + first])
+            if n > first:
+                copy_to_float32(out[first:n], self._data[:n - first])
+            self._read_idx += n
+            self.samples_played += n
+        if n < frames:
+            out[max(n, 0):] = 0
+            # 数据耗尽时尚未到达写端标记的句子结束位置：句子中途断流，每次断流只计一次
+            if not self._starved and self._read_idx != self._end_idx:
+                self.underruns += 1
+            self._starved = True
+        else:
+            self._starved = False
+        return max(n, 0)
@@ -0,0 +1,148 @@
+"""
+音频存储格式微基准：比较原来的路径（np.array 复制模型输出的 float32 波形，原样入队）与紧凑格式
+（float16 / int16、首尾静音裁剪、重采样）在一轮回答上的内存占用、进程间传输量与转换开销。
+
+报告内容（每种方案）:
+    audio_s     裁剪后实际保留的音频秒数
+    stored_KB   一轮回答的波形在通道、播放器缓冲区或缓存中占用的字节数
+    ipc_KB      经 mp.Queue 传输时 pickle 后的字节数（共享内存通道传输的是同样大小的样本）
+    peak_KB     在 TTS 进程中转换整轮回答时 tracemalloc 记录的内存峰值（包括临时数组）
+    prepare_ms  TTS 进程中每秒音频的转换耗时
+    callback_us 输出回调把一个数据块（blocksize 个样本）转换为 float32 的耗时
+    snr_db      存储格式往返转换后相对 float32 原始波形的信噪比（裁剪或重采样的方案不比较）
+另外给出播放器环形缓冲区与共享内存通道按配置预分配的字节数。
+
+用法:
+    python benchmarks/bench_audio_memory.py [--sentences 20] [--lead-ms 300] [--tail-ms 500] [--repeat 5]
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+from audio_format import MODEL_SAMPLE_RATE, copy_to_float32, prepare, to_float32
+from bench_audio_codec import speech_like
+from config_loader import config
+
+# 名称 -> (存储格式, 裁剪静音, 采样率)；None 表示原来的路径
+VARIANTS = {
+    'float32 (原路径)': None,
+    'float16': (np.float16, False, MODEL_SAMPLE_RATE),
+    'int16': (np.int16, False, MODEL_SAMPLE_RATE),
+    'int16 + 裁剪': (np.int16, True, MODEL_SAMPLE_RATE),
+    'int16 + 裁剪 + 16k': (np.int16, True, 16000),
+}
+BLOCKSIZE = (config.get('player') or {}).get('blocksize', 1024)
+
+
+def make_answer(sentences, lead_ms, tail_ms, seed=0):
+    """
+    模拟一轮回答的模型输出：每句 1.5~5 秒，首尾带有低电平的静音（模型输出的静音段并非绝对的零）。
+    """
+    rng = np.random.default_rng(seed)
+    answer = []
+    for i in range(sentences):
+        speech = speech_like(rng.uniform(1.5, 5.0), seed=seed + i)
+        lead = 0.001 * rng.standard_normal(MODEL_SAMPLE_RATE * lead_ms // 1000)
+        tail = 0.001 * rng.standard_normal(MODEL_SAMPLE_RATE * tail_ms // 1000)
+        answer.append(np.concatenate([lead, speech, tail]).astype(np.float32))
+    return answer
+
+
+def convert(answer, variant):
+    if variant is None:
+        return [np.array(wav) for wav in answer]
+    dtype, trim, rate = variant
+    return [prepare(wav, trim=trim, sample_rate=rate, dtype=dtype) for wav in answer]
+
+
+def best_of(repeat, func):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def callback_seconds(samples, repeat):
+    """
+    输出回调的转换耗时：原来的路径直接复制 float32，紧凑格式在复制时转换。
+    """
+    out = np.zeros(BLOCKSIZE, dtype=np.float32)
+    block = samples[:BLOCKSIZE]
+    if block.dtype == np.float32:
+        def copy():
+            out[:] = block
+    else:
+        def copy():
+            copy_to_float32(out, block)
+    loops = 1000
+    return best_of(repeat, lambda: [copy() for _ in range(loops)]) / loops
+
+
+def snr_db(reference, converted):
+    noise = np.sum((reference - to_float32(converted)) ** 2)
+    return round(float(10 * np.log10(np.sum(reference ** 2) / noise)), 1) if noise else float('inf')
+
+
+def bench(answer, variant, repeat):
+    tracemalloc.start()
+    converted = convert(answer, variant)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rate = variant[2] if variant else MODEL_SAMPLE_RATE
+    audio_seconds = sum(wav.size for wav in converted) / rate
+    source_seconds = sum(wav.size for wav in answer) / MODEL_SAMPLE_RATE
+    messages = [{'session': None, 'audio': wav, 'chunk': 'x' * 32, 'turn': 'y' * 32} for wav in converted]
+    result = {
+        'audio_s': round(audio_seconds, 2),
+        'stored_KB': round(sum(wav.nbytes for wav in converted) / 1024, 1),
+        'ipc_KB': round(sum(len(pickle.dumps(m, protocol=pickle.HIGHEST_PROTOCOL)) for m in messages) / 1024, 1),
+        'peak_KB': round(peak / 1024, 1),
+        'prepare_ms': round(1000 * best_of(repeat, lambda: convert(answer, variant)) / source_seconds, 3),
+        'callback_us': round(1e6 * callback_seconds(converted[0], repeat), 2),
+        'snr_db': None,
+    }
+    if variant is not None and not variant[1] and variant[2] == MODEL_SAMPLE_RATE:
+        result['snr_db'] = min(snr_db(wav, out) for wav, out in zip(answer, converted))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sentences', type=int, default=20, help='一轮回答的句子数')
+    parser.add_argument('--lead-ms', type=int, default=300, help='每句开头的静音（毫秒）')
+    parser.add_argument('--tail-ms', type=int, default=500, help='每句结尾的静音（毫秒）')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    answer = make_answer(args.sentences, args.lead_ms, args.tail_ms)
+    print(f"一轮回答: {args.sentences} 句，模型输出共 {sum(w.size for w in answer) / MODEL_SAMPLE_RATE:.1f} 秒"
+          f"（每句含 {args.lead_ms} ms 前导静音、{args.tail_ms} ms 结尾静音）")
+    baseline = None
+    for name, variant in VARIANTS.items():
+        result = bench(answer, variant, args.repeat)
+        baseline = baseline or result
+        ratio = result['stored_KB'] / baseline['stored_KB']
+        print(f"  {name:18s} {result}  (内存为原路径的 {100 * ratio:.0f}%)")
+
+    player = config.get('player') or {}
+    transport = config.get('audio_transport') or {}
+    ring_samples = MODEL_SAMPLE_RATE * player.get('buffer_seconds', 30)
+    shm_samples = transport.get('num_slots', 32) * MODEL_SAMPLE_RATE * transport.get('slot_seconds', 2)
+    print(f"预分配: 播放器环形缓冲区 {ring_samples * 4 / 1024 / 1024:.2f} MB -> {ring_samples * 2 / 1024 / 1024:.2f} MB，"
+          f"共享内存通道 {shm_samples * 4 / 1024 / 1024:.2f} MB -> {shm_samples * 2 / 1024 / 1024:.2f} MB "
+          f"(float32 -> 16 位，24 kHz)")
+
+
+if __name__ == '__main__':
+    main()
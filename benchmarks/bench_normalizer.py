@@ -0,0 +1,118 @@
+"""
+文本标准化微基准：比较原来的 normalize_mixed_text → convert_year_in_text → cn2an.transform 调用链
+与 text_normalizer 的单遍实现（分别测量无缓存和带 LRU 缓存的吞吐量）。
+
+用法:
+    python benchmarks/bench_normalizer.py [--chunks 5000] [--unique 0.3]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cn2an
+
+import text_normalizer
+
+SAMPLES = [
+    "好的，我来简单介绍一下。",
+    "这座城市始建于1368年，到2024年常住人口已经超过了800万。",
+    "它的经济以制造业和服务业为主，其中服务业占比约为56.3%。",
+    "新款OLED电视支持HDR和120Hz刷新率，售价是4999元。",
+    "我推荐你使用Python 3.11或者更高的版本。",
+    "明天的最高气温是25度，最低气温是18度。",
+    "NASA在1969年把人类送上了月球。",
+    "当然可以！",
+    "这个问题涉及到AI和GPU的发展历史。",
+    "请在第2步完成后再执行第3步。",
+]
+
+CHINESE_DIGITS = str.maketrans('0123456789', '零一二三四五六七八九')
+
+
+def legacy_convert_year_in_text(text):
+    digit_map = {'0': '零', '1': '一', '2': '二', '3': '三', '4': '四', '5': '五', '6': '六', '7': '七', '8': '八', '9': '九'}
+
+    def replace_year(match):
+        chinese_year = ''.join(digit_map[digit] for digit in match.group(1))
+        if match.group(0).endswith('年'):
+            return f"{chinese_year}年"
+        return chinese_year
+
+    return re.sub(r'\b(\d{4})(?:年)?\b', replace_year, text)
+
+
+def legacy_normalize_mixed_text(text):
+    parts = re.split(r'([a-zA-Z0-9\s\'._-]+)', text)
+    processed_parts = []
+    for part in parts:
+        if not part:
+            continue
+        if re.fullmatch(r'[A-Z]{2,}', part.strip()):
+            processed_parts.append(" ".join(part.strip()))
+        else:
+            processed_parts.append(part)
+    return ' '.join(processed_parts).replace('  ', ' ')
+
+
+def legacy_prepare(text):
+    """
+    原 tts_converter._prepare_text 的调用链，作为对照组。
+    """
+    return cn2an.transform(legacy_convert_year_in_text(legacy_normalize_mixed_text(text.strip())), "an2cn")
+
+
+def make_chunks(count, unique_ratio, seed=0):
+    # unique_ratio 控制不重复文本的比例；其余文本从已出现过的文本中抽取（开场白、确认语等）
+    rng = random.Random(seed)
+    chunks, seen = [], []
+    for i in range(count):
+        if seen and rng.random() > unique_ratio:
+            chunks.append(rng.choice(seen))
+        else:
+            # 用汉字编号区分文本，避免给所有样本都引入阿拉伯数字
+            text = f"{rng.choice(SAMPLES)[:-1]}，第{str(i).translate(CHINESE_DIGITS)}条。"
+            seen.append(text)
+            chunks.append(text)
+    return chunks
+
+
+def bench(fn, chunks, repeat, setup=None):
+    best = float('inf')
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--unique', type=float, default=0.3, help='不重复文本的比例')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.unique)
+    mismatches = sum(1 for text in set(chunks) if legacy_prepare(text) != text_normalizer.normalize_for_tts(text))
+    print(f"输出一致性检查: {len(set(chunks))} 条不同文本，{mismatches} 条不一致")
+
+    clear = getattr(text_normalizer._normalize_cached, 'cache_clear', None)
+    results = [
+        ('原调用链', bench(lambda c: [legacy_prepare(t) for t in c], chunks, args.repeat)),
+        ('单遍实现（无缓存）', bench(lambda c: [text_normalizer._normalize(t) for t in c], chunks, args.repeat)),
+        ('单遍实现 + LRU（冷启动）', bench(text_normalizer.normalize_batch, chunks, args.repeat, setup=clear)),
+    ]
+    baseline = results[0][1]
+    for name, seconds in results:
+        print(f"{name:24s} {seconds * 1000:9.2f} ms, {len(chunks) / seconds:10.0f} 块/秒, 加速 {baseline / seconds:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
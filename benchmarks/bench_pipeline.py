@@ -0,0 +1,402 @@
+"""
+完整“文本→音频”流水线的离线基准测试。
+
+使用 stub_llm.py 提供的脚本化大模型服务、stubs/ChatTTS（确定性的假模型，合成耗时可配置）
+和 stubs/sounddevice（按真实时间消费数据的空声卡），驱动真实的 LLM 客户端进程、TTS 进程与播放器进程。
+无需 API Key、Ollama、ChatTTS 源码或声卡，可在 CI 上运行。
+
+报告内容：首音延迟 (TTFA) 分布、每秒播放/合成的句子数、队列深度、各通道的阻塞与丢弃统计、
+各进程 CPU 与内存（需要 psutil）。
+
+指定 --duration 时进入浸泡测试模式：反复发送同一组提示词直到达到指定时长，
+并报告各进程常驻内存的增长速度（MB/小时，按后半段的采样做线性拟合，排除预热阶段）。
+
+用法:
+    python benchmarks/bench_pipeline.py [--provider openai|ollama] [--client sync|async]
+        [--prompts 5] [--concurrency 1] [--same-session] [--tokens-per-second 40] [--think-chars 0]
+        [--tts-seconds-per-char 0.01] [--playback-speed 1] [--text-capacity 64] [--json report.json]
+    python benchmarks/bench_pipeline.py --duration 3600 --playback-speed 10 --same-session
+    python benchmarks/bench_pipeline.py --llm-cache --prompts 8 --distinct-prompts 2 --concurrency 2
+    python benchmarks/bench_pipeline.py --supervised --crash-tts-after 3 --prompts 3
+    python benchmarks/bench_pipeline.py --tts-processes 2 --crash-tts-after 3 --crash-tts-process 2
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, '..')
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from stub_llm import StubLLMServer
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def write_bench_config(args, server, workdir):
+    """
+    以项目的 config.yaml 为基础，生成指向脚本化服务和临时目录的配置文件。
+    """
+    with open(os.path.join(ROOT_DIR, 'config.yaml'), encoding='utf-8') as f:
+        cfg = yaml.safe_load(f)
+    cfg['use_online_model'] = args.provider == 'openai'
+    cfg['online_model'] = {'name': 'stub', 'api_key': 'bench', 'base_url': f"{server.address}/v1"}
+    cfg['local_model'] = {'name': 'stub', 'host': server.address}
+    cfg['chat_tts_path'] = workdir
+    cfg['speaker_embedding_path'] = os.path.join(workdir, 'speaker.pkl')
+    cfg['tracing'] = {'enabled': True, 'path': os.path.join(workdir, 'trace.jsonl')}
+    llm = {**(cfg.get('llm') or {}), 'async_client': args.client == 'async'}
+    # 回答缓存默认关闭，以测量真实的大模型请求路径
+    llm['cache'] = {**(llm.get('cache') or {}), 'enabled': args.llm_cache}
+    cfg['llm'] = llm
+    cfg['chunking'] = {**(cfg.get('chunking') or {}), 'adaptive': args.adaptive_chunking == 'on'}
+    cfg['supervisor'] = {**(cfg.get('supervisor') or {}), 'enabled': args.supervised}
+    if args.text_capacity is not None:
+        pipeline = cfg.setdefault('pipeline', {}) or {}
+        channels = pipeline.setdefault('channels', {}) or {}
+        channels['text_queue'] = {**(channels.get('text_queue') or {}), 'capacity': args.text_capacity}
+        pipeline['channels'] = channels
+        cfg['pipeline'] = pipeline
+    tts = cfg.setdefault('tts', {}) or {}
+    tts['num_processes'] = args.tts_processes
+    if args.stream is not None:
+        tts['stream'] = args.stream == 'on'
+    tts['speculative'] = {**(tts.get('speculative') or {}), 'enabled': args.speculative}
+    # 缓存会让重复的提示词直接命中，默认关闭以测量真实合成路径
+    tts['cache'] = {**(tts.get('cache') or {}), 'enabled': args.cache, 'disk_dir': ''}
+    cfg['tts'] = tts
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(cfg, f, allow_unicode=True)
+    return path
+
+
+class Sampler(threading.Thread):
+    """
+    周期性采样队列深度与各进程的 CPU 时间、常驻内存；常驻内存每隔 series_interval 秒另外记录一个时间序列。
+    """
+
+    def __init__(self, queues, processes, interval=0.1, series_interval=5.0):
+        super().__init__(daemon=True)
+        self.queues = queues
+        self.processes = processes
+        self.interval = interval
+        self.depths = {name: [] for name in queues}
+        self.cpu = {}
+        self.rss = {}
+        self.rss_series = {label: [] for label in processes}
+        self.series_interval = series_interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        handles = {}
+        next_series = 0.0
+        while not self._stop_event.is_set():
+            record_series = time.monotonic() >= next_series
+            if record_series:
+                next_series = time.monotonic() + self.series_interval
+            for name, q in self.queues.items():
+                try:
+                    self.depths[name].append(q.qsize())
+                except NotImplementedError:
+                    pass
+            if psutil is not None:
+                for label, process in self.processes.items():
+                    try:
+                        handle = handles.get(label) or handles.setdefault(label, psutil.Process(process.pid))
+                        times = handle.cpu_times()
+                        # 进程退出后无法再读取，保留最后一次采样值
+                        self.cpu[label] = times.user + times.system
+                        rss = handle.memory_info().rss
+                        self.rss[label] = max(self.rss.get(label, 0), rss)
+                        if record_series:
+                            self.rss_series[label].append((time.monotonic(), rss))
+                    except (psutil.Error, TypeError, ValueError):
+                        pass
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class TraceFollower:
+    """
+    增量读取追踪文件，统计已切分和已播放的文本块数量。长时间运行时不必每次重新读取整个文件。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.emitted = 0
+        self.played = 0
+        self._partial = b''
+
+    def poll(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            try:
+                event = json.loads(line).get('event')
+            except ValueError:
+                continue
+            if event == 'chunk_emit':
+                self.emitted += 1
+            elif event == 'playback_end':
+                self.played += 1
+
+
+def wait_for_playback(follower, timeout):
+    """
+    等待所有已切分的文本块播放完毕（playback_end 数量追上 chunk_emit 数量）。
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        follower.poll()
+        if follower.emitted and follower.played >= follower.emitted:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def growth_mb_per_hour(series):
+    """
+    对后半段的 (时间, 常驻内存) 采样做最小二乘拟合，返回每小时的增长量（MB）。
+    """
+    samples = series[len(series) // 2:]
+    if len(samples) < 3:
+        return None
+    n = len(samples)
+    mean_t = sum(t for t, _ in samples) / n
+    mean_m = sum(m for _, m in samples) / n
+    var = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not var:
+        return None
+    slope = sum((t - mean_t) * (m - mean_m) for t, m in samples) / var
+    return round(slope * 3600 / 1024 / 1024, 2)
+
+
+def crash_stage(supervisor, prefix, delay):
+    """
+    delay 秒后强制终止标签以 prefix 开头的进程，模拟阶段崩溃。
+    """
+    def crash():
+        time.sleep(delay)
+        for label, process in supervisor.processes().items():
+            if label.startswith(prefix) and process.is_alive():
+                print(f"\n[Bench]: 强制终止进程 {label} (PID {process.pid})。")
+                process.kill()
+
+    thread = threading.Thread(target=crash, daemon=True)
+    thread.start()
+    return thread
+
+
+def run(args):
+    server = StubLLMServer(tokens_per_second=args.tokens_per_second, token_chars=args.token_chars,
+                           reply_chars=args.reply_chars, think_chars=args.think_chars,
+                           first_token_delay=args.first_token_delay).start()
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+
+    # 以下环境变量必须在导入项目模块之前设置：配置在导入时读取，ollama 的默认客户端在导入时创建，
+    # 子进程（fork 或 spawn）都会继承这些设置
+    os.environ['CHAT_WITH_ME_CONFIG'] = write_bench_config(args, server, workdir)
+    os.environ['OLLAMA_HOST'] = server.address
+    os.environ['BENCH_TTS_BASE_SECONDS'] = str(args.tts_base_seconds)
+    os.environ['BENCH_TTS_SECONDS_PER_CHAR'] = str(args.tts_seconds_per_char)
+    os.environ['BENCH_PLAYBACK_SPEED'] = str(args.playback_speed)
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [STUBS_DIR, ROOT_DIR, os.environ.get('PYTHONPATH')]))
+    sys.path.insert(0, STUBS_DIR)
+
+    import multiprocessing as mp
+    from async_llm_client import USE_ASYNC_CLIENT, serve_ollama_async, serve_openai_async
+    from audio_player import play_audio_data
+    from config_loader import config
+    from latency_tracer import TRACE_PATH, load_records, summarize
+    from ollama_client import stream_ollama_response, stream_openai_response
+    from pipeline_channel import create_channel
+    from chunk_controller import create_chunk_feedback
+    from shm_transport import create_audio_channel
+    from supervisor import Supervisor
+    from tts_pool import create_tts_processes
+
+    user_input_queue = create_channel('input_queue')
+    text_to_speech_queue = create_channel('text_queue')
+    audio_data_queue = create_audio_channel()
+    ui_update_queue = create_channel('ui_queue')
+    player_command_queue = create_channel('player_command_queue')
+    tts_command_queue = create_channel('tts_command_queue')
+    chunk_feedback = create_chunk_feedback()
+
+    if config['use_online_model']:
+        target = serve_openai_async if USE_ASYNC_CLIENT else stream_openai_response
+        model_config = config['online_model']
+    else:
+        target = serve_ollama_async if USE_ASYNC_CLIENT else stream_ollama_response
+        model_config = config['local_model']
+    supervisor = Supervisor()
+    supervisor.add_stage('llm', lambda input_queue: [mp.Process(
+        target=target, args=(input_queue, text_to_speech_queue, model_config, config['system_prompt'],
+                             ui_update_queue, chunk_feedback))], source=user_input_queue,
+        writes=[text_to_speech_queue, ui_update_queue])
+    supervisor.add_stage('tts', lambda text_queue: create_tts_processes(
+        text_queue, audio_data_queue, tts_command_queue, feedback=chunk_feedback),
+        source=text_to_speech_queue, needs_ready=True, on_give_up=lambda: audio_data_queue.put(None),
+        writes=[audio_data_queue], reads=[tts_command_queue])
+    supervisor.add_stage('player', lambda: [mp.Process(
+        target=play_audio_data, args=(audio_data_queue, player_command_queue, chunk_feedback))],
+        reads=[audio_data_queue, player_command_queue])
+    supervisor.start(order=['tts', 'llm', 'player'])
+    processes = supervisor.processes()
+    if args.crash_tts_after:
+        crash_stage(supervisor, f"tts[{args.crash_tts_process}]", args.crash_tts_after)
+
+    sampler = Sampler({'text_queue': text_to_speech_queue, 'audio_queue': audio_data_queue}, processes)
+    sampler.start()
+
+    follower = TraceFollower(TRACE_PATH)
+    started = time.time()
+    timed_out = False
+    rounds = 0
+    while not timed_out:
+        for batch_start in range(0, args.prompts, args.concurrency):
+            batch = range(batch_start, min(args.prompts, batch_start + args.concurrency))
+            for i in batch:
+                session = 'bench' if args.same_session else f"bench-{i}"
+                question = i % args.distinct_prompts if args.distinct_prompts else i
+                user_input_queue.put({'session': session, 'prompt': f"第 {question} 个问题：请介绍一下这座城市。"})
+            finished = 0
+            while finished < len(batch):
+                try:
+                    item = ui_update_queue.get(timeout=args.timeout)
+                except queue.Empty:
+                    timed_out = True
+                    break
+                if item is None:
+                    break
+                if item[1] is None:
+                    finished += 1
+            if not wait_for_playback(follower, args.timeout):
+                timed_out = True
+            if timed_out:
+                print("!!! 等待回答或播放超时，结果可能不完整。")
+                break
+        rounds += 1
+        if not args.duration or time.time() - started >= args.duration:
+            break
+    elapsed = time.time() - started
+    channels = {'input_queue': user_input_queue, 'text_queue': text_to_speech_queue,
+                'ui_queue': ui_update_queue, 'audio_queue': audio_data_queue}
+    channel_stats = {name: q.stats() for name, q in channels.items() if hasattr(q, 'stats')}
+
+    user_input_queue.put(None)
+    if not supervisor.join(timeout=args.timeout):
+        supervisor.terminate()
+    sampler.stop()
+    server.stop()
+
+    records = load_records(TRACE_PATH)
+    report = summarize(records)
+    played = sum(1 for r in records if r['event'] == 'playback_end')
+    synthesized = [r for r in records if r['event'] == 'tts_done']
+    audio_seconds = sum(r.get('audio_seconds', 0) for r in synthesized)
+    report['wall_seconds'] = round(elapsed, 3)
+    report['rounds'] = rounds
+    report['sentences_played'] = played
+    report['sentences_per_second'] = round(played / elapsed, 3) if elapsed else None
+    report['audio_seconds_per_wall_second'] = round(audio_seconds / elapsed, 3) if elapsed else None
+    report['queue_depth'] = {
+        name: {'max': max(values), 'mean': round(sum(values) / len(values), 2)} if values else None
+        for name, values in sampler.depths.items()
+    }
+    report['channels'] = channel_stats
+    if psutil is not None:
+        report['processes'] = {
+            label: {'cpu_seconds': round(sampler.cpu.get(label, 0.0), 3),
+                    'cpu_percent': round(100 * sampler.cpu.get(label, 0.0) / elapsed, 1) if elapsed else None,
+                    'max_rss_mb': round(sampler.rss.get(label, 0) / 1024 / 1024, 1),
+                    'rss_growth_mb_per_hour': growth_mb_per_hour(sampler.rss_series[label])}
+            for label in processes
+        }
+    if supervisor.enabled:
+        report['supervisor_stats'] = supervisor.stats()
+    report['llm_requests'] = server.requests
+    report['timed_out'] = timed_out
+    report['trace_path'] = TRACE_PATH
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--provider', choices=['openai', 'ollama'], default='openai')
+    parser.add_argument('--client', choices=['sync', 'async'], default='async')
+    parser.add_argument('--prompts', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1, help='同时发出的提示词数量（不同会话）')
+    parser.add_argument('--same-session', action='store_true', help='所有提示词属于同一会话（测试对话历史与前缀缓存）')
+    parser.add_argument('--tokens-per-second', type=float, default=40.0)
+    parser.add_argument('--token-chars', type=int, default=2)
+    parser.add_argument('--reply-chars', type=int, default=150)
+    parser.add_argument('--think-chars', type=int, default=0)
+    parser.add_argument('--first-token-delay', type=float, default=0.2)
+    parser.add_argument('--tts-base-seconds', type=float, default=0.05)
+    parser.add_argument('--tts-seconds-per-char', type=float, default=0.01)
+    parser.add_argument('--tts-processes', type=int, default=1)
+    parser.add_argument('--playback-speed', type=float, default=1.0, help='空声卡的消费倍速，大于 1 可缩短测试时间')
+    parser.add_argument('--stream', choices=['on', 'off'], default=None, help='覆盖 tts.stream 配置')
+    parser.add_argument('--cache', action='store_true', help='启用短语音频缓存')
+    parser.add_argument('--speculative', action='store_true', help='启用句子前缀预合成')
+    parser.add_argument('--llm-cache', action='store_true', help='启用大模型回答缓存')
+    parser.add_argument('--adaptive-chunking', choices=['on', 'off'], default='off',
+                        help='自适应分块（chunking.adaptive），默认关闭以便与固定长度对比')
+    parser.add_argument('--distinct-prompts', type=int, default=0,
+                        help='只使用这么多个不同的提示词并循环发送（测试回答缓存），0 表示每条都不同')
+    parser.add_argument('--supervised', action='store_true', help='启用进程监督 (supervisor.enabled)')
+    parser.add_argument('--crash-tts-after', type=float, default=0.0,
+                        help='若干秒后强制终止 TTS 进程，检查监督器的重启与重放（需要 --supervised）')
+    parser.add_argument('--crash-tts-process', type=int, default=0,
+                        help='终止 TTS 阶段的第几个进程：进程池模式下 0 为调度器，1 起为工作进程')
+    parser.add_argument('--text-capacity', type=int, default=None, help='覆盖文本通道的容量 (pipeline.channels.text_queue)')
+    parser.add_argument('--duration', type=float, default=0.0, help='浸泡测试时长（秒），0 表示只发送一轮提示词')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', help='把报告写入该 JSON 文件，便于在 CI 中比较')
+    args = parser.parse_args()
+
+    report = run(args)
+    print(f"\n流水线基准报告 (provider={args.provider}, client={args.client}, prompts={args.prompts}, "
+          f"concurrency={args.concurrency})，延迟单位：秒")
+    for name, value in report.items():
+        if isinstance(value, dict) and name in ('queue_depth', 'channels', 'processes'):
+            print(f"  {name}:")
+            for key, stats in value.items():
+                print(f"    {key:30s} {stats if stats else '无数据'}")
+        else:
+            print(f"  {name:32s} {value if value is not None else '无数据'}")
+    if psutil is None:
+        print("  (未安装 psutil，跳过各进程 CPU/内存统计)")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report['timed_out'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+分句器微基准：比较旧的“每个 token 都对整个缓冲区 re.split”做法与 StreamingSegmenter。
+
+用法:
+    python benchmarks/bench_segmenter.py [--chars 20000] [--token-size 2]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ollama_client import FIRST_CHUNK_MIN_LENGTH
+from text_segmenter import StreamingSegmenter
+
+
+def legacy_segment(tokens):
+    """
+    原 stream_*_response 中的切分逻辑（不含入队），作为对照组。
+    """
+    chunks = []
+    full_sentence = ""
+    is_first_chunk = True
+    for content in tokens:
+        content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+        if not content:
+            continue
+        full_sentence += content
+        if is_first_chunk and len(full_sentence) >= FIRST_CHUNK_MIN_LENGTH:
+            chunks.append(full_sentence)
+            full_sentence = ""
+            is_first_chunk = False
+            continue
+        if not is_first_chunk:
+            sentences = re.split(r'(?<=[。！？\!\?])\s*', full_sentence)
+            if len(sentences) > 1:
+                chunks.extend(sentences[:-1])
+                full_sentence = sentences[-1]
+    if full_sentence.strip():
+        chunks.append(full_sentence)
+    return chunks
+
+
+def streaming_segment(tokens):
+    segmenter = StreamingSegmenter(FIRST_CHUNK_MIN_LENGTH)
+    chunks = []
+    for content in tokens:
+        chunks.extend(text for text, *_ in segmenter.push(segmenter.filter_think(content)))
+    chunks.extend(text for text, *_ in segmenter.flush())
+    return chunks
+
+
+def make_tokens(total_chars, token_size, sentence_length):
+    # sentence_length 越大，单个句子在缓冲区中停留越久，旧做法的二次方开销越明显
+    body = ("这是一个用于基准测试的很长的句子，" * (sentence_length // 17 + 1))[:sentence_length] + "。"
+    text = (body * (total_chars // len(body) + 1))[:total_chars]
+    return [text[i:i + token_size] for i in range(0, len(text), token_size)]
+
+
+def bench(fn, tokens, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(tokens)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chars', type=int, default=20000)
+    parser.add_argument('--token-size', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for sentence_length in (40, 400, 4000):
+        tokens = make_tokens(args.chars, args.token_size, sentence_length)
+        legacy = bench(legacy_segment, tokens, args.repeat)
+        streaming = bench(streaming_segment, tokens, args.repeat)
+        print(f"句长 {sentence_length:5d}: 旧做法 {legacy * 1000:8.2f} ms, "
+              f"StreamingSegmenter {streaming * 1000:8.2f} ms, 加速 {legacy / streaming:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
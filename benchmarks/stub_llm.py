@@ -0,0 +1,241 @@
+"""
+基准测试用的脚本化大模型服务：按固定速率逐 token 返回预设回答，不需要 API Key 或 Ollama。
+
+同时提供两种协议:
+    POST /v1/chat/completions   OpenAI 兼容的 SSE 流 (base_url = http://host:port/v1)
+    POST /api/chat              Ollama 的 NDJSON 流 (host = http://host:port)
+
+请求 "stream": false 时一次性返回完整回答。流式响应末尾附带 token 用量（每个字符记 1 token），
+并模拟前缀缓存：与上一次请求相同的消息前缀计入 cached_tokens（Ollama 协议下不计入 prompt_eval_count）。
+
+单独运行:
+    python benchmarks/stub_llm.py --port 11435 --tokens-per-second 40
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "好的，我来简单介绍一下。这座城市始建于1368年，到2024年常住人口已经超过了800万。"
+    "它的经济以制造业和服务业为主，其中服务业占比约为56.3%。"
+    "每年春天都有大量游客前来赏花，最热门的景点通常需要提前预约！"
+    "如果你打算去旅行，建议避开节假日，这样体验会更好。"
+    "另外，当地的特色小吃也非常值得一试，比如汤包和鸭血粉丝汤。"
+)
+DEFAULT_THINK = "用户想了解这座城市的概况，我需要给出简洁的回答。"
+# hold 事件一直未被设置时的最长等待，避免测试在客户端出错时永久挂起
+HOLD_TIMEOUT_SECONDS = 30
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端断开保持连接（例如同步客户端退出）时，处理线程读取下一个请求会遇到连接重置，不算错误
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubLLMServer:
+    """
+    reply_chars: 回答的可见字符数（不足时重复预设文本）；think_chars: <think> 段的字符数，0 表示不输出。
+    hold: 可选的 threading.Event，流式响应在输出首个 token 前等待它被设置，测试据此控制回答的先后而不依赖计时。
+    统计: requests 请求数；active_streams / max_active_streams 当前与最多同时进行的流式响应数；
+    completed 完整输出的流式响应数；disconnects 被客户端中途断开的流式响应数。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, tokens_per_second=40.0, token_chars=2,
+                 reply_chars=len(DEFAULT_REPLY), think_chars=0, first_token_delay=0.2, hold=None):
+        self.tokens_per_second = tokens_per_second
+        self.token_chars = max(1, token_chars)
+        self.first_token_delay = first_token_delay
+        self.reply = (DEFAULT_REPLY * (reply_chars // len(DEFAULT_REPLY) + 1))[:reply_chars]
+        self.think = (DEFAULT_THINK * (think_chars // len(DEFAULT_THINK) + 1))[:think_chars]
+        self.hold = hold
+        self.requests = 0
+        self.active_streams = 0
+        self.max_active_streams = 0
+        self.completed = 0
+        self.disconnects = 0
+        self._last_messages = []
+        self._lock = threading.Lock()
+        self._httpd = _QuietHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokens(self):
+        text = f"<think>{self.think}</think>" + self.reply if self.think else self.reply
+        return [text[i:i + self.token_chars] for i in range(0, len(text), self.token_chars)]
+
+    def usage(self, messages):
+        """
+        返回 (提示词 token 数, 命中前缀缓存的 token 数)，并记住本次请求的消息。
+        """
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages)
+        cached = 0
+        with self._lock:
+            for previous, message in zip(self._last_messages, messages):
+                if previous != message:
+                    break
+                cached += len(message.get('content') or '')
+            self._last_messages = messages
+        return prompt_tokens, cached
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                model = body.get('model', 'stub')
+                if self.path.rstrip('/').endswith('/chat/completions'):
+                    content_type, encode = 'text/event-stream', server._openai_event
+                elif self.path.rstrip('/') == '/api/chat':
+                    content_type, encode = 'application/x-ndjson', server._ollama_event
+                else:
+                    self.send_error(404)
+                    return
+                with server._lock:
+                    server.requests += 1
+                prompt_tokens, cached = server.usage(body.get('messages') or [])
+                usage = {'prompt_tokens': prompt_tokens, 'cached_tokens': cached,
+                         'completion_tokens': len(server.reply), 'include': (body.get('stream_options') or {}).get('include_usage')}
+                # 未指定时 OpenAI 协议默认不流式，Ollama 协议默认流式
+                if not body.get('stream', self.path.rstrip('/') == '/api/chat'):
+                    self._write_full(model, usage)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                with server._lock:
+                    server.active_streams += 1
+                    server.max_active_streams = max(server.max_active_streams, server.active_streams)
+                try:
+                    if server.hold is not None:
+                        server.hold.wait(HOLD_TIMEOUT_SECONDS)
+                    time.sleep(server.first_token_delay)
+                    interval = 1.0 / server.tokens_per_second if server.tokens_per_second > 0 else 0
+                    deadline = time.monotonic()
+                    for token in server.tokens():
+                        self._write_chunk(encode(model, token, False))
+                        deadline += interval
+                        delay = deadline - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self._write_chunk(encode(model, '', True, usage))
+                    self.wfile.write(b'0\r\n\r\n')
+                    self.wfile.flush()
+                    with server._lock:
+                        server.completed += 1
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端取消了请求
+                    with server._lock:
+                        server.disconnects += 1
+                finally:
+                    with server._lock:
+                        server.active_streams -= 1
+
+            def _write_full(self, model, usage):
+                if self.path.rstrip('/') == '/api/chat':
+                    response = json.loads(server._ollama_event(model, server.reply, True, usage))
+                else:
+                    response = {
+                        'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': server.reply},
+                                     'finish_reason': 'stop'}],
+                        'usage': server._openai_usage(usage),
+                    }
+                data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+                self.wfile.flush()
+
+        return Handler
+
+    @staticmethod
+    def _openai_usage(usage):
+        return {'prompt_tokens': usage['prompt_tokens'], 'completion_tokens': usage['completion_tokens'],
+                'total_tokens': usage['prompt_tokens'] + usage['completion_tokens'],
+                'prompt_tokens_details': {'cached_tokens': usage['cached_tokens']}}
+
+    @staticmethod
+    def _openai_event(model, token, done, usage=None):
+        if done:
+            if not (usage and usage['include']):
+                return b'data: [DONE]\n\n'
+            chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': model, 'choices': [], 'usage': StubLLMServer._openai_usage(usage)}
+            return f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode('utf-8')
+        chunk = {
+            'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    @staticmethod
+    def _ollama_event(model, token, done, usage=None):
+        chunk = {
+            'model': model, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'message': {'role': 'assistant', 'content': token}, 'done': done,
+        }
+        if done:
+            chunk['done_reason'] = 'stop'
+            if usage:
+                chunk['prompt_eval_count'] = usage['prompt_tokens'] - usage['cached_tokens']
+                chunk['prompt_eval_duration'] = chunk['prompt_eval_count'] * 100000
+                chunk['eval_count'] = usage['completion_tokens']
+        return (json.dumps(chunk, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--tokens-per-second', type=float, default=40.0)
+    parser.add_argument('--token-chars', type=int, default=2)
+    parser.add_argument('--reply-chars', type=int, default=len(DEFAULT_REPLY))
+    parser.add_argument('--think-chars', type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubLLMServer(port=args.port, tokens_per_second=args.tokens_per_second, token_chars=args.token_chars,
+                           reply_chars=args.reply_chars, think_chars=args.think_chars).start()
+    print(f"脚本化大模型服务已启动: {server.address} (OpenAI base_url: {server.address}/v1)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
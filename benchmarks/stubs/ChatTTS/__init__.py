@@ -0,0 +1,62 @@
+"""
+基准测试用的 ChatTTS 替身：不加载任何模型，按文本生成确定性的正弦波。
+
+合成耗时可通过环境变量配置（秒）:
+    BENCH_TTS_BASE_SECONDS      每次 infer 调用的固定开销，默认 0.05
+    BENCH_TTS_SECONDS_PER_CHAR  每个字符的合成耗时，默认 0.01
+    BENCH_TTS_CHARS_PER_SECOND  生成音频的语速（字/秒），决定音频时长，默认 5
+"""
+import os
+import time
+import zlib
+
+import numpy as np
+
+SAMPLE_RATE = 24000
+BASE_SECONDS = float(os.environ.get('BENCH_TTS_BASE_SECONDS', 0.05))
+SECONDS_PER_CHAR = float(os.environ.get('BENCH_TTS_SECONDS_PER_CHAR', 0.01))
+CHARS_PER_SECOND = float(os.environ.get('BENCH_TTS_CHARS_PER_SECOND', 5))
+STREAM_STEPS = 4
+
+
+def _synthesize(text):
+    n = max(1, int(len(text) / CHARS_PER_SECOND * SAMPLE_RATE))
+    # 频率由文本决定，同一文本总是得到相同的波形
+    freq = 200 + zlib.crc32(text.encode('utf-8')) % 400
+    t = np.arange(n, dtype=np.float32) / SAMPLE_RATE
+    return (0.1 * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+class Chat:
+    class InferCodeParams:
+        def __init__(self, spk_emb=None, temperature=0.3, top_P=0.7, top_K=20, **kwargs):
+            self.spk_emb = spk_emb
+            self.temperature = temperature
+            self.top_P = top_P
+            self.top_K = top_K
+            self.__dict__.update(kwargs)
+
+    def load(self, custom_path=None, compile=False, **kwargs):
+        return True
+
+    def sample_random_speaker(self):
+        return 'bench-speaker'
+
+    def infer(self, texts, stream=False, params_infer_code=None, **kwargs):
+        if isinstance(texts, str):
+            texts = [texts]
+        cost = BASE_SECONDS + SECONDS_PER_CHAR * sum(len(t) for t in texts)
+        if stream:
+            return self._infer_stream(texts, cost)
+        time.sleep(cost)
+        return [_synthesize(t) for t in texts]
+
+    def _infer_stream(self, texts, cost):
+        wavs = [_synthesize(t) for t in texts]
+        for step in range(STREAM_STEPS):
+            time.sleep(cost / STREAM_STEPS)
+            frames = []
+            for wav in wavs:
+                size = -(-wav.size // STREAM_STEPS)
+                frames.append(wav[step * size:(step + 1) * size])
+            yield frames
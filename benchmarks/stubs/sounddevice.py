@@ -0,0 +1,51 @@
+"""
+基准测试用的空声卡：OutputStream 按真实时间节奏调用回调并丢弃数据，可在无声卡的 CI 机器上运行。
+环境变量 BENCH_PLAYBACK_SPEED 可以加快消费速度（例如 4 表示四倍速），缩短基准测试耗时。
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+PLAYBACK_SPEED = float(os.environ.get('BENCH_PLAYBACK_SPEED', 1.0))
+
+
+class CallbackFlags:
+    output_underflow = False
+
+
+class OutputStream:
+    def __init__(self, samplerate, channels=1, dtype='float32', blocksize=1024, callback=None, **kwargs):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.blocksize = blocksize or 1024
+        self.callback = callback
+        self._running = False
+        self._thread = None
+
+    def _run(self):
+        outdata = np.zeros((self.blocksize, self.channels), dtype=self.dtype)
+        period = self.blocksize / self.samplerate / PLAYBACK_SPEED
+        deadline = time.monotonic()
+        flags = CallbackFlags()
+        while self._running:
+            self.callback(outdata, self.blocksize, None, flags)
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
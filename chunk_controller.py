@@ -0,0 +1,173 @@
+"""
+根据实测的 TTS 合成速度与播放缓冲水位，在运行时调整文本块的长度。
+
+文本块太短，每次推理的固定开销（模型调用、解码器预热等）所占比例变大；太长则首音延迟增加，
+缓冲不足时下一块来不及合成，播放出现停顿。合理的取值取决于 chat.infer 在当前机器上的速度，
+因此由 TTS 进程测量每个批次的耗时，播放器报告缓冲区中尚未播放的秒数，
+大模型客户端据此决定首块的最小长度和其余文本块的最大长度:
+    合成耗时     按 耗时 = 固定开销 + 每字符耗时 × 字符数 做指数加权的线性回归
+    首块最小长度  首块的播放时长足以覆盖下一块的合成耗时（乘以安全系数）
+    最大长度     缓冲充足时取缓冲秒数内能合成完的最大长度，以摊薄固定开销；
+                缓冲低于 low_water_seconds 时缩短，让下一段音频尽快到达；
+                没有缓冲信息时取固定开销占比不超过 max_overhead_ratio 的长度
+测量值不足时使用 ollama_client 中的默认常量。
+"""
+import math
+import multiprocessing as mp
+import time
+
+from config_loader import config
+from latency_tracer import trace
+
+CHUNKING_CONFIG = config.get('chunking') or {}
+ADAPTIVE_ENABLED = CHUNKING_CONFIG.get('adaptive', False)
+FIRST_CHUNK_RANGE = CHUNKING_CONFIG.get('first_chunk_range', [8, 40])
+MAX_CHARS_RANGE = CHUNKING_CONFIG.get('max_chars_range', [24, 120])
+SAFETY = CHUNKING_CONFIG.get('safety', 1.5)
+LOW_WATER_SECONDS = CHUNKING_CONFIG.get('low_water_seconds', 1.0)
+MAX_OVERHEAD_RATIO = CHUNKING_CONFIG.get('max_overhead_ratio', 0.2)
+MIN_SAMPLES = CHUNKING_CONFIG.get('min_samples', 3)
+UPDATE_INTERVAL_SECONDS = CHUNKING_CONFIG.get('update_interval_seconds', 0.5)
+# 回归的衰减系数：越小越快地跟随负载变化
+DECAY = 0.9
+# 播放器超过该时长没有报告时，认为没有可用的缓冲信息（例如 WebUI 的浏览器模式尚未开始推送）
+BUFFER_STALE_SECONDS = 5.0
+
+
+def _clamp(value, bounds):
+    low, high = bounds
+    return int(min(max(value, low), high))
+
+
+class ChunkFeedback:
+    """
+    保存在共享内存中的测量值：TTS 进程写入合成耗时，播放器写入缓冲水位，大模型客户端读取。
+    """
+    FIELDS = ('samples', 'w', 'x', 'y', 'xx', 'xy', 'audio_per_char', 'buffer_seconds', 'buffer_updated', 'underruns')
+
+    def __init__(self):
+        self._values = mp.Array('d', len(self.FIELDS))
+
+    def record_synthesis(self, chars, seconds, audio_seconds=None):
+        """
+        记录一次推理：chars 个字符（整个批次）耗时 seconds 秒，生成 audio_seconds 秒音频。
+        """
+        if chars <= 0:
+            return
+        v = self._values
+        with v.get_lock():
+            for i in range(1, 6):
+                v[i] *= DECAY
+            v[0] += 1
+            v[1] += 1
+            v[2] += chars
+            v[3] += seconds
+            v[4] += chars * chars
+            v[5] += chars * seconds
+            if audio_seconds:
+                rate = audio_seconds / chars
+                v[6] = rate if not v[6] else 0.8 * v[6] + 0.2 * rate
+
+    def record_buffer(self, seconds, underruns=None):
+        v = self._values
+        with v.get_lock():
+            v[7] = seconds
+            v[8] = time.time()
+            if underruns is not None:
+                v[9] = underruns
+
+    def snapshot(self):
+        with self._values.get_lock():
+            samples, w, x, y, xx, xy, audio_per_char, buffer_seconds, buffer_updated, underruns = self._values
+        snapshot = {'samples': int(samples), 'seconds_per_char': None, 'base_seconds': None,
+                    'audio_seconds_per_char': audio_per_char or None, 'buffer_seconds': None,
+                    'underruns': int(underruns)}
+        if buffer_updated and time.time() - buffer_updated < BUFFER_STALE_SECONDS:
+            snapshot['buffer_seconds'] = buffer_seconds
+        if not w or not x:
+            return snapshot
+        mean_x, mean_y = x / w, y / w
+        variance = xx / w - mean_x * mean_x
+        slope = (xy / w - mean_x * mean_y) / variance if variance > 1e-6 else None
+        if slope is None or slope <= 0 or mean_y - slope * mean_x < 0:
+            # 文本块长度几乎不变，或回归结果不合理：全部耗时计入每字符耗时（偏保守）
+            slope, base = mean_y / mean_x, 0.0
+        else:
+            base = mean_y - slope * mean_x
+        snapshot['seconds_per_char'] = slope
+        snapshot['base_seconds'] = base
+        return snapshot
+
+
+def create_chunk_feedback():
+    return ChunkFeedback() if ADAPTIVE_ENABLED else None
+
+
+class ChunkController:
+    """
+    运行在大模型客户端进程内，给出当前的首块最小长度与文本块最大长度。
+    决策变化时打印并追踪 chunk_sizing 事件。
+    """
+
+    def __init__(self, feedback, first_chunk_min, max_chars):
+        self.feedback = feedback
+        self.default_first = first_chunk_min
+        self.default_max = max_chars
+        self.first_chunk_min = first_chunk_min
+        self.max_chars = max_chars
+        self.reason = 'default'
+        self.decisions = 0
+        # 已发出文本块的平均长度，用于估算首块之后下一块的合成耗时
+        self._mean_chunk = float(first_chunk_min)
+        self._updated = 0.0
+
+    def observe_chunk(self, chars):
+        self._mean_chunk = 0.9 * self._mean_chunk + 0.1 * chars
+
+    def limits(self):
+        """
+        返回 (首块最小长度, 文本块最大长度)，最多每 update_interval_seconds 秒重新计算一次。
+        """
+        now = time.monotonic()
+        if self.feedback is not None and now - self._updated >= UPDATE_INTERVAL_SECONDS:
+            self._updated = now
+            self._update(self.feedback.snapshot())
+        return self.first_chunk_min, self.max_chars
+
+    def _decide(self, m):
+        per_char, base, audio_per_char = m['seconds_per_char'], m['base_seconds'], m['audio_seconds_per_char']
+        if m['samples'] < MIN_SAMPLES or not per_char or not audio_per_char:
+            return self.default_first, self.default_max, 'default'
+
+        # 首块播放期间要合成完下一块
+        next_chunk = max(self._mean_chunk, MAX_CHARS_RANGE[0])
+        first = _clamp(math.ceil(SAFETY * (base + per_char * next_chunk) / audio_per_char), FIRST_CHUNK_RANGE)
+
+        if per_char * SAFETY >= audio_per_char:
+            # 合成慢于实时播放，停顿无法避免：用最长的文本块换取最高的吞吐
+            return first, MAX_CHARS_RANGE[1], 'slower_than_realtime'
+        buffer_seconds = m['buffer_seconds']
+        if buffer_seconds is None:
+            # 固定开销占比不超过 max_overhead_ratio
+            longest = base * (1 - MAX_OVERHEAD_RATIO) / (MAX_OVERHEAD_RATIO * per_char)
+            return first, _clamp(longest, MAX_CHARS_RANGE), 'overhead'
+        if buffer_seconds < LOW_WATER_SECONDS:
+            return first, MAX_CHARS_RANGE[0], 'low_buffer'
+        longest = (buffer_seconds / SAFETY - base) / per_char
+        return first, _clamp(longest, MAX_CHARS_RANGE), 'buffer'
+
+    def _update(self, measurements):
+        first, max_chars, reason = self._decide(measurements)
+        max_chars = max(max_chars, first)
+        if (first, max_chars, reason) == (self.first_chunk_min, self.max_chars, self.reason):
+            return
+        self.first_chunk_min, self.max_chars, self.reason = first, max_chars, reason
+        self.decisions += 1
+        metrics = {key: round(value, 4) if isinstance(value, float) else value
+                   for key, value in measurements.items()}
+        print(f"\n[Chunking]: 首块最小长度 {first}，最大长度 {max_chars} ({reason})，测量值 {metrics}")
+        trace('chunk_sizing', first_chunk_min=first, max_chars=max_chars, reason=reason, **metrics)
+
+    def stats(self):
+        return {'first_chunk_min': self.first_chunk_min, 'max_chars': self.max_chars, 'reason': self.reason,
+                'decisions': self.decisions}
@@ -1,11 +1,12 @@
+import os
 import yaml
 from pathlib import Path
 
 def load_config():
     """
-    加载 YAML 配置文件。
+    加载 YAML 配置文件。可以通过环境变量 CHAT_WITH_ME_CONFIG 指定其他配置文件（例如基准测试）。
     """
-    config_path = Path(__file__).parent / "config.yaml"
+    config_path = Path(os.environ.get("CHAT_WITH_ME_CONFIG") or Path(__file__).parent / "config.yaml")
     if not config_path.exists():
         raise FileNotFoundError(
             f"错误：配置文件 'config.yaml' 未找到。请确保它与此脚本位于同一目录。"
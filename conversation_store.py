@@ -0,0 +1,335 @@
+"""
+按会话保存的对话历史，在 token 预算内组装发给大模型的消息。
+
+为了让服务端的前缀缓存（OpenAI 兼容接口的 prompt cache、Ollama 保持加载的 KV 缓存）持续命中，
+发出的消息只在末尾追加：系统提示词、摘要和已有的对话轮次在两次压缩之间保持逐字节不变。
+历史超过预算的 compact_at 比例后，一次性把最早的若干轮折叠进摘要，压缩到 compact_to 比例，
+而不是每轮都丢弃一条（那样每轮的前缀都会变化，缓存永远无法命中）。
+"""
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from config_loader import config
+from latency_tracer import trace
+
+CONVERSATION_CONFIG = config.get('conversation') or {}
+HISTORY_ENABLED = CONVERSATION_CONFIG.get('enabled', False)
+MAX_CONTEXT_TOKENS = CONVERSATION_CONFIG.get('max_context_tokens', 3000)
+COMPACT_AT = CONVERSATION_CONFIG.get('compact_at', 0.8)
+COMPACT_TO = CONVERSATION_CONFIG.get('compact_to', 0.5)
+SUMMARIZE = CONVERSATION_CONFIG.get('summarize', True)
+SUMMARY_MAX_CHARS = CONVERSATION_CONFIG.get('summary_max_chars', 200)
+MAX_SESSIONS = CONVERSATION_CONFIG.get('max_sessions', 256)
+OLLAMA_KEEP_ALIVE = CONVERSATION_CONFIG.get('ollama_keep_alive', '30m')
+OLLAMA_NUM_CTX = CONVERSATION_CONFIG.get('ollama_num_ctx', 0)
+REPORT_USAGE = CONVERSATION_CONFIG.get('report_usage', True)
+
+SUMMARY_PROMPT = (
+    "请把下面的对话压缩成不超过 {max_chars} 字的摘要，保留用户的身份信息、偏好、已经确认的事实和尚未解决的问题，"
+    "只输出摘要本身。"
+)
+SUMMARY_PREFIX = "此前对话的摘要："
+# 每条消息的格式开销（角色标记、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK = re.compile(r'[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_THINK_BLOCK = re.compile(r'<think>.*?(</think>|$)', re.S)
+
+
+def estimate_tokens(text):
+    """
+    不依赖分词器的粗略估计：中日韩字符约 1 token/字，其余字符约 4 字符/token。
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def strip_think(text):
+    return _THINK_BLOCK.sub('', text).strip()
+
+
+def openai_usage(usage):
+    """
+    从 OpenAI 兼容接口的 usage 中取出 token 统计；不同服务商报告缓存命中的字段不同。
+    """
+    if usage is None:
+        return None
+    cached = getattr(usage, 'prompt_cache_hit_tokens', None)  # DeepSeek
+    if cached is None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None)
+    return {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens,
+            'cached_tokens': cached}
+
+
+def ollama_usage(chunk):
+    """
+    Ollama 最后一个流式片段中的统计。prompt_eval_count 只包含实际计算的 token，
+    前缀命中 KV 缓存时它会明显小于提示词长度。
+    """
+    prompt_eval = chunk.get('prompt_eval_count')
+    duration = chunk.get('prompt_eval_duration')
+    return {'prompt_tokens': prompt_eval, 'completion_tokens': chunk.get('eval_count'),
+            'prompt_eval_ms': round(duration / 1e6, 1) if duration else None}
+
+
+class Conversation:
+    def __init__(self):
+        self.summary = None
+        self.turns = []           # [(用户消息, 助手回答)]
+        self.last_request = []    # 上一次发出的消息，用于计算稳定前缀
+        self.compactions = 0
+
+
+class ConversationStore:
+    """
+    对话历史仓库，运行在大模型客户端进程内。会话数超过 max_sessions 时淘汰最久未使用的会话。
+    客户端在后台线程或独立的任务中压缩历史（见 compact_history_in_background / compact_history_in_task），
+    读写历史的方法都持有 _lock。
+    """
+
+    def __init__(self, system_prompt, max_tokens=MAX_CONTEXT_TOKENS, max_sessions=MAX_SESSIONS):
+        self.system_message = {'role': 'system', 'content': system_prompt}
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        # 估算值与服务端实际 token 数之比，由服务端报告的 usage 校准
+        self._scale = 1.0
+        self._lock = threading.RLock()
+        # 正在后台压缩的会话，以及异步客户端中进行压缩的任务
+        self._compacting = set()
+        self._tasks = set()
+
+    def _get(self, session):
+        conversation = self._sessions.get(session)
+        if conversation is None:
+            conversation = self._sessions[session] = Conversation()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session)
+        return conversation
+
+    def _tokens(self, message):
+        return int(estimate_tokens(message['content']) * self._scale) + MESSAGE_OVERHEAD_TOKENS
+
+    def _history(self, conversation):
+        messages = [self.system_message]
+        if conversation.summary:
+            messages.append({'role': 'system', 'content': SUMMARY_PREFIX + conversation.summary})
+        for user, assistant in conversation.turns:
+            messages.append({'role': 'user', 'content': user})
+            messages.append({'role': 'assistant', 'content': assistant})
+        return messages
+
+    def history_tokens(self, session):
+        return sum(map(self._tokens, self._history(self._get(session))))
+
+    def build_messages(self, session, prompt):
+        """
+        返回 (messages, context)。context 记录本次请求的估算 token 数以及与上一次请求相同的前缀长度。
+        历史加上新问题仍超出预算时（压缩来不及进行），直接丢弃最早的轮次，保证请求不超长。
+        """
+        with self._lock:
+            return self._build_messages(session, prompt)
+
+    def _build_messages(self, session, prompt):
+        user_message = {'role': 'user', 'content': prompt}
+        if not HISTORY_ENABLED:
+            messages = [self.system_message, user_message]
+            return messages, {'context_tokens': sum(map(self._tokens, messages)), 'stable_prefix_tokens': 0,
+                              'history_turns': 0}
+        conversation = self._get(session)
+        trimmed = 0
+        messages = self._history(conversation) + [user_message]
+        while conversation.turns and sum(map(self._tokens, messages)) > self.max_tokens:
+            conversation.turns.pop(0)
+            trimmed += 1
+            messages = self._history(conversation) + [user_message]
+
+        stable = 0
+        for sent, message in zip(conversation.last_request, messages):
+            if sent != message:
+                break
+            stable += self._tokens(message)
+        conversation.last_request = messages
+        context = {'context_tokens': sum(map(self._tokens, messages)), 'stable_prefix_tokens': stable,
+                   'history_turns': len(conversation.turns)}
+        if trimmed:
+            context['trimmed_turns'] = trimmed
+        return messages, context
+
+    def add_turn(self, session, prompt, reply):
+        reply = strip_think(reply)
+        if HISTORY_ENABLED and reply:
+            with self._lock:
+                self._get(session).turns.append((prompt, reply))
+
+    def finish_turn(self, session, turn, prompt, reply, context, usage=None):
+        """
+        一轮回答结束（包括被中断）后记录回答并上报统计。
+        """
+        self.add_turn(session, prompt, reply)
+        self.report(session, turn, context, usage)
+
+    def report(self, session, turn, context, usage):
+        """
+        打印并追踪每轮的上下文规模与缓存命中情况，服务端报告了提示词 token 数时用它校准估算。
+        """
+        stats = dict(context)
+        if usage:
+            stats.update({key: value for key, value in usage.items() if value is not None})
+            reported = usage.get('prompt_tokens')
+            # Ollama 的 prompt_eval_count 不含命中缓存的部分，不能用于校准
+            if reported and 'prompt_eval_ms' not in usage and context['context_tokens']:
+                ratio = reported / (context['context_tokens'] / self._scale)
+                self._scale = 0.8 * self._scale + 0.2 * ratio
+        print(f"\n[Conversation]: 会话 {session} 上下文统计 {stats}")
+        trace('llm_usage', turn=turn, **stats)
+
+    def compaction_due(self, session):
+        """
+        历史超过预算的 compact_at 比例时，返回需要折叠进摘要的最早若干轮 (轮数, 待摘要的文本)；否则返回 None。
+        """
+        if not HISTORY_ENABLED:
+            return None
+        with self._lock:
+            return self._compaction_due(session)
+
+    def _compaction_due(self, session):
+        conversation = self._get(session)
+        if self.history_tokens(session) <= self.max_tokens * COMPACT_AT:
+            return None
+        target = self.max_tokens * COMPACT_TO
+        count = 0
+        remaining = self.history_tokens(session)
+        # 至少保留最近一轮，保证回答的连贯
+        while count < len(conversation.turns) - 1 and remaining > target:
+            user, assistant = conversation.turns[count]
+            remaining -= self._tokens({'content': user}) + self._tokens({'content': assistant})
+            count += 1
+        if not count:
+            return None
+        lines = [SUMMARY_PREFIX + conversation.summary] if conversation.summary else []
+        for user, assistant in conversation.turns[:count]:
+            lines.append(f"用户：{user}")
+            lines.append(f"助手：{assistant}")
+        return count, '\n'.join(lines)
+
+    def compact(self, session, count, summary=None, expected=None):
+        """
+        用摘要替换最早的 count 轮。summary 为 None（未启用摘要或生成失败）时这些轮次直接丢弃，保留旧摘要。
+        expected 为生成摘要时的这几轮（后台压缩）：摘要生成期间 build_messages 可能已从头部截掉其中若干轮，
+        这时只删除仍然留在历史开头的部分；历史与摘要内容对不上时放弃本次压缩，返回 False。
+        """
+        with self._lock:
+            conversation = self._get(session)
+            if expected is not None:
+                count = next((len(expected) - skip for skip in range(len(expected) + 1)
+                              if conversation.turns[:len(expected) - skip] == expected[skip:]), 0)
+                if not count and expected:
+                    print(f"[Conversation]: 会话 {session} 的历史在生成摘要期间已变化，放弃本次压缩。")
+                    return False
+            del conversation.turns[:count]
+            if summary:
+                conversation.summary = summary.strip()[:SUMMARY_MAX_CHARS * 2]
+            conversation.compactions += 1
+        print(f"[Conversation]: 会话 {session} 的历史已压缩 (折叠 {count} 轮，摘要 {len(conversation.summary or '')} 字)。")
+        return True
+
+
+def summary_messages(transcript):
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT.format(max_chars=SUMMARY_MAX_CHARS)},
+        {'role': 'user', 'content': transcript},
+    ]
+
+
+def _summary_done(session, started, summary=None, error=None):
+    if error is not None:
+        print(f"\n[Conversation]: 生成摘要失败: {error}")
+    summary = strip_think(summary or '') or None
+    trace('llm_summary', session=session, seconds=round(time.monotonic() - started, 3), ok=summary is not None)
+    return summary
+
+
+def _begin_compaction(store, session):
+    """
+    需要压缩时登记该会话并返回 (轮数, 待摘要的文本, 这几轮的副本)；不需要或该会话已在压缩时返回 None。
+    """
+    with store._lock:
+        if session in store._compacting:
+            return None
+        due = store.compaction_due(session)
+        if due is None:
+            return None
+        count, transcript = due
+        store._compacting.add(session)
+        return count, transcript, list(store._get(session).turns[:count])
+
+
+def _end_compaction(store, session):
+    with store._lock:
+        store._compacting.discard(session)
+
+
+def compact_history_in_background(store, session, summarize):
+    """
+    同步客户端在一轮回答结束后调用：需要时生成摘要并压缩历史。summarize(messages) 返回摘要文本，失败时只丢弃旧轮次。
+    摘要请求在守护线程中进行，不会推迟下一轮的首音。同一会话同时只进行一次压缩，摘要完成前的新一轮照常使用未压缩的历史。
+    返回启动的线程，不需要压缩时返回 None。
+    """
+    due = _begin_compaction(store, session)
+    if due is None:
+        return None
+    count, transcript, expected = due
+
+    def run():
+        try:
+            summary = None
+            if SUMMARIZE:
+                started = time.monotonic()
+                try:
+                    summary = _summary_done(session, started, summarize(summary_messages(transcript)))
+                except Exception as e:
+                    _summary_done(session, started, error=e)
+            store.compact(session, count, summary, expected)
+        finally:
+            _end_compaction(store, session)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def compact_history_in_task(store, session, summarize):
+    """
+    compact_history_in_background 的异步版本，summarize 为返回摘要文本的协程函数。
+    摘要在独立的任务中生成，不属于该会话的回答任务：新问题或停止操作取消回答时摘要照常完成，
+    下一轮也不必等待摘要。返回创建的任务（保存在 store._tasks 中直到完成），不需要压缩时返回 None。
+    """
+    due = _begin_compaction(store, session)
+    if due is None:
+        return None
+    count, transcript, expected = due
+
+    async def run():
+        try:
+            summary = None
+            if SUMMARIZE:
+                started = time.monotonic()
+                try:
+                    summary = _summary_done(session, started, await summarize(summary_messages(transcript)))
+                except Exception as e:
+                    _summary_done(session, started, error=e)
+            store.compact(session, count, summary, expected)
+        finally:
+            _end_compaction(store, session)
+
+    task = asyncio.get_running_loop().create_task(run())
+    # 事件循环只弱引用任务，需要保留引用直到完成
+    store._tasks.add(task)
+    task.add_done_callback(store._tasks.discard)
+    return task
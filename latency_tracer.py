@@ -0,0 +1,277 @@
+"""
+端到端延迟追踪。
+
+各进程调用 trace() 把事件以 JSON 行的形式追加到同一个文件中（以 O_APPEND 方式写入，多进程安全），
+每个文本块带有 chunk ID，每轮对话带有 turn ID。事件包括:
+    prompt            收到用户输入 (turn)
+    llm_first_token   大模型返回首个 token (turn)
+    chunk_emit        文本块切分完成并送往 TTS (turn, chunk)
+    tts_submit        文本块提交推理 (chunk)
+    tts_cache_hit     文本块命中音频缓存 (chunk)
+    tts_done          推理完成 (chunk, synth_seconds, audio_seconds, batch_audio_seconds, streamed)
+    enqueue           音频放入播放队列 (chunk)，流式合成时为首个音频帧入队
+    playback_start    开始播放 (chunk)
+    playback_end      播放结束 (chunk)
+    spec_emit         句子前缀送去预合成 (turn, chunk)
+    spec_hit          预合成前缀被完整句子复用 (chunk)
+    spec_discard      预合成前缀被丢弃 (chunk, wasted: 是否已经花费了推理算力)
+    tts_ready         TTS 进程启动完成 (import, speaker, model_load, warmup, total, buffered_chunks)
+    tts_cancel        过时批次被撤销或中途停止 (kind, chars, saved_seconds, wasted_seconds)
+    llm_usage         一轮回答的上下文规模 (turn, context_tokens, stable_prefix_tokens, history_turns,
+                      以及服务端报告的 prompt_tokens, cached_tokens 等)
+    llm_summary       历史压缩时生成摘要 (session, seconds, ok)
+    chunk_sizing      自适应分块调整了文本块长度 (first_chunk_min, max_chars, reason, seconds_per_char, base_seconds,
+                      audio_seconds_per_char, buffer_seconds, underruns)
+    llm_cache         回答缓存查询 (turn, result: hit / coalesced / miss, chars)
+    llm_backpressure  文本通道饱和，大模型客户端暂停读取流式响应 (turn, seconds)
+    channel_gauges    通道的定期统计 (channel, capacity, depth, max_depth, blocked_puts, wait_seconds, dropped 等)
+    audio_encode      WebUI 把一段音频编码后推送给浏览器 (chunk, turn, codec, bytes, audio_seconds, encode_ms)
+    audio_delivery    WebUI 一轮音频推送结束 (session, codec, segments, bytes, kbps, encode_ms_p50 等)
+    stage_restart     监督器重启了一个阶段 (stage, reason: crash / hung / stall, lost_seconds, restarts)
+    stage_recovered   重启的阶段恢复工作 (stage, downtime_seconds)
+
+查看汇总报告:
+    python latency_tracer.py [trace.jsonl]
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from config_loader import config
+
+TRACE_CONFIG = config.get('tracing') or {}
+TRACE_ENABLED = TRACE_CONFIG.get('enabled', False)
+TRACE_PATH = TRACE_CONFIG.get('path', './logs/latency_trace.jsonl')
+
+_lock = threading.Lock()
+_file = None
+_file_pid = None
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:12]
+
+
+def _open_trace_file():
+    global _file, _file_pid
+    # 子进程（fork）继承的文件对象不能共用缓冲区，按 PID 重新打开
+    if _file is None or _file_pid != os.getpid():
+        directory = os.path.dirname(TRACE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _file = open(TRACE_PATH, 'a', encoding='utf-8')
+        _file_pid = os.getpid()
+    return _file
+
+
+def trace(event, ts=None, **fields):
+    """
+    记录一个事件。ts 默认为当前时间（time.time()，跨进程可比）。
+    """
+    if not TRACE_ENABLED:
+        return
+    record = {'ts': ts if ts is not None else time.time(), 'event': event, 'pid': os.getpid()}
+    record.update((k, v) for k, v in fields.items() if v is not None)
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    try:
+        with _lock:
+            f = _open_trace_file()
+            f.write(line)
+            f.flush()
+    except OSError as e:
+        print(f"[Tracer]: 写入追踪文件失败: {e}")
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(p):
+        # 最近秩法
+        index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+        return round(values[index], 4)
+
+    return {'n': len(values), 'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': round(values[-1], 4)}
+
+
+def summarize(records):
+    """
+    由追踪事件计算各阶段的延迟分布。
+    """
+    turns = defaultdict(dict)
+    chunks = defaultdict(dict)
+    for r in records:
+        event, chunk, turn = r.get('event'), r.get('chunk'), r.get('turn')
+        if chunk is not None:
+            chunks[chunk].setdefault(event, r)
+            if turn is not None:
+                chunks[chunk]['turn'] = turn
+        elif turn is not None:
+            turns[turn].setdefault(event, r)
+
+    for chunk, events in chunks.items():
+        start = events.get('playback_start')
+        turn = events.get('turn')
+        if start is not None and turn is not None:
+            first = turns[turn].get('first_playback')
+            if first is None or start['ts'] < first:
+                turns[turn]['first_playback'] = start['ts']
+
+    ttfa, first_token, first_chunk = [], [], []
+    for events in turns.values():
+        prompt = events.get('prompt')
+        if prompt is None:
+            continue
+        if 'first_playback' in events:
+            ttfa.append(events['first_playback'] - prompt['ts'])
+        if 'llm_first_token' in events:
+            first_token.append(events['llm_first_token']['ts'] - prompt['ts'])
+
+    def stage(a, b, streamed=None):
+        return [e[b]['ts'] - e[a]['ts'] for e in chunks.values() if a in e and b in e
+                and (streamed is None or bool(e.get('tts_done', {}).get('streamed')) == streamed)]
+
+    rtf = []
+    for events in chunks.values():
+        done = events.get('tts_done')
+        if done and done.get('batch_audio_seconds'):
+            rtf.append(done['synth_seconds'] / done['batch_audio_seconds'])
+        if events.get('chunk_emit', {}).get('first') and 'playback_start' in events:
+            first_chunk.append(events['playback_start']['ts'] - events['chunk_emit']['ts'])
+
+    startup = [r['total'] for r in records if r.get('event') == 'tts_ready' and 'total' in r]
+    speculated = sum(1 for r in records if r.get('event') == 'spec_emit')
+    speculation = None
+    if speculated:
+        hits = sum(1 for r in records if r.get('event') == 'spec_hit')
+        wasted = sum(1 for r in records if r.get('event') == 'spec_discard' and r.get('wasted'))
+        speculation = {'speculated': speculated, 'hits': hits, 'wasted': wasted,
+                       'hit_rate': round(hits / speculated, 3), 'waste_rate': round(wasted / speculated, 3)}
+
+    cancels = [r for r in records if r.get('event') == 'tts_cancel']
+    cancellation = None
+    if cancels:
+        cancellation = {
+            'batches': len(cancels),
+            'before_start': sum(1 for r in cancels if r.get('kind') == 'before_start'),
+            'interrupted': sum(1 for r in cancels if r.get('kind') == 'interrupted'),
+            'saved_seconds': round(sum(r.get('saved_seconds', 0.0) for r in cancels), 3),
+            'wasted_seconds': round(sum(r.get('wasted_seconds', 0.0) for r in cancels), 3),
+        }
+
+    usages = [r for r in records if r.get('event') == 'llm_usage']
+    context = None
+    if usages:
+        estimated = sum(r.get('context_tokens', 0) for r in usages)
+        stable = sum(r.get('stable_prefix_tokens', 0) for r in usages)
+        context = {'turns': len(usages), 'context_tokens': _percentiles([r.get('context_tokens', 0) for r in usages]),
+                   'stable_prefix_ratio': round(stable / estimated, 3) if estimated else None,
+                   'summaries': sum(1 for r in records if r.get('event') == 'llm_summary')}
+        reported = [r for r in usages if r.get('cached_tokens') is not None and r.get('prompt_tokens')]
+        if reported:
+            context['cached_ratio'] = round(sum(r['cached_tokens'] for r in reported)
+                                            / sum(r['prompt_tokens'] for r in reported), 3)
+
+    pauses = [r.get('seconds', 0.0) for r in records if r.get('event') == 'llm_backpressure']
+    backpressure = {'turns': len(pauses), 'seconds': _percentiles(pauses)} if pauses else None
+
+    lookups = [r for r in records if r.get('event') == 'llm_cache']
+    llm_cache = None
+    if lookups:
+        results = [r.get('result') for r in lookups]
+        llm_cache = {'lookups': len(lookups), 'hits': results.count('hit'), 'coalesced': results.count('coalesced'),
+                     'hit_rate': round((len(lookups) - results.count('miss')) / len(lookups), 3)}
+        hit_turns = {r.get('turn') for r in lookups if r.get('result') != 'miss'}
+        hit_ttfa = [turns[t]['first_playback'] - turns[t]['prompt']['ts'] for t in hit_turns
+                    if 'first_playback' in turns.get(t, {}) and 'prompt' in turns[t]]
+        if hit_ttfa:
+            llm_cache['time_to_first_audio'] = _percentiles(hit_ttfa)
+
+    sizing = [r for r in records if r.get('event') == 'chunk_sizing']
+    chunk_sizing = None
+    if sizing:
+        reasons = defaultdict(int)
+        for r in sizing:
+            reasons[r.get('reason')] += 1
+        chunk_sizing = {'decisions': len(sizing), 'reasons': dict(reasons),
+                        'first_chunk_min': _percentiles([r['first_chunk_min'] for r in sizing]),
+                        'max_chars': _percentiles([r['max_chars'] for r in sizing]),
+                        'last': {key: sizing[-1].get(key) for key in ('first_chunk_min', 'max_chars', 'reason')},
+                        'underruns': max(r.get('underruns', 0) for r in sizing)}
+
+    encodes = [r for r in records if r.get('event') == 'audio_encode']
+    audio_delivery = None
+    if encodes:
+        sent = sum(r.get('bytes', 0) for r in encodes)
+        seconds = sum(r.get('audio_seconds', 0.0) for r in encodes)
+        audio_delivery = {'segments': len(encodes), 'codecs': sorted({r.get('codec') for r in encodes}),
+                          'kbps': round(8 * sent / seconds / 1000, 1) if seconds else None,
+                          'encode_ms': _percentiles([r.get('encode_ms', 0.0) for r in encodes])}
+
+    restarts = [r for r in records if r.get('event') == 'stage_restart']
+    supervisor = None
+    if restarts:
+        reasons = defaultdict(int)
+        for r in restarts:
+            reasons[f"{r.get('stage')}:{r.get('reason')}"] += 1
+        recovered = [r.get('downtime_seconds', 0.0) for r in records if r.get('event') == 'stage_recovered']
+        supervisor = {'restarts': dict(reasons),
+                      'lost_seconds': round(sum(r.get('lost_seconds', 0.0) for r in restarts), 3),
+                      'downtime_seconds': round(sum(recovered), 3), 'recovered': len(recovered)}
+
+    return {
+        'time_to_first_audio': _percentiles(ttfa),
+        'llm_first_token': _percentiles(first_token),
+        'first_chunk_emit_to_playback': _percentiles(first_chunk),
+        'emit_to_tts_submit': _percentiles(stage('chunk_emit', 'tts_submit')),
+        'tts_submit_to_done': _percentiles(stage('tts_submit', 'tts_done')),
+        # 流式合成的音频在推理完成前就开始入队，只统计非流式的任务；流式任务统计提交到首帧入队的时间
+        'tts_done_to_enqueue': _percentiles(stage('tts_done', 'enqueue', streamed=False)),
+        'tts_submit_to_first_frame': _percentiles(stage('tts_submit', 'enqueue', streamed=True)),
+        'emit_to_enqueue': _percentiles(stage('chunk_emit', 'enqueue')),
+        'enqueue_to_playback': _percentiles(stage('enqueue', 'playback_start')),
+        'real_time_factor': _percentiles(rtf),
+        'speculation': speculation,
+        'cancellation': cancellation,
+        'context': context,
+        'backpressure': backpressure,
+        'llm_cache': llm_cache,
+        'chunk_sizing': chunk_sizing,
+        'audio_delivery': audio_delivery,
+        'supervisor': supervisor,
+        'tts_startup': _percentiles(startup),
+    }
+
+
+def load_records(path):
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else TRACE_PATH
+    if not os.path.exists(path):
+        print(f"追踪文件 '{path}' 不存在。请在 config.yaml 中开启 tracing.enabled 后运行一次对话。")
+        return 1
+    report = summarize(load_records(path))
+    print(f"延迟报告 ({path})，单位：秒（real_time_factor 为合成耗时/音频时长）")
+    for name, stats in report.items():
+        print(f"  {name:30s} {stats if stats else '无数据'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
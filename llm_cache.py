@@ -0,0 +1,261 @@
+"""
+大模型回答缓存。
+
+常见问题式的提示词反复出现时，每次都要付出完整的网络与推理延迟。这里按 (服务类型, 模型, 系统提示词摘要,
+完整消息列表, 采样参数) 缓存回答的 token 流及每段到达的时间，命中时按原来的节奏（可加速）回放，
+下游仍然逐段分句、逐块合成，与真实的流式响应没有区别。
+消息列表包含对话历史，因此只有上下文完全相同时才会命中（例如各会话的第一个问题）。
+
+异步客户端中，相同的请求同时到达时只向上游发出一次，其余请求订阅同一条正在进行的流（in-flight 合并）。
+只缓存正常结束的非空回答；被中断或出错的回答不会写入。
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from config_loader import config
+from latency_tracer import trace
+
+LLM_CACHE_CONFIG = (config.get('llm') or {}).get('cache') or {}
+LLM_CACHE_ENABLED = LLM_CACHE_CONFIG.get('enabled', False)
+TTL_SECONDS = LLM_CACHE_CONFIG.get('ttl_seconds', 3600)
+MAX_ENTRIES = LLM_CACHE_CONFIG.get('max_entries', 256)
+MAX_CHARS = LLM_CACHE_CONFIG.get('max_chars', 200000)
+# 回放速度：1 为原始节奏，大于 1 按倍数加速，0 表示不等待；首段总是立即产出
+REPLAY_SPEED = LLM_CACHE_CONFIG.get('replay_speed', 4.0)
+
+
+def make_key(provider, model, messages, **params):
+    """
+    params 为影响回答内容的采样参数（temperature、num_ctx 等），值为 None 的参数不参与计算。
+    """
+    system = ''.join(m['content'] for m in messages if m.get('role') == 'system')
+    payload = json.dumps({
+        'provider': provider,
+        'model': model,
+        'system': hashlib.sha256(system.encode('utf-8')).hexdigest(),
+        'messages': [m for m in messages if m.get('role') != 'system'],
+        'params': {k: v for k, v in params.items() if v is not None},
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CachedResponse:
+    """
+    一条回答的 token 流：[(相对首段的秒数, 文本)]。
+    """
+    __slots__ = ('pieces', 'chars', 'created', '_started')
+
+    def __init__(self):
+        self.pieces = []
+        self.chars = 0
+        self.created = time.monotonic()
+        self._started = None
+
+    def add(self, content):
+        if not content:
+            return
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        self.pieces.append((now - self._started, content))
+        self.chars += len(content)
+
+    def text(self):
+        return ''.join(content for _, content in self.pieces)
+
+
+def _replay_delays(response, speed):
+    previous = 0.0
+    for offset, content in response.pieces:
+        delay = (offset - previous) / speed if speed else 0.0
+        previous = offset
+        yield delay, content
+
+
+def replay(response, speed=REPLAY_SPEED):
+    for delay, content in _replay_delays(response, speed):
+        if delay > 0:
+            time.sleep(delay)
+        yield content
+
+
+async def replay_async(response, speed=REPLAY_SPEED):
+    for delay, content in _replay_delays(response, speed):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield content
+
+
+class _Inflight:
+    """
+    正在向上游请求的回答，由单独的任务读取，所有订阅者共享。最后一个订阅者离开时取消上游请求。
+    """
+
+    def __init__(self):
+        self.response = CachedResponse()
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        index = 0
+        while True:
+            changed = self._changed
+            pieces = self.response.pieces
+            while index < len(pieces):
+                yield pieces[index][1]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class ResponseCache:
+    """
+    按 LRU 淘汰的回答缓存，条目超过 ttl_seconds 后失效；条目数或总字数超出上限时淘汰最久未使用的条目。
+    运行在大模型客户端进程内。
+    """
+
+    def __init__(self, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES, max_chars=MAX_CHARS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._inflight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        response = self._entries.get(key)
+        if response is not None and self.ttl_seconds and time.monotonic() - response.created > self.ttl_seconds:
+            self._drop(key)
+            self.expired += 1
+            response = None
+        if response is not None:
+            self._entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        if not response.chars or response.chars > self.max_chars:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = response
+        self._chars += response.chars
+        while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        self._chars -= self._entries.pop(key).chars
+
+    def _record(self, result, turn, response=None):
+        if result == 'hit':
+            self.hits += 1
+        elif result == 'coalesced':
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        if result != 'miss':
+            print(f"\n[LLM Cache]: 回答{'命中缓存' if result == 'hit' else '与进行中的相同请求合并'}，统计 {self.stats()}")
+        trace('llm_cache', turn=turn, result=result, chars=response.chars if result == 'hit' else None)
+
+    def stream(self, key, make_stream, turn=None):
+        """
+        同步版本：命中时回放缓存，否则读取 make_stream() 产出的文本并在正常结束后写入缓存。
+        """
+        response = self.get(key)
+        if response is not None:
+            self._record('hit', turn, response)
+            yield from replay(response)
+            return
+        self._record('miss', turn)
+        response = CachedResponse()
+        for content in make_stream():
+            response.add(content)
+            yield content
+        self.put(key, response)
+
+    async def stream_async(self, key, make_stream, turn=None):
+        """
+        异步版本：make_stream() 返回异步迭代器。未命中时上游请求在单独的任务中读取，
+        同时到达的相同请求订阅这条流，而不再各自请求上游。
+        """
+        response = self.get(key)
+        if response is not None:
+            self._record('hit', turn, response)
+            async for content in replay_async(response):
+                yield content
+            return
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            self._record('miss', turn)
+            inflight = self._inflight[key] = _Inflight()
+            inflight.task = asyncio.create_task(self._fetch(key, inflight, make_stream))
+        else:
+            self._record('coalesced', turn)
+        inflight.subscribers += 1
+        try:
+            async for content in inflight.follow():
+                yield content
+        finally:
+            inflight.subscribers -= 1
+            if not inflight.subscribers and not inflight.done:
+                # 所有请求方都已取消（例如会话被打断），不再需要这条回答
+                self._inflight.pop(key, None)
+                inflight.task.cancel()
+
+    async def _fetch(self, key, inflight, make_stream):
+        try:
+            async for content in make_stream():
+                if content:
+                    inflight.response.add(content)
+                    inflight.notify()
+        except asyncio.CancelledError:
+            inflight.error = asyncio.CancelledError()
+        except Exception as e:
+            inflight.error = e
+        else:
+            self.put(key, inflight.response)
+        finally:
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+            inflight.done = True
+            inflight.notify()
+
+    def stats(self):
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'chars': self._chars,
+        }
+
+
+def create_response_cache():
+    if not LLM_CACHE_ENABLED:
+        return None
+    print(f"[LLM Cache]: 回答缓存已启用 (有效期 {TTL_SECONDS} 秒，最多 {MAX_ENTRIES} 条 / {MAX_CHARS} 字，"
+          f"回放速度 {REPLAY_SPEED or '不限'})。")
+    return ResponseCache()
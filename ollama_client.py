@@ -1,25 +1,166 @@
 import ollama
 import openai
 import re
+from config_loader import config
+from conversation_store import (
+    HISTORY_ENABLED,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_NUM_CTX,
+    REPORT_USAGE,
+    ConversationStore,
+    compact_history_in_background,
+    ollama_usage,
+    openai_usage,
+)
+from text_segmenter import StreamingSegmenter
+from latency_tracer import new_trace_id, trace
+from llm_cache import create_response_cache, make_key
+from chunk_controller import ChunkController
+import supervisor
 
+# 默认的首块最小长度与文本块最大长度；启用自适应分块（chunking.adaptive）后由 ChunkController 在运行时调整
 FIRST_CHUNK_MIN_LENGTH = 18
 MAX_CHARS_PER_CHUNK = 50
 
-def _process_and_queue_text_chunk(text_chunk, text_queue, ui_queue):
+# 预合成：句子尚未结束时，把以分句标点结尾的稳定前缀提前交给 TTS
+SPECULATIVE_CONFIG = (config.get('tts') or {}).get('speculative') or {}
+SPECULATIVE_ENABLED = SPECULATIVE_CONFIG.get('enabled', False)
+SPECULATIVE_MIN_CHARS = SPECULATIVE_CONFIG.get('min_chars', 8)
+
+def _unpack_prompt(item):
+    """
+    输入队列中的元素可以是字符串（终端），也可以是 {'session': ..., 'prompt': ...}（WebUI）。
+    {'session': ..., 'cancel': True} 形式的取消请求只有异步客户端支持，这里返回的 prompt 为 None。
+    提示词字典还可以带有 'voice'，用于切换该会话的音色（见 _apply_voice），
+    以及 'epoch'，即 WebUI 为该会话分配的代号（见 _start_turn）。
+    """
+    if isinstance(item, dict):
+        return item.get('session'), item.get('prompt')
+    return None, item
+
+def _apply_voice(item, text_queue):
+    """
+    提示词附带 'voice' 时，通知 TTS 为该会话切换音色；该会话之后的回答都使用这个音色，直到再次切换。
+    空字符串表示恢复默认音色。
+    """
+    if isinstance(item, dict) and 'voice' in item:
+        text_queue.put({'session': item.get('session'), 'set_voice': item['voice']})
+
+def _ollama_chat_options():
+    """
+    keep_alive 让模型连同上一轮的 KV 缓存常驻内存，前缀相同的下一轮只需计算新增的部分；
+    num_ctx 需要容纳完整的历史，否则 Ollama 会从头部截断，前缀也就不再稳定。未启用多轮历史时使用 Ollama 的默认设置。
+    """
+    if not HISTORY_ENABLED:
+        return {}
+    options = {'keep_alive': OLLAMA_KEEP_ALIVE}
+    if OLLAMA_NUM_CTX:
+        options['options'] = {'num_ctx': OLLAMA_NUM_CTX}
+    return options
+
+def _openai_stream_options():
+    # 让流式响应的最后一个片段带上 token 用量（包括服务商报告的前缀缓存命中数）
+    return {'stream_options': {'include_usage': True}} if REPORT_USAGE else {}
+
+def _ollama_stream(model_name, messages, chat_options, usage):
+    for chunk in ollama.chat(model=model_name, messages=messages, stream=True, **chat_options):
+        if chunk.get('done'):
+            usage.update(ollama_usage(chunk))
+        yield chunk['message']['content']
+
+def _openai_stream(client, model_name, messages, usage):
+    stream = client.chat.completions.create(model=model_name, messages=messages, stream=True, temperature=0.7, **_openai_stream_options())
+    for chunk in stream:
+        if getattr(chunk, 'usage', None) is not None:
+            usage.update(openai_usage(chunk.usage))
+        if chunk.choices:
+            yield chunk.choices[0].delta.content
+
+def _cache_key(provider, model_name, messages):
+    """
+    回答缓存的键，包含影响回答内容的采样参数。
+    """
+    if provider == 'openai':
+        return make_key(provider, model_name, messages, temperature=0.7)
+    return make_key(provider, model_name, messages, num_ctx=OLLAMA_NUM_CTX or None)
+
+def _stream_with_cache(cache, provider, model_name, messages, make_stream, turn=None):
+    if cache is None:
+        return make_stream()
+    return cache.stream(_cache_key(provider, model_name, messages), make_stream, turn)
+
+def _create_chunking(feedback):
+    return ChunkController(feedback, FIRST_CHUNK_MIN_LENGTH, MAX_CHARS_PER_CHUNK) if feedback is not None else None
+
+def _chunk_limits(chunking):
+    """
+    返回 (首块最小长度, 文本块最大长度)。
+    """
+    return chunking.limits() if chunking is not None else (FIRST_CHUNK_MIN_LENGTH, MAX_CHARS_PER_CHUNK)
+
+def _new_segmenter(chunking=None):
+    return StreamingSegmenter(_chunk_limits(chunking)[0])
+
+def _report_turn(item, busy):
+    """
+    在监督下运行时报告本轮的状态：回答期间低水位为本条提示词的中转序号，回答结束后为下一条。
+    """
+    relay_seq = supervisor.relay_seq(item)
+    if relay_seq is not None:
+        supervisor.report(1 if busy else 0, relay_seq if busy else relay_seq + 1)
+
+def _prompt_epoch(item):
+    return item.get('epoch') if isinstance(item, dict) else None
+
+def _finish_turn(session, text_queue, ui_queue, turn=None):
+    # 结束标记会随音频流按顺序送达，WebUI 据此结束该会话本轮的音频推送
+    text_queue.put({'session': session, 'turn': turn, 'end_of_turn': True})
+    if ui_queue:
+        ui_queue.put((session, None))
+
+def _start_turn(session, text_queue=None, epoch=None):
+    """
+    开始一轮回答。提示词带有代号时先向 TTS 发送本轮的开始标记，TTS 据此把本轮的文本块归入该代号，
+    会话被清空（进入更大的代号）后，旧代号的文本块与音频会在下游被丢弃。
+    """
+    turn = new_trace_id()
+    trace('prompt', turn=turn, session=session)
+    if epoch is not None:
+        text_queue.put({'session': session, 'turn': turn, 'epoch': epoch, 'start_of_turn': True})
+    return turn
+
+def _process_and_queue_text_chunk(text_chunk, text_queue, ui_queue, is_first=False, session=None, turn=None, speculated=None,
+                                  max_chars=MAX_CHARS_PER_CHUNK):
     text_chunk = text_chunk.strip()
     if not text_chunk:
         return
 
+    if speculated:
+        # 句子的前缀已经提前送去合成，整句作为一个文本块发送，由 TTS 核对前缀后只合成剩余部分
+        chunk_id = new_trace_id()
+        trace('chunk_emit', turn=turn, chunk=chunk_id, chars=len(text_chunk), first=is_first)
+        text_queue.put({'text': text_chunk, 'first': is_first, 'session': session, 'turn': turn,
+                        'chunk': chunk_id, 'speculated': speculated})
+        if ui_queue:
+            ui_queue.put((session, text_chunk, chunk_id))
+        return
+
     def queue_chunk(chunk_to_queue):
-        text_queue.put(chunk_to_queue)
+        nonlocal is_first
+        # 'first' 标记快速响应首块，TTS 进程收到后会立即合成而不等待批次窗口
+        chunk_id = new_trace_id()
+        trace('chunk_emit', turn=turn, chunk=chunk_id, chars=len(chunk_to_queue), first=is_first)
+        text_queue.put({'text': chunk_to_queue, 'first': is_first, 'session': session, 'turn': turn, 'chunk': chunk_id})
+        is_first = False
         if ui_queue:
-            ui_queue.put(chunk_to_queue)
+            # 带上文本块 ID，WebUI 可以让文字与对应的音频同时出现
+            ui_queue.put((session, chunk_to_queue, chunk_id))
 
-    if len(text_chunk) <= MAX_CHARS_PER_CHUNK:
+    if len(text_chunk) <= max_chars:
         queue_chunk(text_chunk)
         return
 
-    print(f"\n[文本切分]: 检测到长句 (长度 {len(text_chunk)} > {MAX_CHARS_PER_CHUNK})...")
+    print(f"\n[文本切分]: 检测到长句 (长度 {len(text_chunk)} > {max_chars})...")
     
     parts = re.split(r'([，；,;])', text_chunk)
     current_chunk = ""
@@ -28,7 +169,7 @@ def _process_and_queue_text_chunk(text_chunk, text_queue, ui_queue):
         delimiter = parts[i+1] if i + 1 < len(parts) else ""
         full_part = part + delimiter
 
-        if len(current_chunk) + len(full_part) > MAX_CHARS_PER_CHUNK and current_chunk:
+        if len(current_chunk) + len(full_part) > max_chars and current_chunk:
             queue_chunk(current_chunk.strip())
             current_chunk = full_part
         else:
@@ -37,64 +178,92 @@ def _process_and_queue_text_chunk(text_chunk, text_queue, ui_queue):
     if current_chunk:
         queue_chunk(current_chunk.strip())
 
+def _feed_stream_content(segmenter, content, text_queue, ui_queue, session=None, turn=None, chunking=None):
+    """
+    把一段流式输出送入分句器，并将切出的文本块放入队列。
+    """
+    if segmenter.received_chars == 0:
+        trace('llm_first_token', turn=turn)
+    supervisor.progress()
+    visible = segmenter.filter_think(content)
+    if not visible:
+        return
+    print(visible, end="", flush=True)
+    for chunk, is_first, speculated in segmenter.push(visible):
+        if is_first:
+            print("\n[快速响应]: 检测到首个文本块，优先合成...")
+        _queue_segment(chunk, is_first, speculated, text_queue, ui_queue, session, turn, chunking)
+    speculation = segmenter.speculate(SPECULATIVE_MIN_CHARS, new_trace_id) if SPECULATIVE_ENABLED else None
+    if speculation is not None:
+        prefix, spec_id = speculation
+        trace('spec_emit', turn=turn, chunk=spec_id, chars=len(prefix))
+        text_queue.put({'text': prefix, 'session': session, 'turn': turn, 'chunk': spec_id, 'speculative': True})
+
+def _queue_segment(chunk, is_first, speculated, text_queue, ui_queue, session, turn, chunking):
+    if chunking is not None:
+        chunking.observe_chunk(len(chunk))
+    _process_and_queue_text_chunk(chunk, text_queue, ui_queue, is_first=is_first, session=session, turn=turn,
+                                  speculated=speculated, max_chars=_chunk_limits(chunking)[1])
+
+def _flush_stream(segmenter, text_queue, ui_queue, session=None, turn=None, chunking=None):
+    for chunk, is_first, speculated in segmenter.flush():
+        _queue_segment(chunk, is_first, speculated, text_queue, ui_queue, session, turn, chunking)
 
-def stream_ollama_response(input_queue, text_queue, local_model_config, system_prompt, ui_queue=None):
+def stream_ollama_response(input_queue, text_queue, local_model_config, system_prompt, ui_queue=None, feedback=None):
     model_name = local_model_config['name']
     print(f"Ollama 客户端已启动，使用模型: {model_name}")
+    store = ConversationStore(system_prompt)
+    cache = create_response_cache()
+    chunking = _create_chunking(feedback)
+    chat_options = _ollama_chat_options()
 
     while True:
-        prompt = input_queue.get()
-        if prompt is None:
+        item = input_queue.get()
+        if item is None:
             text_queue.put(None)
             if ui_queue: ui_queue.put(None)
             break
+        session, prompt = _unpack_prompt(item)
+        if prompt is None:
+            continue
+        _apply_voice(item, text_queue)
+        _report_turn(item, busy=True)
         
         print(f"\n[用户]: {prompt}")
         print("[AI]: ", end="", flush=True)
         
-        full_sentence = ""
-        is_first_chunk = True
+        segmenter = _new_segmenter(chunking)
+        turn = _start_turn(session, text_queue, _prompt_epoch(item))
 
+        messages, context = store.build_messages(session, prompt)
+        reply, usage = [], {}
         try:
-            stream = ollama.chat(model=model_name, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], stream=True)
-            for chunk in stream:
-                content = chunk['message']['content']
+            stream = _stream_with_cache(cache, 'ollama', model_name, messages,
+                                        lambda: _ollama_stream(model_name, messages, chat_options, usage), turn)
+            for content in stream:
                 if content:
-                    content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-                    if not content:
-                        continue
-                    
-                    print(content, end="", flush=True)
-                    full_sentence += content
-
-                    if is_first_chunk and len(full_sentence) >= FIRST_CHUNK_MIN_LENGTH:
-                        print("\n[快速响应]: 检测到首个文本块，优先合成...")
-                        _process_and_queue_text_chunk(full_sentence, text_queue, ui_queue)
-                        full_sentence = ""
-                        is_first_chunk = False
-                        continue
-
-                    if not is_first_chunk:
-                        sentences = re.split(r'(?<=[。！？\!\?])\s*', full_sentence)
-                        if len(sentences) > 1:
-                            for sentence in sentences[:-1]:
-                                _process_and_queue_text_chunk(sentence, text_queue, ui_queue)
-                            full_sentence = sentences[-1]
+                    reply.append(content)
+                    _feed_stream_content(segmenter, content, text_queue, ui_queue, session, turn, chunking)
         except Exception as e:
             print(f"\n调用 Ollama 时出错: {e}")
         
-        if full_sentence.strip():
-            _process_and_queue_text_chunk(full_sentence, text_queue, ui_queue)
-        
-        if ui_queue:
-            ui_queue.put(None)
+        _flush_stream(segmenter, text_queue, ui_queue, session, turn, chunking)
+        _finish_turn(session, text_queue, ui_queue, turn)
         print()
+        store.finish_turn(session, turn, prompt, ''.join(reply), context, usage)
+        _report_turn(item, busy=False)
+        # 摘要在后台线程中生成，下一个问题无需等待
+        compact_history_in_background(store, session, lambda summary_messages: ollama.chat(
+            model=model_name, messages=summary_messages, **chat_options)['message']['content'])
 
-def stream_openai_response(input_queue, text_queue, online_model_config, system_prompt, ui_queue=None):
+def stream_openai_response(input_queue, text_queue, online_model_config, system_prompt, ui_queue=None, feedback=None):
     model_name = online_model_config['name']
     api_key = online_model_config['api_key']
     base_url = online_model_config['base_url']
     print(f"OpenAI 客户端已启动，使用模型: {model_name}, API 地址: {base_url}")
+    store = ConversationStore(system_prompt)
+    cache = create_response_cache()
+    chunking = _create_chunking(feedback)
 
     try:
         client = openai.OpenAI(api_key=api_key, base_url=base_url)
@@ -105,51 +274,39 @@ def stream_openai_response(input_queue, text_queue, online_model_config, system_
         return
 
     while True:
-        prompt = input_queue.get()
-        if prompt is None:
+        item = input_queue.get()
+        if item is None:
             text_queue.put(None)
             if ui_queue: ui_queue.put(None)
             break
+        session, prompt = _unpack_prompt(item)
+        if prompt is None:
+            continue
+        _apply_voice(item, text_queue)
+        _report_turn(item, busy=True)
         
         print(f"\n[用户]: {prompt}")
         print("[AI]: ", end="", flush=True)
 
-        full_sentence = ""
-        is_first_chunk = True
+        segmenter = _new_segmenter(chunking)
+        turn = _start_turn(session, text_queue, _prompt_epoch(item))
 
+        messages, context = store.build_messages(session, prompt)
+        reply, usage = [], {}
         try:
-            stream = client.chat.completions.create(model=model_name, messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], stream=True, temperature=0.7)
-            for chunk in stream:
-                content = chunk.choices[0].delta.content
+            stream = _stream_with_cache(cache, 'openai', model_name, messages,
+                                        lambda: _openai_stream(client, model_name, messages, usage), turn)
+            for content in stream:
                 if content:
-                    # 新增代码：使用正则表达式过滤掉 <think> 标签及其内容
-                    content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-
-                    if not content: # 如果过滤后内容为空，则跳过本次循环
-                        continue
-                    
-                    print(content, end="", flush=True)
-                    full_sentence += content
-                    
-                    if is_first_chunk and len(full_sentence) >= FIRST_CHUNK_MIN_LENGTH:
-                        print("\n[快速响应]: 检测到首个文本块，优先合成...")
-                        _process_and_queue_text_chunk(full_sentence, text_queue, ui_queue)
-                        full_sentence = ""
-                        is_first_chunk = False
-                        continue
-
-                    if not is_first_chunk:
-                        sentences = re.split(r'(?<=[。！？\!\?])\s*', full_sentence)
-                        if len(sentences) > 1:
-                            for sentence in sentences[:-1]:
-                               _process_and_queue_text_chunk(sentence, text_queue, ui_queue)
-                            full_sentence = sentences[-1]
+                    reply.append(content)
+                    _feed_stream_content(segmenter, content, text_queue, ui_queue, session, turn, chunking)
         except Exception as e:
             print(f"\n调用 OpenAI API 时发生未知错误: {e}")
         
-        if full_sentence.strip():
-            _process_and_queue_text_chunk(full_sentence, text_queue, ui_queue)
-        
-        if ui_queue:
-            ui_queue.put(None)
-        print()
\ No newline at end of file
+        _flush_stream(segmenter, text_queue, ui_queue, session, turn, chunking)
+        _finish_turn(session, text_queue, ui_queue, turn)
+        print()
+        store.finish_turn(session, turn, prompt, ''.join(reply), context, usage)
+        _report_turn(item, busy=False)
+        compact_history_in_background(store, session, lambda summary_messages: client.chat.completions.create(
+            model=model_name, messages=summary_messages, temperature=0.3).choices[0].message.content)
\ No newline at end of file
@@ -0,0 +1,282 @@
+"""
+流水线各阶段之间有界、带监控的进程间通道，替代无上限的 mp.Queue。
+
+每个通道的容量和满时的策略在 config.yaml 的 pipeline.channels 中配置:
+    block   队列满时写端阻塞等待（默认），下游处理不过来时上游随之放慢
+    drop    队列满时丢弃新的数据消息；控制消息（结束标记、开始标记、音色切换等）总是阻塞等待
+无论哪种策略，句子前缀的预合成任务在队列满时都直接丢弃：完整句子随后仍会到达并正常合成。
+
+各通道的深度、最大深度、写入阻塞次数与等待时长、丢弃数保存在共享内存中，任何进程都能读取。
+
+启用进程监督时，每个通道预先创建若干个备用队列。读写某个通道的阶段被强制重启后，它可能还持有队列内部的锁，
+监督器调用 reset() 让各进程换用下一个备用队列（见 PipelineChannel.reset）。
+"""
+import asyncio
+import multiprocessing as mp
+import os
+import threading
+import time
+from queue import Empty, Full
+
+import supervisor
+from config_loader import config
+from latency_tracer import trace
+
+PIPELINE_CONFIG = config.get('pipeline') or {}
+CHANNEL_CONFIG = PIPELINE_CONFIG.get('channels') or {}
+# 通道深度达到容量的该比例时视为饱和，大模型客户端暂停读取上游的流式响应
+HIGH_WATER = PIPELINE_CONFIG.get('high_water', 0.75)
+# TTS 进程内部已接收但尚未输出的任务超过该数量时，暂停从文本通道读取（0 表示不限制）
+TTS_MAX_PENDING = PIPELINE_CONFIG.get('tts_max_pending', 0)
+REPORT_INTERVAL_SECONDS = PIPELINE_CONFIG.get('report_interval_seconds', 0)
+BACKPRESSURE_POLL_SECONDS = 0.02
+# 写入阻塞或读取等待时的轮询间隔：期间检查通道是否已换用备用队列，并向监督器报告进展
+CHANNEL_POLL_SECONDS = 0.1
+_SUPERVISOR_CONFIG = config.get('supervisor') or {}
+# 每个通道的备用队列数，只在启用进程监督时创建
+RESET_SPARES = 2 * _SUPERVISOR_CONFIG.get('max_restarts', 5) if _SUPERVISOR_CONFIG.get('enabled', False) else 0
+
+
+class ChannelGauges:
+    """
+    保存在共享内存中的通道计数器，写端、读端和监控线程可以位于不同进程。
+    """
+    FIELDS = ('depth', 'max_depth', 'puts', 'gets', 'dropped', 'blocked_puts', 'wait_seconds', 'max_wait_seconds')
+
+    def __init__(self):
+        self._values = mp.Array('d', len(self.FIELDS))
+
+    def on_put(self, wait=None):
+        v = self._values
+        with v.get_lock():
+            v[0] += 1
+            v[1] = max(v[1], v[0])
+            v[2] += 1
+            if wait is not None:
+                v[5] += 1
+                v[6] += wait
+                v[7] = max(v[7], wait)
+
+    def on_get(self):
+        v = self._values
+        with v.get_lock():
+            # 读端可能先于写端的计数取走消息，深度不低于 0
+            v[0] = max(v[0] - 1, 0)
+            v[3] += 1
+
+    def on_drop(self):
+        with self._values.get_lock():
+            self._values[4] += 1
+
+    def on_reset(self):
+        # 尚未取出的消息随旧队列一起丢弃
+        with self._values.get_lock():
+            self._values[0] = 0
+
+    def depth(self):
+        return int(self._values[0])
+
+    def snapshot(self):
+        with self._values.get_lock():
+            values = list(self._values)
+        stats = {name: (round(value, 3) if name.endswith('seconds') else int(value))
+                 for name, value in zip(self.FIELDS, values)}
+        stats['mean_wait_ms'] = round(1000 * values[6] / values[5], 2) if values[5] else 0.0
+        return stats
+
+
+def _is_droppable(item, policy):
+    if item is None:
+        return False
+    if isinstance(item, dict):
+        if item.get('speculative'):
+            return True
+        return policy == 'drop' and ('text' in item or item.get('audio') is not None)
+    if isinstance(item, tuple):
+        # 界面更新 (会话, 文本[, 文本块 ID])，文本为 None 的是结束标记
+        return policy == 'drop' and item[1] is not None
+    return policy == 'drop'
+
+
+class PipelineChannel:
+    """
+    接口与 mp.Queue 相同（put/get/get_nowait/qsize/empty），可以直接替换原来的队列。
+    qsize() 读取共享计数器，在 macOS 上同样可用。
+    spares 为备用队列数（见 reset）；为 0 时读取直接调用 mp.Queue.get，不做轮询。
+    """
+
+    def __init__(self, name, capacity=0, policy='block', spares=0):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"通道 '{name}' 的策略 '{policy}' 无效，应为 'block' 或 'drop'。")
+        self.name = name
+        self.capacity = max(0, int(capacity))
+        self.policy = policy
+        self._queues = [mp.Queue(self.capacity) for _ in range(1 + spares)]
+        # 当前使用的队列编号，由 reset() 递增
+        self._generation = mp.RawValue('i', 0)
+        # 读端正在读取的队列编号：换用备用队列后先读完旧队列中剩余的消息。
+        # 按进程记录，重启后的新进程（无论 fork 还是 spawn）从当前队列开始读取
+        self._reader_pid = os.getpid()
+        self._read_generation = 0
+        self._write_generation = 0
+        self.gauges = ChannelGauges()
+
+    @property
+    def generation(self):
+        return self._generation.value
+
+    @property
+    def _queue(self):
+        generation = self._generation.value
+        if generation != self._write_generation:
+            # 旧队列已经无人读取，进程退出时不再等待其后台线程把缓冲的消息写完
+            for q in self._queues[:generation]:
+                q.cancel_join_thread()
+            self._write_generation = generation
+        return self._queues[generation]
+
+    def reset(self, drop_pending):
+        """
+        换用下一个备用队列，由监督器在强制终止读写本通道的阶段之后调用。
+        drop_pending 为 True 表示读端被终止：旧队列中的消息不再有人读取，直接丢弃；
+        否则（写端被终止）读端先读完旧队列中已经完整写入的消息，再转到新队列。
+        没有剩余的备用队列时返回 False。
+        """
+        generation = self._generation.value + 1
+        if generation >= len(self._queues):
+            return False
+        self._generation.value = generation
+        if drop_pending:
+            self.gauges.on_reset()
+        return True
+
+    def put(self, item, block=True, timeout=None):
+        """
+        放入一条消息。被丢弃时返回 False。
+        阻塞等待期间向监督器报告进展：下游处理不过来属于正常的反压，不算作本阶段停滞。
+        """
+        try:
+            self._queue.put(item, block=False)
+        except Full:
+            if _is_droppable(item, self.policy):
+                self.gauges.on_drop()
+                return False
+            if not block:
+                raise
+            started = time.monotonic()
+            while True:
+                wait = CHANNEL_POLL_SECONDS
+                if timeout is not None:
+                    wait = min(wait, max(started + timeout - time.monotonic(), 0))
+                try:
+                    self._queue.put(item, True, wait)
+                    break
+                except Full:
+                    if timeout is not None and time.monotonic() - started >= timeout:
+                        raise
+                    supervisor.progress()
+            self.gauges.on_put(time.monotonic() - started)
+            return True
+        self.gauges.on_put()
+        return True
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        if len(self._queues) == 1:
+            item = self._queues[0].get(block, timeout)
+            self.gauges.on_get()
+            return item
+        if self._reader_pid != os.getpid():
+            self._reader_pid = os.getpid()
+            self._read_generation = self._generation.value
+        started = time.monotonic()
+        while True:
+            if self._read_generation != self._generation.value:
+                try:
+                    item = self._queues[self._read_generation].get_nowait()
+                except Empty:
+                    self._read_generation += 1
+                    continue
+            else:
+                wait = CHANNEL_POLL_SECONDS
+                if timeout is not None:
+                    wait = min(wait, max(started + timeout - time.monotonic(), 0))
+                try:
+                    item = self._queues[self._read_generation].get(block, wait)
+                except Empty:
+                    if not block or (timeout is not None and time.monotonic() - started >= timeout):
+                        raise
+                    continue
+            self.gauges.on_get()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.gauges.depth()
+
+    def empty(self):
+        generation = self._generation.value
+        start = self._read_generation if self._reader_pid == os.getpid() else generation
+        return all(q.empty() for q in self._queues[start:generation + 1])
+
+    def saturated(self):
+        return bool(self.capacity) and self.gauges.depth() >= self.capacity * HIGH_WATER
+
+    def stats(self):
+        return {'capacity': self.capacity, 'policy': self.policy, **self.gauges.snapshot()}
+
+
+def create_channel(name):
+    """
+    按 pipeline.channels.<name> 的配置创建通道；未配置的通道不限容量，与原来的 mp.Queue 相同。
+    """
+    channel_config = CHANNEL_CONFIG.get(name) or {}
+    return PipelineChannel(name, channel_config.get('capacity', 0), channel_config.get('policy', 'block'),
+                           spares=RESET_SPARES)
+
+
+def is_saturated(q):
+    saturated = getattr(q, 'saturated', None)
+    return saturated is not None and saturated()
+
+
+async def wait_for_capacity(q):
+    """
+    通道饱和时等待下游消费，返回等待的秒数。大模型客户端在读取下一段流式响应之前调用，
+    暂停读取后上游 HTTP 连接的接收窗口随之填满，服务端的生成也会放慢。
+    """
+    if not is_saturated(q):
+        return 0.0
+    started = time.monotonic()
+    while is_saturated(q):
+        await asyncio.sleep(BACKPRESSURE_POLL_SECONDS)
+    return time.monotonic() - started
+
+
+def start_gauge_reporter(channels, interval=REPORT_INTERVAL_SECONDS):
+    """
+    在当前进程中启动守护线程，每隔 interval 秒打印并追踪有变化的通道统计。interval 为 0 时不启动。
+    """
+    if not interval:
+        return None
+    channels = {name: q for name, q in channels.items() if hasattr(q, 'stats')}
+
+    def report():
+        last_puts = {}
+        while True:
+            time.sleep(interval)
+            for name, q in channels.items():
+                stats = q.stats()
+                if stats.get('puts') == last_puts.get(name):
+                    continue
+                last_puts[name] = stats.get('puts')
+                print(f"\n[Pipeline]: 通道 {name} 统计 {stats}")
+                trace('channel_gauges', channel=name, **stats)
+
+    thread = threading.Thread(target=report, daemon=True)
+    thread.start()
+    return thread
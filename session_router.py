@@ -0,0 +1,163 @@
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class SessionRouter:
+    """
+    WebUI 进程内的会话分发器。
+    后端进程共用一个 UI 文本队列和一个音频通道，消息中带有会话 ID；
+    这里用后台线程把它们分发到每个会话自己的本地队列，浏览器标签页之间互不干扰。
+    sync_text=True 时，文本块先暂存，等它的音频推送给浏览器（release_text）后才放入文本队列，
+    使文字与语音同步出现。
+    本地队列最多保存 max_queued 条消息：浏览器已经离开而会话尚未被回收时，分发线程不会因此阻塞，
+    超出的部分丢弃最早的消息。
+    """
+
+    def __init__(self, ui_queue, audio_queue=None, sync_text=False, max_queued=512):
+        self._lock = threading.Lock()
+        self._max_queued = max_queued
+        self._dropped = 0
+        self._text_queues = {}
+        self._audio_queues = {}
+        # 每个会话当前的代号，代号更小的音频消息（包括结束标记）属于已被清空的回答
+        self._epochs = {}
+        self._sync_text = sync_text and audio_queue is not None
+        self._held = {}          # session -> 等待音频的 (文本块 ID, 文本)，None 文本为本轮结束标记
+        self._released = {}      # session -> 音频已经推送的文本块 ID（音频可能先于文本到达）
+        self._passthrough = set()  # 本轮音频已结束的会话，之后的文本不再等待
+        threading.Thread(target=self._route_text, args=(ui_queue,), daemon=True).start()
+        if audio_queue is not None:
+            threading.Thread(target=self._route_audio, args=(audio_queue,), daemon=True).start()
+
+    def _get(self, queues, session):
+        with self._lock:
+            q = queues.get(session)
+            if q is None:
+                q = queues[session] = queue.Queue(self._max_queued)
+            return q
+
+    def _put(self, q, item):
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                continue
+            self._dropped += 1
+            if self._dropped == 1 or self._dropped % 100 == 0:
+                print(f"[WebUI]: 会话本地队列已满，丢弃最早的消息（累计 {self._dropped} 条）。")
+
+    def text_queue(self, session):
+        return self._get(self._text_queues, session)
+
+    def audio_queue(self, session):
+        return self._get(self._audio_queues, session)
+
+    def reset(self, session, epoch=None):
+        """
+        清空会话本地队列中上一轮遗留的内容。给出 epoch 时，之后到达的旧代号音频也会被丢弃。
+        """
+        if epoch is not None:
+            self._epochs[session] = epoch
+        with self._lock:
+            self._held.pop(session, None)
+            self._released.pop(session, None)
+            self._passthrough.discard(session)
+        for q in (self.text_queue(session), self.audio_queue(session)):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+
+    def epoch(self, session):
+        return self._epochs.get(session, 0)
+
+    def end_audio_turn(self, session, epoch):
+        """
+        主动结束会话当前的音频推送（例如用户点击了终止按钮）。epoch 为被结束的那一轮的代号：
+        没有推送在进行时结束标记会留在队列中，下一轮的推送按代号把它当作过时的标记忽略（见 is_stale_end）。
+        """
+        self._put(self.audio_queue(session), {'session': session, 'end_of_turn': True, 'epoch': epoch})
+
+    @staticmethod
+    def is_stale_end(item, start_epoch):
+        """
+        item 是否为推送开始（当时会话的代号为 start_epoch）之前的轮次留下的结束标记。
+        """
+        return bool(item.get('end_of_turn')) and item.get('epoch') is not None and item['epoch'] < start_epoch
+
+    def release_text(self, session, chunk=None):
+        """
+        音频推送到 chunk 时放出它及之前暂存的文本；chunk 为 None 表示本轮音频已结束，放出全部文本。
+        """
+        if not self._sync_text:
+            return
+        with self._lock:
+            if chunk is None:
+                self._passthrough.add(session)
+                self._released.pop(session, None)
+                items = list(self._held.pop(session, ()))
+            else:
+                self._released.setdefault(session, set()).add(chunk)
+                items = self._take_released(session)
+        for _, text in items:
+            self._put(self.text_queue(session), text)
+
+    def _take_released(self, session):
+        held = self._held.get(session)
+        released = self._released.get(session)
+        if not held or not released:
+            return []
+        last = max((i for i, (chunk, _) in enumerate(held) if chunk in released), default=-1)
+        return [held.popleft() for _ in range(last + 1)]
+
+    def discard(self, session):
+        with self._lock:
+            self._text_queues.pop(session, None)
+            self._audio_queues.pop(session, None)
+            self._epochs.pop(session, None)
+            self._held.pop(session, None)
+            self._released.pop(session, None)
+            self._passthrough.discard(session)
+
+    def _route_text(self, ui_queue):
+        while True:
+            item = ui_queue.get()
+            if item is None:
+                break
+            session, text = item[0], item[1]
+            chunk = item[2] if len(item) > 2 else None
+            if self._sync_text:
+                with self._lock:
+                    if session not in self._passthrough:
+                        self._held.setdefault(session, deque()).append((chunk, text))
+                        items = self._take_released(session)
+                    else:
+                        items = [(chunk, text)]
+                for _, held_text in items:
+                    self._put(self.text_queue(session), held_text)
+                continue
+            self._put(self.text_queue(session), text)
+
+    def _route_audio(self, audio_queue):
+        while True:
+            item = audio_queue.get()
+            if item is None:
+                break
+            if not isinstance(item, dict):
+                continue
+            epoch = item.get('epoch')
+            if epoch is not None and epoch < self._epochs.get(item.get('session'), 0):
+                continue
+            if item.get('audio') is not None:
+                # 共享内存通道返回的是槽位视图，下一次 get() 后即失效，这里必须复制
+                item = {**item, 'audio': np.array(item['audio'])}
+            self._put(self.audio_queue(item.get('session')), item)
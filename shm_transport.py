@@ -0,0 +1,281 @@
+import atexit
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import supervisor
+from audio_format import SAMPLE_DTYPE, SAMPLE_RATE, to_storage
+from config_loader import config
+from pipeline_channel import RESET_SPARES, ChannelGauges, PipelineChannel, create_channel
+
+TRANSPORT_CONFIG = config.get('audio_transport') or {}
+# 没有空闲槽位时的轮询间隔
+SLOT_POLL_SECONDS = 0.005
+# 槽位状态：空闲、写端正在写入、已发布（描述符在队列中或读端正在使用）
+FREE, WRITING, PUBLISHED = 0, 1, 2
+
+
+def _piece_metas(meta, count):
+    """
+    一段波形被切分为 count 个片段时各片段的元数据：除最后一个片段外都标记 'partial'，空波形也占一个片段。
+    """
+    continued = {**(meta or {}), 'partial': True}
+    return [continued] * (count - 1) + [meta]
+
+
+class SharedAudioChannel:
+    """
+    基于 multiprocessing.shared_memory 的音频传输通道，可直接替换 audio_data_queue。
+    共享内存被划分为若干个预分配的槽位（样本为音频通路的存储格式，见 audio_format），
+    队列中只传递 (槽位, 样本数) 这样的小描述符。
+    写端把波形复制进空闲槽位；读端拿到的是槽位上的视图，不做复制，
+    该视图在下一次 get() 或 release() 之前有效，随后槽位归还给写端。
+    超过单个槽位长度的波形会被切分为多个连续片段，除最后一个片段外都带有 'partial': True（同一句话还有后续音频），
+    播放器据此只在句子之间做交叉淡化。
+    消息也可以是 {'audio': 波形, ...} 形式的字典，其余字段随描述符一起传递。
+    槽位数就是通道的容量，stats() 报告与 PipelineChannel 相同的统计（等待空闲槽位计为写入阻塞）。
+    槽位状态保存在共享数组中，写端只在查找空闲槽位和发布描述符时短暂持有锁；
+    读写本通道的阶段被强制重启后，监督器调用 reset() 收回该阶段占用的槽位（见 PipelineChannel.reset）。
+    写入与发布也可以分开：TTS 进程池的工作进程用 stage() 把音频直接写入槽位，只把槽位编号交给调度器，
+    调度器按原始顺序 publish()，丢弃的消息用 discard() 归还槽位。
+    """
+
+    def __init__(self, num_slots=32, slot_samples=SAMPLE_RATE * 2, dtype=SAMPLE_DTYPE, spares=0):
+        self.num_slots = num_slots
+        self.slot_samples = slot_samples
+        self.dtype = np.dtype(dtype)
+        self._shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_samples * self.dtype.itemsize)
+        self._owner_pid = os.getpid()
+        self._descriptors = PipelineChannel('audio_descriptors', spares=spares)
+        self._states = mp.RawArray('b', num_slots)
+        # 每个队列编号一把锁：持锁的写端被终止后，换用备用队列的同时换用新的锁
+        self._locks = [mp.Lock() for _ in range(1 + spares)]
+        self._held_slot = None
+        self.gauges = ChannelGauges()
+        atexit.register(self._unlink)
+
+    def __getstate__(self):
+        return {
+            'name': self._shm.name,
+            'num_slots': self.num_slots,
+            'slot_samples': self.slot_samples,
+            'dtype': self.dtype.str,
+            'owner_pid': self._owner_pid,
+            'descriptors': self._descriptors,
+            'states': self._states,
+            'locks': self._locks,
+            'gauges': self.gauges,
+        }
+
+    def __setstate__(self, state):
+        self.num_slots = state['num_slots']
+        self.slot_samples = state['slot_samples']
+        self.dtype = np.dtype(state['dtype'])
+        self._owner_pid = state['owner_pid']
+        self._descriptors = state['descriptors']
+        self._states = state['states']
+        self._locks = state['locks']
+        self.gauges = state['gauges']
+        # 子进程与创建者共用同一个 resource_tracker，挂载时的登记不会导致提前释放
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._held_slot = None
+
+    def _slot_view(self, slot, n):
+        return np.ndarray((n,), dtype=self.dtype, buffer=self._shm.buf,
+                          offset=slot * self.slot_samples * self.dtype.itemsize)
+
+    def _lock(self):
+        """
+        获取当前队列编号的锁；等待期间通道被重置时改为获取新的锁。
+        """
+        while True:
+            generation = self._descriptors.generation
+            lock = self._locks[generation]
+            lock.acquire()
+            if self._descriptors.generation == generation:
+                return lock
+            lock.release()
+
+    def _try_claim(self, count):
+        """
+        一次取得 count 个空闲槽位；空闲槽位不足时不占用任何槽位，返回 None。
+        """
+        lock = self._lock()
+        try:
+            slots = [slot for slot in range(self.num_slots) if self._states[slot] == FREE][:count]
+            if len(slots) < count:
+                return None
+            for slot in slots:
+                self._states[slot] = WRITING
+            return slots
+        finally:
+            lock.release()
+
+    def _claim_slot(self):
+        """
+        取得一个空闲槽位，返回 (槽位, 等待秒数)。没有空闲槽位时等待播放器消费，天然形成背压；
+        等待期间向监督器报告进展，下游的反压不算作本阶段停滞。
+        """
+        started = None
+        while True:
+            slots = self._try_claim(1)
+            if slots:
+                return slots[0], None if started is None else time.monotonic() - started
+            if started is None:
+                started = time.monotonic()
+            supervisor.progress()
+            time.sleep(SLOT_POLL_SECONDS)
+
+    def _publish(self, slot, n, meta):
+        # 持锁发布：与读端重启时的 reset() 互斥，描述符与槽位状态总是属于同一个队列编号
+        lock = self._lock()
+        try:
+            self._states[slot] = PUBLISHED
+            self._descriptors.put((slot, n, meta))
+        finally:
+            lock.release()
+
+    def put(self, item):
+        if item is None:
+            self._descriptors.put(None)
+            self.gauges.on_put()
+            return
+        meta = None
+        audio_data = item
+        if isinstance(item, dict):
+            meta = {k: v for k, v in item.items() if k != 'audio'}
+            audio_data = item.get('audio')
+            if audio_data is None:
+                self._descriptors.put((None, 0, meta))
+                self.gauges.on_put()
+                return
+        audio_data = to_storage(audio_data, self.dtype)
+        starts = range(0, max(audio_data.size, 1), self.slot_samples)
+        for start, piece_meta in zip(starts, _piece_metas(meta, len(starts))):
+            piece = audio_data[start:start + self.slot_samples]
+            slot, wait = self._claim_slot()
+            self._slot_view(slot, piece.size)[:] = piece
+            self._publish(slot, piece.size, piece_meta)
+            self.gauges.on_put(wait)
+
+    def stage(self, item):
+        """
+        把 {'audio': 波形, ...} 消息的音频写入空闲槽位但不发布，返回用 'shm_slots' 代替 'audio' 的小消息，
+        可以经普通队列传给发布者。空闲槽位不足时不等待，原样返回消息：
+        各工作进程的输出要按顺序发布，等待槽位可能与尚未发布的其他进程的输出互相等待。
+        """
+        audio_data = to_storage(item['audio'], self.dtype)
+        starts = range(0, max(audio_data.size, 1), self.slot_samples)
+        slots = self._try_claim(len(starts))
+        if slots is None:
+            return item
+        staged = []
+        for slot, start in zip(slots, starts):
+            piece = audio_data[start:start + self.slot_samples]
+            self._slot_view(slot, piece.size)[:] = piece
+            staged.append((slot, piece.size))
+        return {**{k: v for k, v in item.items() if k != 'audio'}, 'shm_slots': staged}
+
+    def publish(self, item):
+        """
+        发布 stage() 返回的消息，读端得到的消息与直接 put() 原消息相同。
+        """
+        meta = {k: v for k, v in item.items() if k != 'shm_slots'}
+        for (slot, n), piece_meta in zip(item['shm_slots'], _piece_metas(meta, len(item['shm_slots']))):
+            self._publish(slot, n, piece_meta)
+            self.gauges.on_put()
+
+    def discard(self, item):
+        """
+        归还 stage() 返回的消息占用的槽位。
+        """
+        for slot, _ in item['shm_slots']:
+            self._states[slot] = FREE
+
+    def release(self):
+        """
+        归还上一次 get() 得到的槽位。
+        """
+        if self._held_slot is not None:
+            self._states[self._held_slot] = FREE
+            self._held_slot = None
+
+    def reset(self, drop_pending):
+        """
+        由监督器在强制终止读写本通道的阶段之后调用，含义同 PipelineChannel.reset。
+        写端被终止时收回它正在写入的槽位，读端先读完已发布的片段；
+        读端被终止时丢弃已发布的片段（包括它正在播放的片段），收回对应的槽位。
+        """
+        lock = self._locks[self._descriptors.generation]
+        # 写端被终止时可能正持有锁；读端被终止时写端仍在运行，需要与其发布互斥
+        locked = drop_pending and lock.acquire(timeout=1)
+        try:
+            if not self._descriptors.reset(drop_pending):
+                return False
+            stale = PUBLISHED if drop_pending else WRITING
+            for slot in range(self.num_slots):
+                if self._states[slot] == stale:
+                    self._states[slot] = FREE
+            if drop_pending:
+                self.gauges.on_reset()
+            return True
+        finally:
+            if locked:
+                lock.release()
+
+    def get(self, block=True, timeout=None):
+        self.release()
+        descriptor = self._descriptors.get(block, timeout)
+        self.gauges.on_get()
+        if descriptor is None:
+            return None
+        slot, n, meta = descriptor
+        if slot is None:
+            return meta
+        self._held_slot = slot
+        view = self._slot_view(slot, n)
+        return view if meta is None else {**meta, 'audio': view}
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        """
+        待取出的音频片段数量。
+        """
+        return self.gauges.depth()
+
+    def empty(self):
+        return self._descriptors.empty()
+
+    def stats(self):
+        return {'capacity': self.num_slots, 'policy': 'block', **self.gauges.snapshot()}
+
+    def _unlink(self):
+        if os.getpid() != self._owner_pid:
+            return
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            self._shm.close()
+        except BufferError:
+            # 仍有视图引用该内存，进程退出时会自动解除映射
+            pass
+
+
+def create_audio_channel():
+    """
+    根据配置创建 TTS 进程到播放器进程之间的音频通道。
+    """
+    if TRANSPORT_CONFIG.get('type', 'queue') == 'shm':
+        num_slots = TRANSPORT_CONFIG.get('num_slots', 32)
+        slot_samples = int(SAMPLE_RATE * TRANSPORT_CONFIG.get('slot_seconds', 2))
+        print(f"音频传输使用共享内存 ({num_slots} 个槽位, 每个 {slot_samples} 个 {SAMPLE_DTYPE.name} 采样点，"
+              f"共 {num_slots * slot_samples * SAMPLE_DTYPE.itemsize / 1024 / 1024:.1f} MB)。")
+        return SharedAudioChannel(num_slots=num_slots, slot_samples=slot_samples, spares=RESET_SPARES)
+    return create_channel('audio_queue')
@@ -0,0 +1,345 @@
+"""
+批量（离线）模式：把长文本或保存下来的大模型回答合成为音频文件，不经过声卡。
+
+    python start_batch.py 输入.txt [更多输入 ...] -o 输出.flac [--voice 名称] [--workers 4]
+
+- 每个非空行为一段，段内按句切分，长句沿用 _process_and_queue_text_chunk 的切分规则；
+  文本标准化在 TTS 进程中完成，与实时对话完全相同；
+- 使用 TTS 进程池并行合成，输出按原文顺序拼接，段落之间插入 paragraph_gap_ms 的静音；
+- 音频边合成边追加到 PCM 暂存文件（输出文件名 + .pcm），内存中不保存完整波形，
+  全部完成后流式编码为 WAV（.wav）、FLAC（.flac）或 Opus（.opus / .ogg，需要 soundfile）；
+- 进度记录在清单文件（输出文件名 + .manifest.json）中，中断后重新运行同一命令会跳过已完成的文本块。
+
+输入可以是纯文本文件，也可以是 .jsonl 文件（每行一个含 content 或 text 字段的对象，role 为 user/system 的行会被跳过），
+'-' 表示标准输入。
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from config_loader import config
+from conversation_store import strip_think
+from latency_tracer import new_trace_id
+from ollama_client import _process_and_queue_text_chunk
+from pipeline_channel import create_channel
+from shm_transport import create_audio_channel
+from text_segmenter import split_sentences
+from tts_pool import create_tts_processes
+from audio_format import SAMPLE_RATE, describe as describe_audio_format, to_storage
+
+BATCH_CONFIG = config.get('batch') or {}
+# 0 表示按 CPU 核心数自动选择；每个工作进程各自加载一份模型，并平分 CPU 核心作为推理线程
+WORKERS = BATCH_CONFIG.get('workers', 0)
+PARAGRAPH_GAP_MS = BATCH_CONFIG.get('paragraph_gap_ms', 400)
+SESSION = 'batch'
+MANIFEST_VERSION = 1
+# 扩展名 -> (soundfile 格式, 编码)；WAV 使用标准库写入
+OUTPUT_FORMATS = {
+    '.wav': (None, None),
+    '.flac': ('FLAC', 'PCM_16'),
+    '.opus': ('OGG', 'OPUS'),
+    '.ogg': ('OGG', 'OPUS'),
+}
+ENCODE_BLOCK_SAMPLES = SAMPLE_RATE * 10
+
+
+def read_documents(paths):
+    for path in paths:
+        if path == '-':
+            yield sys.stdin.read()
+            continue
+        with open(path, encoding='utf-8') as f:
+            if not path.endswith('.jsonl'):
+                yield f.read()
+                continue
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record.get('role') in ('user', 'system'):
+                    continue
+                yield strip_think(record.get('content') or record.get('text') or '')
+
+
+class _ChunkCollector:
+    """
+    代替文本队列接收 _process_and_queue_text_chunk 切出的文本块。
+    """
+
+    def __init__(self):
+        self.texts = []
+
+    def put(self, item):
+        self.texts.append(item['text'])
+
+
+def build_chunks(documents, gap_samples):
+    """
+    返回 [[文本, 之后插入的静音采样点数]]，每段的最后一块之后插入段落间隔。
+    """
+    chunks = []
+    collector = _ChunkCollector()
+    for document in documents:
+        for paragraph in document.splitlines():
+            collector.texts = []
+            for sentence in split_sentences(paragraph):
+                _process_and_queue_text_chunk(sentence, collector, None)
+            if collector.texts:
+                chunks.extend([text, 0] for text in collector.texts)
+                chunks[-1][1] = gap_samples
+    return chunks
+
+
+def fingerprint(chunks, voice):
+    """
+    文本块、音色和音频格式（采样率、静音裁剪等）的摘要。清单中的记录与之不一致时不能继续上次的进度。
+    """
+    digest = hashlib.sha256(json.dumps({'voice': voice, **describe_audio_format()}, sort_keys=True).encode('utf-8'))
+    for text, gap in chunks:
+        digest.update(f"{gap}\t{text}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[Batch]: 读取清单 '{path}' 失败: {e}")
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def save_manifest(path, manifest):
+    # 先写临时文件再原子替换，中断时不会留下写了一半的清单
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class _Spool:
+    """
+    按文本块提交的 16 位 PCM 暂存文件。清单只记录已提交的采样点数，恢复时截掉之后写了一半的内容。
+    """
+
+    def __init__(self, path, committed_samples):
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._file.truncate(committed_samples * 2)
+        self._file.seek(0, os.SEEK_END)
+        self.samples = committed_samples
+
+    def write(self, audio):
+        pcm = to_storage(audio, np.int16)
+        self._file.write(pcm.tobytes())
+        self.samples += pcm.size
+
+    def write_silence(self, samples):
+        if samples:
+            self._file.write(bytes(samples * 2))
+            self.samples += samples
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def synthesize(chunks, manifest, manifest_path, spool_path, voice, workers):
+    """
+    合成 manifest['done'] 之后的文本块并追加到暂存文件，每完成一块更新一次清单。全部完成时返回 True。
+    """
+    text_queue = create_channel('text_queue')
+    audio_queue = create_audio_channel()
+    command_queue = mp.Queue()
+    processes = create_tts_processes(text_queue, audio_queue, command_queue, num_processes=workers)
+    for process in processes:
+        process.start()
+
+    start = manifest['done']
+    turn = new_trace_id()
+    chunk_ids = {new_trace_id(): index for index in range(start, len(chunks))}
+
+    def feed():
+        # 文本通道有容量上限，在单独的线程中写入，主线程同时读取音频，避免双方互相等待
+        if voice:
+            text_queue.put({'session': SESSION, 'set_voice': voice})
+        for chunk_id, index in chunk_ids.items():
+            text_queue.put({'text': chunks[index][0], 'first': False, 'session': SESSION, 'turn': turn,
+                            'chunk': chunk_id})
+        text_queue.put({'session': SESSION, 'turn': turn, 'end_of_turn': True})
+        text_queue.put(None)
+
+    threading.Thread(target=feed, daemon=True).start()
+    spool = _Spool(spool_path, manifest['samples'])
+    started = time.monotonic()
+    synthesized_samples = 0
+    has_audio = False
+
+    def commit_through(index):
+        # 音频按原文顺序到达：收到后一块的音频（或结束标记）时，之前的文本块都已完成
+        nonlocal has_audio
+        while manifest['done'] < index:
+            done = manifest['done']
+            if not has_audio:
+                manifest['empty_chunks'].append(done)
+                print(f"\n[Batch]: 警告: 第 {done} 块没有合成出音频: {chunks[done][0]}")
+            spool.write_silence(chunks[done][1])
+            spool.commit()
+            manifest['done'] = done + 1
+            manifest['samples'] = spool.samples
+            save_manifest(manifest_path, manifest)
+            has_audio = False
+            elapsed = time.monotonic() - started
+            speed = synthesized_samples / SAMPLE_RATE / elapsed if elapsed else 0.0
+            print(f"\r[Batch]: {manifest['done']}/{len(chunks)} 块，音频 {spool.samples / SAMPLE_RATE:.1f} 秒，"
+                  f"合成速度 {speed:.2f}x 实时", end='', flush=True)
+
+    try:
+        while True:
+            message = audio_queue.get()
+            if message is None:
+                break
+            if message.get('end_of_turn'):
+                commit_through(len(chunks))
+                continue
+            index = chunk_ids.get(message.get('chunk'))
+            if index is None or message.get('audio') is None:
+                continue
+            commit_through(index)
+            spool.write(message['audio'])
+            synthesized_samples += len(message['audio'])
+            has_audio = True
+    except KeyboardInterrupt:
+        print(f"\n[Batch]: 已中断，完成 {manifest['done']}/{len(chunks)} 块。重新运行同一命令即可继续。")
+        for process in processes:
+            process.terminate()
+    finally:
+        spool.close()
+        if hasattr(audio_queue, 'release'):
+            audio_queue.release()
+    print()
+    for process in processes:
+        process.join()
+    return manifest['done'] >= len(chunks)
+
+
+def encode_output(spool_path, output_path):
+    """
+    把暂存文件分块流式编码为最终的音频文件。编码完成前输出写在临时文件中。
+    """
+    fmt, subtype = OUTPUT_FORMATS[os.path.splitext(output_path)[1].lower()]
+    tmp_path = output_path + '.tmp'
+    with open(spool_path, 'rb') as src:
+        if fmt is None:
+            with wave.open(tmp_path, 'wb') as out:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(SAMPLE_RATE)
+                while data := src.read(ENCODE_BLOCK_SAMPLES * 2):
+                    out.writeframes(data)
+        else:
+            try:
+                import soundfile
+            except ImportError:
+                print(f"[Batch]: 输出 {fmt}/{subtype} 需要安装 soundfile (pip install soundfile)。"
+                      f"合成结果保留在 '{spool_path}'，安装后重新运行同一命令即可完成编码。")
+                return False
+            with soundfile.SoundFile(tmp_path, 'w', SAMPLE_RATE, 1, format=fmt, subtype=subtype) as out:
+                while data := src.read(ENCODE_BLOCK_SAMPLES * 2):
+                    out.write(np.frombuffer(data, dtype=np.int16))
+    os.replace(tmp_path, output_path)
+    return True
+
+
+def _lock_output(output_path):
+    """
+    对同一个输出文件加独占锁，防止两个批量任务同时追加同一个暂存文件。进程退出时锁自动释放。
+    返回锁文件对象（需要在任务结束前保持打开）；已被其他进程锁定时返回 None。
+    """
+    lock_file = open(output_path + '.lock', 'w')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+    return lock_file
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="文本文件、.jsonl 文件或 '-'（标准输入）")
+    parser.add_argument('-o', '--output', required=True, help='输出文件，扩展名决定格式: ' + '/'.join(OUTPUT_FORMATS))
+    parser.add_argument('--voice', default='', help='音色库中的音色名称，默认使用默认音色')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='TTS 工作进程数，0 表示按 CPU 核心数自动选择')
+    parser.add_argument('--paragraph-gap-ms', type=int, default=PARAGRAPH_GAP_MS)
+    parser.add_argument('--restart', action='store_true', help='忽略已有的进度，从头开始')
+    args = parser.parse_args(argv[1:])
+
+    if os.path.splitext(args.output)[1].lower() not in OUTPUT_FORMATS:
+        print(f"不支持的输出格式 '{args.output}'，可用的扩展名: {', '.join(OUTPUT_FORMATS)}")
+        return 1
+    chunks = build_chunks(read_documents(args.inputs), int(SAMPLE_RATE * args.paragraph_gap_ms / 1000))
+    if not chunks:
+        print("输入中没有可以合成的文本。")
+        return 1
+
+    lock = _lock_output(args.output)
+    if lock is None:
+        print(f"另一个批量任务正在写入 '{args.output}'。")
+        return 1
+    manifest_path = args.output + '.manifest.json'
+    spool_path = args.output + '.pcm'
+    digest = fingerprint(chunks, args.voice)
+    manifest = None if args.restart else load_manifest(manifest_path)
+    if manifest is not None and manifest.get('fingerprint') != digest:
+        print(f"输入文本或音色与清单 '{manifest_path}' 记录的不一致。如需重新合成请加上 --restart。")
+        return 1
+    if manifest is not None and manifest.get('completed') and os.path.exists(args.output):
+        print(f"'{args.output}' 已经合成完毕。")
+        return 0
+    if manifest is None or (manifest['done'] and not os.path.exists(spool_path)):
+        manifest = {'version': MANIFEST_VERSION, 'fingerprint': digest, 'total': len(chunks), 'done': 0,
+                    'samples': 0, 'empty_chunks': [], 'completed': False}
+        save_manifest(manifest_path, manifest)
+    elif manifest['done']:
+        print(f"[Batch]: 从第 {manifest['done']}/{len(chunks)} 块继续，已有音频 {manifest['samples'] / SAMPLE_RATE:.1f} 秒。")
+
+    workers = args.workers or max(1, (os.cpu_count() or 1) // 4)
+    print(f"[Batch]: 共 {len(chunks)} 个文本块，使用 {workers} 个 TTS 工作进程。")
+    if manifest['done'] < len(chunks) and not synthesize(chunks, manifest, manifest_path, spool_path, args.voice, workers):
+        return 1
+    if not encode_output(spool_path, args.output):
+        return 1
+    manifest['completed'] = True
+    save_manifest(manifest_path, manifest)
+    os.remove(spool_path)
+    lock.close()
+    os.remove(args.output + '.lock')
+    print(f"[Batch]: 已写入 '{args.output}' ({manifest['samples'] / SAMPLE_RATE:.1f} 秒)。")
+    if manifest['empty_chunks']:
+        print(f"[Batch]: {len(manifest['empty_chunks'])} 个文本块没有合成出音频，序号记录在清单的 empty_chunks 中。")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
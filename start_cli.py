@@ -2,82 +2,104 @@ import multiprocessing as mp
 import sys
 
 from ollama_client import stream_ollama_response, stream_openai_response 
-from tts_converter import convert_text_to_audio
+from async_llm_client import USE_ASYNC_CLIENT, serve_ollama_async, serve_openai_async
+from tts_pool import create_tts_processes
 from audio_player import play_audio_data
 from config_loader import config
+from shm_transport import create_audio_channel
+from pipeline_channel import create_channel, start_gauge_reporter
+from chunk_controller import create_chunk_feedback
+from voice_bank import VOICE_BANK_ENABLED, VoiceBank
+from supervisor import Supervisor
 
 def main_input_loop(input_queue):
     """
-    在主进程中处理用户输入。
+    在主进程中处理用户输入。启用音色库时，'/voices' 列出可用音色，'/voice 名称' 切换之后回答的音色
+    （'/voice' 不带名称恢复默认音色）。
     """
     print("\n你好！请输入你的问题。输入 'exit' 或 'quit' 来结束对话。")
+    if VOICE_BANK_ENABLED:
+        print("输入 '/voices' 查看可用音色，'/voice 名称' 切换音色。")
+    voice = None
     for line in sys.stdin:
         line = line.strip()
         if line.lower() in ["exit", "quit"]:
             print("程序退出指令已发送。")
             input_queue.put(None)
             break
+        if VOICE_BANK_ENABLED and line == '/voices':
+            print("可用音色: " + (', '.join(VoiceBank().names()) or '无'))
+            continue
+        if VOICE_BANK_ENABLED and (line == '/voice' or line.startswith('/voice ')):
+            # 音色随下一个问题一起发送，在该回答开始前生效
+            voice = line[len('/voice'):].strip()
+            print(f"之后的回答将使用音色: {voice or '默认'}")
+            continue
         if line:
-            input_queue.put(line)
+            if voice is not None:
+                input_queue.put({'prompt': line, 'voice': voice})
+                voice = None
+            else:
+                input_queue.put({'prompt': line})
 
 if __name__ == "__main__":
-    # 创建队列
-    user_input_queue = mp.Queue()
-    text_to_speech_queue = mp.Queue()
-    audio_data_queue = mp.Queue()
-    player_command_queue = mp.Queue()
-    tts_command_queue = mp.Queue()
+    # 创建队列。流水线上的数据通道都有容量上限，下游处理不过来时上游随之放慢
+    user_input_queue = create_channel('input_queue')
+    text_to_speech_queue = create_channel('text_queue')
+    audio_data_queue = create_audio_channel()
+    player_command_queue = create_channel('player_command_queue')
+    tts_command_queue = create_channel('tts_command_queue')
+    # 自适应分块：TTS 报告合成耗时、播放器报告缓冲水位，大模型客户端据此调整文本块长度
+    chunk_feedback = create_chunk_feedback()
 
-    llm_process = None
     system_prompt = config['system_prompt']
-    
     ui_update_queue = None 
 
     # 根据配置文件决定启动哪个LLM进程
     if config['use_online_model']:
         print("--- 根据配置，启动联网 OpenAI 模型 ---")
-        online_config = config['online_model']
-        llm_process = mp.Process(
-            target=stream_openai_response, 
-            args=(user_input_queue, text_to_speech_queue, online_config, system_prompt, ui_update_queue)
-        )
+        llm_target = serve_openai_async if USE_ASYNC_CLIENT else stream_openai_response
+        model_config = config['online_model']
     else:
         print("--- 根据配置，启动本地 Ollama 模型 ---")
-        local_config = config['local_model']
-        llm_process = mp.Process(
-            target=stream_ollama_response, 
-            args=(user_input_queue, text_to_speech_queue, local_config, system_prompt, ui_update_queue)
-        )
+        llm_target = serve_ollama_async if USE_ASYNC_CLIENT else stream_ollama_response
+        model_config = config['local_model']
 
-    # TTS 转换进程
-    tts_conversion_process = mp.Process(
-        target=convert_text_to_audio, 
-        args=(text_to_speech_queue, audio_data_queue, tts_command_queue)
-    )
-    
+    # 各阶段由监督器创建和启动。启用 supervisor.enabled 时，崩溃、卡死或停滞的阶段会被单独重启，
+    # 其余阶段的模型保持加载，重启的阶段从中转日志中重放尚未处理完的输入
+    supervisor = Supervisor()
+    supervisor.add_stage('llm', lambda input_queue: [mp.Process(
+        target=llm_target,
+        args=(input_queue, text_to_speech_queue, model_config, system_prompt, ui_update_queue, chunk_feedback)
+    )], source=user_input_queue, on_give_up=lambda: text_to_speech_queue.put(None), writes=[text_to_speech_queue])
+    # TTS 转换进程（启用进程池时包括调度器和多个工作进程）。放弃重启时通知播放器结束
+    supervisor.add_stage('tts', lambda text_queue: create_tts_processes(
+        text_queue, audio_data_queue, tts_command_queue, feedback=chunk_feedback
+    ), source=text_to_speech_queue, needs_ready=True, on_give_up=lambda: audio_data_queue.put(None),
+       writes=[audio_data_queue], reads=[tts_command_queue])
     # 音频播放进程
-    player_process = mp.Process(
+    supervisor.add_stage('player', lambda: [mp.Process(
         target=play_audio_data, 
-        args=(audio_data_queue, player_command_queue)
-    )
+        args=(audio_data_queue, player_command_queue, chunk_feedback)
+    )], reads=[audio_data_queue, player_command_queue])
 
-    # 启动所有后台进程
-    if llm_process:
-        llm_process.start()
-    tts_conversion_process.start()
-    player_process.start()
+    # 启动所有后台进程。TTS 进程最先启动，模型加载与大模型的首次请求并行进行，
+    # 加载完成前到达的文本块在队列中缓冲
+    supervisor.start(order=['tts', 'llm', 'player'])
+    start_gauge_reporter({'input_queue': user_input_queue, 'text_queue': text_to_speech_queue,
+                          'audio_queue': audio_data_queue})
 
     # 在主进程中运行输入循环
     try:
         main_input_loop(user_input_queue)
     except KeyboardInterrupt:
         print("\n检测到中断，正在关闭程序...")
+        supervisor.shutdown()
         user_input_queue.put(None)
 
     # 等待所有后台进程结束
-    if llm_process:
-        llm_process.join()
-    tts_conversion_process.join()
-    player_process.join()
+    supervisor.join()
+    if supervisor.enabled:
+        print(f"[Supervisor]: 监督统计 {supervisor.stats()}")
 
     print("所有进程已结束，程序关闭。")
\ No newline at end of file
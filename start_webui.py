@@ -1,69 +1,127 @@
 import gradio as gr
+import itertools
 import multiprocessing as mp
+import numpy as np
 import queue
+import time
 
-from ollama_client import stream_ollama_response, stream_openai_response 
-from tts_converter import convert_text_to_audio
-from audio_player import play_audio_data
+from ollama_client import stream_ollama_response, stream_openai_response
+from async_llm_client import USE_ASYNC_CLIENT, serve_ollama_async, serve_openai_async
+from tts_pool import create_tts_processes
+from audio_player import play_audio_data, SAMPLE_RATE
+from audio_codec import SegmentEncoder, resolve_codec
 from config_loader import config
+from shm_transport import create_audio_channel
+from pipeline_channel import create_channel, start_gauge_reporter
+from chunk_controller import create_chunk_feedback
+from session_router import SessionRouter
+from latency_tracer import trace
+from voice_bank import VOICE_BANK_ENABLED, VoiceBank
+from supervisor import Supervisor
 
-user_input_queue = mp.Queue()
-text_to_speech_queue = mp.Queue()
-audio_data_queue = mp.Queue()
-ui_update_queue = mp.Queue()
-player_command_queue = mp.Queue()
-tts_command_queue = mp.Queue()
+WEBUI_CONFIG = config.get('webui') or {}
+# "browser": 音频按会话流式发送给发起请求的浏览器；"server": 在服务器本机声卡播放
+AUDIO_OUTPUT = WEBUI_CONFIG.get('audio_output', 'server')
+AUDIO_TIMEOUT_SECONDS = WEBUI_CONFIG.get('audio_timeout_seconds', 60)
+# 浏览器模式下每段音频的编码格式："mp3"（语音约 50 kbps）或 "wav"（16 位 PCM）
+AUDIO_FORMAT = resolve_codec(WEBUI_CONFIG.get('audio_format', 'mp3')) if AUDIO_OUTPUT == 'browser' else None
+# 浏览器模式下文字随对应的语音一起出现，而不是先于语音显示整段回答
+SYNC_TEXT = AUDIO_OUTPUT == 'browser' and WEBUI_CONFIG.get('sync_text_with_audio', True)
+TEXT_TIMEOUT_SECONDS = AUDIO_TIMEOUT_SECONDS if SYNC_TEXT else 20
+SESSION_QUEUE_SIZE = WEBUI_CONFIG.get('session_queue_size', 512)
+
+# 队列在 launch_backend_processes() 中创建，避免子进程重新导入本模块时重复创建
+user_input_queue = None
+player_command_queue = None
+tts_command_queue = None
+router = None
+chunk_feedback = None
+supervisor = None
+
+# 每个会话的当前代号。终止（浏览器模式下还包括发送新问题）时取一个更大的代号，
+# 随提示词和 CLEAR 命令传给后端，旧代号的文本块与音频在各环节被丢弃
+session_epochs = {}
+_epoch_counter = itertools.count(1)
 
 def launch_backend_processes():
+    global user_input_queue, player_command_queue, tts_command_queue, router, chunk_feedback, supervisor
     print("正在启动后端服务进程...")
-    
-    llm_process = None
+
+    user_input_queue = create_channel('input_queue')
+    text_to_speech_queue = create_channel('text_queue')
+    audio_data_queue = create_audio_channel()
+    ui_update_queue = create_channel('ui_queue')
+    player_command_queue = create_channel('player_command_queue')
+    tts_command_queue = create_channel('tts_command_queue')
+    chunk_feedback = create_chunk_feedback()
+
     system_prompt = config['system_prompt']
     if config['use_online_model']:
-        online_config = config['online_model']
-        llm_process = mp.Process(target=stream_openai_response, args=(user_input_queue, text_to_speech_queue, online_config, system_prompt, ui_update_queue))
+        llm_target = serve_openai_async if USE_ASYNC_CLIENT else stream_openai_response
+        model_config = config['online_model']
     else:
-        local_config = config['local_model']
-        llm_process = mp.Process(target=stream_ollama_response, args=(user_input_queue, text_to_speech_queue, local_config, system_prompt, ui_update_queue))
-    
-    tts_process = mp.Process(target=convert_text_to_audio, args=(text_to_speech_queue, audio_data_queue, tts_command_queue))
-    player_process = mp.Process(target=play_audio_data, args=(audio_data_queue, player_command_queue))
-
-    llm_process.daemon = True
-    tts_process.daemon = True
-    player_process.daemon = True
-
-    llm_process.start()
-    tts_process.start()
-    player_process.start()
-    
-    print("后端服务进程已成功启动。")
-
-def handle_user_message(user_input, history):
+        llm_target = serve_ollama_async if USE_ASYNC_CLIENT else stream_ollama_response
+        model_config = config['local_model']
+
+    # 各阶段由监督器以守护进程方式创建和启动，启用 supervisor.enabled 时单独重启出错的阶段
+    supervisor = Supervisor()
+    supervisor.add_stage('llm', lambda input_queue: [mp.Process(target=llm_target, args=(input_queue, text_to_speech_queue, model_config, system_prompt, ui_update_queue, chunk_feedback))],
+                         source=user_input_queue, daemon=True, writes=[text_to_speech_queue, ui_update_queue])
+    supervisor.add_stage('tts', lambda text_queue: create_tts_processes(text_queue, audio_data_queue, tts_command_queue,
+                                                                        feedback=chunk_feedback),
+                         source=text_to_speech_queue, needs_ready=True, daemon=True,
+                         writes=[audio_data_queue], reads=[tts_command_queue])
+
+    if AUDIO_OUTPUT == 'browser':
+        # 音频由本进程按会话转发给各自的浏览器，不再启动本地播放器
+        router = SessionRouter(ui_update_queue, audio_data_queue, sync_text=SYNC_TEXT, max_queued=SESSION_QUEUE_SIZE)
+    else:
+        router = SessionRouter(ui_update_queue, max_queued=SESSION_QUEUE_SIZE)
+        supervisor.add_stage('player', lambda: [mp.Process(target=play_audio_data, args=(audio_data_queue, player_command_queue, chunk_feedback))],
+                             daemon=True, reads=[audio_data_queue, player_command_queue])
+
+    # TTS 进程最先启动，模型加载期间大模型照常响应，文本块在队列中缓冲
+    supervisor.start(order=['tts', 'llm', 'player'])
+    start_gauge_reporter({'input_queue': user_input_queue, 'text_queue': text_to_speech_queue,
+                          'ui_queue': ui_update_queue, 'audio_queue': audio_data_queue})
+
+    print(f"后端服务进程已成功启动 (音频输出: {AUDIO_OUTPUT})。")
+
+def handle_user_message(user_input, history, voice, request: gr.Request):
     """
     处理用户从UI发送的消息，并使用新的 'messages' 格式。
+    每个浏览器会话只读取属于自己的流式输出；voice 为音色库中选择的音色，空字符串表示默认音色。
     """
     if not user_input.strip():
-        return history, "请输入内容后再发送"
+        yield history, "请输入内容后再发送"
+        return
 
-    print(f"[WebUI]: 收到用户输入: {user_input}")
-    while not ui_update_queue.empty():
-        try:
-            ui_update_queue.get_nowait()
-        except queue.Empty:
-            continue
+    session = request.session_hash
+    print(f"[WebUI]: 会话 {session} 收到用户输入: {user_input}")
+    if AUDIO_OUTPUT == 'browser':
+        # 上一轮尚未推送的音频会被丢弃，进入新代号让 TTS 也停止合成这些旧句子。
+        # 本轮开始标记可能排在文本通道中的旧句子之后，CLEAR 命令让 TTS 立即停止
+        epoch = session_epochs[session] = next(_epoch_counter)
+        tts_command_queue.put(("CLEAR", session, epoch))
+    else:
+        epoch = session_epochs.get(session, 0)
+    router.reset(session, epoch)
+    text_updates = router.text_queue(session)
 
     history.append({"role": "user", "content": user_input})
     history.append({"role": "assistant", "content": ""})
-    
+
     # 将用户输入放入队列，由LLM进程处理
-    user_input_queue.put(user_input)
+    prompt = {'session': session, 'prompt': user_input, 'epoch': epoch}
+    if VOICE_BANK_ENABLED:
+        prompt['voice'] = voice or ''
+    user_input_queue.put(prompt)
 
     bot_response_content = ""
-    # 循环从ui_update_queue获取LLM的流式输出
+    # 循环从本会话的队列获取LLM的流式输出
     while True:
         try:
-            update = ui_update_queue.get(timeout=20)
+            update = text_updates.get(timeout=TEXT_TIMEOUT_SECONDS)
             if update is None:
                 break
             bot_response_content += update
@@ -73,48 +131,130 @@ def handle_user_message(user_input, history):
         except queue.Empty:
             print("[WebUI]: 等待AI响应超时。")
             break
-    
-    print(f"[WebUI]: AI响应结束: {bot_response_content}")
+
+    print(f"[WebUI]: 会话 {session} AI响应结束: {bot_response_content}")
     yield history, "AI响应结束"
 
-def terminate_and_clear_audio():
+def stream_session_audio(request: gr.Request):
     """
-    终止当前播放并清空待播队列。
+    将本会话合成的音频编码后按段流式推送给浏览器，直到收到本轮结束标记。
+    一段包含当前已经到达的全部音频：TTS 领先时合并成较大的段以减少封装开销，否则逐块立即发送。
     """
-    print("[WebUI]: 用户点击终止，发送CLEAR命令。")
-    player_command_queue.put("CLEAR")
-    tts_command_queue.put("CLEAR")
+    session = request.session_hash
+    audio_updates = router.audio_queue(session)
+    # 与 handle_user_message 并行启动，此时会话可能还停留在上一轮的代号；更早的轮次留下的结束标记不能结束本轮
+    start_epoch = router.epoch(session)
+    encoder = SegmentEncoder(AUDIO_FORMAT)
+    last_chunk = None
+    finished = False
+    # 浏览器无法回报播放进度，按 已推送的音频时长 - 开始推送以来的时间 估算其缓冲水位
+    pushed_seconds = 0.0
+    first_push = None
+    while not finished:
+        try:
+            items = [audio_updates.get(timeout=AUDIO_TIMEOUT_SECONDS)]
+        except queue.Empty:
+            print("[WebUI]: 等待音频超时。")
+            break
+        while not items[-1].get('end_of_turn'):
+            try:
+                items.append(audio_updates.get_nowait())
+            except queue.Empty:
+                break
+        if router.is_stale_end(items[-1], start_epoch):
+            items.pop()
+            if not items:
+                continue
+        finished = bool(items[-1].get('end_of_turn'))
+        # 流式合成的句子以一条可能不含样本的结束消息收尾
+        pieces = [item for item in items if item.get('audio') is not None and len(item['audio'])]
+        if not pieces:
+            continue
+        audio = np.concatenate([item['audio'] for item in pieces])
+        data, encode_seconds = encoder.encode(audio)
+        for item in pieces:
+            if item.get('chunk') is not None and item['chunk'] != last_chunk:
+                # 浏览器端无法回报实际播放时间，以推送给浏览器的时刻近似
+                last_chunk = item['chunk']
+                trace('playback_start', chunk=last_chunk, turn=item.get('turn'))
+                router.release_text(session, last_chunk)
+        trace('audio_encode', chunk=last_chunk, turn=pieces[-1].get('turn'), codec=encoder.codec, bytes=len(data),
+              audio_seconds=round(audio.size / SAMPLE_RATE, 3), encode_ms=round(1000 * encode_seconds, 3))
+        if chunk_feedback is not None:
+            now = time.monotonic()
+            if first_push is None or now - first_push > pushed_seconds:
+                # 浏览器端已经播完，之后的推送重新计时
+                first_push, pushed_seconds = now, 0.0
+            pushed_seconds += audio.size / SAMPLE_RATE
+            chunk_feedback.record_buffer(pushed_seconds - (now - first_push))
+        yield data
+
+    router.release_text(session)
+    if encoder.segments:
+        stats = encoder.stats()
+        print(f"[WebUI]: 会话 {session} 本轮音频发送统计 {stats}")
+        trace('audio_delivery', session=session, **stats)
+
+def terminate_and_clear_audio(request: gr.Request):
+    """
+    终止当前会话的播放并清空其待播队列。
+    """
+    session = request.session_hash
+    print(f"[WebUI]: 会话 {session} 点击终止，取消生成并发送CLEAR命令。")
+    # 异步客户端会中断上游 HTTP 流；同步客户端忽略该请求
+    user_input_queue.put({'session': session, 'cancel': True})
+    stopped_epoch = session_epochs.get(session, 0)
+    epoch = session_epochs[session] = next(_epoch_counter)
+    tts_command_queue.put(("CLEAR", session, epoch))
+    if AUDIO_OUTPUT == 'browser':
+        router.reset(session, epoch)
+        router.end_audio_turn(session, stopped_epoch)
+    else:
+        player_command_queue.put(("CLEAR", session, epoch))
     return "已发送清空命令"
 
-# --- 构建 Gradio Web UI ---
-with gr.Blocks(theme=gr.themes.Soft()) as demo:
-    gr.Markdown("# 语音对话 Web UI")
-    gr.Markdown("在下方的输入框中输入你的问题，点击发送或按回车。AI的回答将以文本形式显示，并自动转换为语音播放。")
-
-    chatbot = gr.Chatbot(
-        label="对话历史", 
-        height=500, 
-        avatar_images=("./asset/icons/avatar_user.png", "./asset/icons/avatar_bot.jpg"),
-        type='messages' 
-    )
-    status_textbox = gr.Textbox(label="状态", interactive=False)
-
-    with gr.Row():
-        msg_textbox = gr.Textbox(placeholder="输入你的问题...", label="用户输入", container=False, scale=7)
-        send_button = gr.Button("发送", variant="primary", scale=1)
-        terminate_button = gr.Button("清空音频队列", variant="stop", scale=2)
-
-    # 绑定事件
-    msg_textbox.submit(handle_user_message, [msg_textbox, chatbot], [chatbot, status_textbox])
-    send_button.click(handle_user_message, [msg_textbox, chatbot], [chatbot, status_textbox])
-    terminate_button.click(terminate_and_clear_audio, outputs=[status_textbox])
-    
-    # 清空输入框
-    send_button.click(lambda: "", None, msg_textbox)
-    msg_textbox.submit(lambda: "", None, msg_textbox)
+def release_session(request: gr.Request):
+    router.discard(request.session_hash)
+    session_epochs.pop(request.session_hash, None)
+
+def build_demo():
+    # --- 构建 Gradio Web UI ---
+    with gr.Blocks(theme=gr.themes.Soft()) as demo:
+        gr.Markdown("# 语音对话 Web UI")
+        gr.Markdown("在下方的输入框中输入你的问题，点击发送或按回车。AI的回答将以文本形式显示，并自动转换为语音播放。")
+
+        chatbot = gr.Chatbot(
+            label="对话历史",
+            height=500,
+            avatar_images=("./asset/icons/avatar_user.png", "./asset/icons/avatar_bot.jpg"),
+            type='messages'
+        )
+        status_textbox = gr.Textbox(label="状态", interactive=False)
+        audio_player = gr.Audio(label="语音", streaming=True, autoplay=True, visible=AUDIO_OUTPUT == 'browser',
+                                format=AUDIO_FORMAT or 'wav')
+        # 音色库中的音色可按会话切换，无需重启 TTS 进程
+        voice_names = VoiceBank().names() if VOICE_BANK_ENABLED else []
+        voice_dropdown = gr.Dropdown(choices=[("默认音色", "")] + [(name, name) for name in voice_names], value="",
+                                     label="音色", visible=bool(voice_names))
+
+        with gr.Row():
+            msg_textbox = gr.Textbox(placeholder="输入你的问题...", label="用户输入", container=False, scale=7)
+            send_button = gr.Button("发送", variant="primary", scale=1)
+            terminate_button = gr.Button("清空音频队列", variant="stop", scale=2)
+
+        # 绑定事件；不限制并发，使多个浏览器会话可以同时对话
+        for trigger in (msg_textbox.submit, send_button.click):
+            trigger(handle_user_message, [msg_textbox, chatbot, voice_dropdown], [chatbot, status_textbox], concurrency_limit=None)
+            if AUDIO_OUTPUT == 'browser':
+                trigger(stream_session_audio, None, audio_player, concurrency_limit=None)
+            # 清空输入框
+            trigger(lambda: "", None, msg_textbox)
+        terminate_button.click(terminate_and_clear_audio, outputs=[status_textbox], concurrency_limit=None)
+        demo.unload(release_session)
+    return demo
 
 if __name__ == "__main__":
     launch_backend_processes()
     print("正在启动 Gradio Web UI...")
-    demo.launch()
-    print("Web UI已关闭，程序结束。")
\ No newline at end of file
+    build_demo().launch()
+    print("Web UI已关闭，程序结束。")
@@ -0,0 +1,422 @@
+"""
+流水线各阶段（大模型客户端、TTS、播放器）的进程监督。
+
+每个阶段的进程在共享内存的心跳板上占一个槽位，由进程内的守护线程定时写入心跳；
+阶段代码在处理工作时报告进展、在途工作数和低水位（最早一个尚未完成的输入序号）。主进程的监督线程据此判断:
+    crash   进程以非零退出码结束（包括模型加载失败）
+    hung    心跳超过 heartbeat_timeout_seconds 没有更新（进程卡死在持有 GIL 的调用中或被暂停）
+    stall   有在途工作，但超过 stall_seconds 没有任何进展（例如推理或上游请求卡住）
+出现以上情况时只重启该阶段（进程池模式下 TTS 的调度器与工作进程作为一组重启），其余阶段的模型保持加载。
+
+带有输入通道的阶段由监督进程中转输入：中转线程给每条消息编号并记入日志，再放入该阶段专用的队列。
+阶段报告的低水位之前的消息已经处理完毕，从日志中删除；重启时换用新的专用队列
+（被强制终止的进程可能持有旧队列的锁），并先按顺序重放日志中尚未完成的消息。
+阶段读写的其他通道（输出通道、命令队列、共享内存音频通道）在添加阶段时声明，重启前由监督器重置，
+换用备用的队列并收回被终止的进程占用的槽位（见 PipelineChannel.reset）。
+在途工作数不为 0 但正在等待下游通道空出位置时，通道会持续报告进展，反压不算作停滞。
+重放保证至少处理一次：崩溃前已经输出、但排在未完成消息之后的文本块可能会再合成一次。
+音色切换消息另外按会话保留最新的一条，重启后最先重放，使新进程恢复各会话的音色。
+
+阶段进程中调用 progress / report / ready 等函数即可报告状态；不在监督下运行时这些函数什么也不做。
+"""
+import multiprocessing as mp
+import threading
+import time
+from collections import deque
+from queue import Empty, Full
+
+from config_loader import config
+import pipeline_channel
+from latency_tracer import trace
+
+SUPERVISOR_CONFIG = config.get('supervisor') or {}
+SUPERVISOR_ENABLED = SUPERVISOR_CONFIG.get('enabled', False)
+HEARTBEAT_INTERVAL_SECONDS = SUPERVISOR_CONFIG.get('heartbeat_interval_seconds', 1.0)
+HEARTBEAT_TIMEOUT_SECONDS = SUPERVISOR_CONFIG.get('heartbeat_timeout_seconds', 30)
+STALL_SECONDS = SUPERVISOR_CONFIG.get('stall_seconds') or {}
+DEFAULT_STALL_SECONDS = 60
+RESTART_BACKOFF_SECONDS = SUPERVISOR_CONFIG.get('restart_backoff_seconds', 1.0)
+MAX_BACKOFF_SECONDS = 30
+MAX_RESTARTS = SUPERVISOR_CONFIG.get('max_restarts', 5)
+RESTART_WINDOW_SECONDS = SUPERVISOR_CONFIG.get('restart_window_seconds', 300)
+REPLAY_ENABLED = SUPERVISOR_CONFIG.get('replay', True)
+# 日志条数上限：阶段长时间不报告低水位时，丢弃最早的消息而不是无限增长
+MAX_JOURNAL = 4096
+CHECK_INTERVAL_SECONDS = 0.5
+MAX_SLOTS = 64
+_NO_ITEM = object()
+
+# 心跳板每个槽位的字段
+FIELDS = ('beat', 'progress', 'busy', 'low_water', 'ready')
+BEAT, PROGRESS, BUSY, LOW_WATER, READY = range(len(FIELDS))
+
+# 当前进程的心跳板与槽位，由 _run_supervised 在子进程中设置
+_board = None
+_slot = None
+
+
+def _set(field, value):
+    _board[_slot * len(FIELDS) + field] = value
+
+
+def _get(board, slot, field):
+    return board[slot * len(FIELDS) + field]
+
+
+def supervised():
+    return _board is not None
+
+
+def progress():
+    """
+    报告工作有进展（输出了一段文本或音频、完成了一个批次）。
+    """
+    if _board is not None:
+        _set(PROGRESS, time.time())
+
+
+def report(busy, low_water=None):
+    """
+    报告在途工作数与低水位。在途工作数从 0 变为正数时重新开始计算停滞时间。
+    """
+    if _board is None:
+        return
+    if busy and not _get(_board, _slot, BUSY):
+        _set(PROGRESS, time.time())
+    _set(BUSY, busy)
+    if low_water is not None:
+        _set(LOW_WATER, low_water)
+
+
+def ready():
+    """
+    阶段初始化完成（例如模型已加载）。声明了 needs_ready 的阶段调用后才计入恢复时间的终点。
+    """
+    if _board is not None:
+        _set(READY, 1)
+
+
+def relay_seq(item):
+    """
+    中转线程给消息加上的序号；不在监督下运行或不是字典消息时返回 None。
+    """
+    return item.get('relay_seq') if isinstance(item, dict) else None
+
+
+def _beat_forever():
+    while True:
+        _set(BEAT, time.time())
+        time.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+
+def _run_supervised(board, slot, target, args, kwargs):
+    global _board, _slot
+    _board, _slot = board, slot
+    threading.Thread(target=_beat_forever, daemon=True).start()
+    target(*args, **kwargs)
+
+
+class _Relay:
+    """
+    在主进程中把共享输入通道的消息转发到阶段专用的队列，并保留尚未处理完的消息以便重放。
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.journal = deque()   # [(序号, 消息)]
+        self.voices = {}         # 会话 -> 最新的音色切换消息
+        self.next_seq = 0
+        self.target = None
+        self.replayed = 0
+        self.journal_overflow = 0
+        self._replay = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def new_target(self, capacity, policy):
+        """
+        换用新的专用队列，并安排重放日志中的消息。返回新队列。
+        """
+        with self._lock:
+            self.target = pipeline_channel.PipelineChannel(f"{self.name}_stage", capacity, policy)
+            self._replay = deque(self.voices.values())
+            if REPLAY_ENABLED:
+                self._replay.extend(item for _, item in self.journal)
+            self.replayed += len(self._replay)
+            return self.target
+
+    def trim(self, low_water):
+        with self._lock:
+            while self.journal and self.journal[0][0] < low_water:
+                self.journal.popleft()
+
+    def run(self):
+        while True:
+            with self._lock:
+                target = self.target
+                item = self._replay.popleft() if self._replay else _NO_ITEM
+            if item is _NO_ITEM:
+                if self._closed:
+                    # 结束标记已经转发；阶段仍可能在退出前崩溃，此时需要重放
+                    time.sleep(CHECK_INTERVAL_SECONDS)
+                    continue
+                try:
+                    item = self.source.get(timeout=CHECK_INTERVAL_SECONDS)
+                except Empty:
+                    continue
+                with self._lock:
+                    target = self.target
+                    if isinstance(item, dict):
+                        item = {**item, 'relay_seq': self.next_seq}
+                        if 'set_voice' in item:
+                            self.voices[item.get('session')] = item
+                    self.journal.append((self.next_seq, item))
+                    self.next_seq += 1
+                    if len(self.journal) > MAX_JOURNAL:
+                        self.journal.popleft()
+                        self.journal_overflow += 1
+                    if item is None:
+                        self._closed = True
+            self._forward(target, item)
+
+    def _forward(self, target, item):
+        while True:
+            try:
+                target.put(item, timeout=CHECK_INTERVAL_SECONDS)
+                return
+            except Full:
+                # 阶段已重启：这条消息在日志中，会随重放进入新的队列
+                if self.target is not target:
+                    return
+
+
+class _Stage:
+    def __init__(self, name, factory, source, needs_ready, on_give_up, daemon, writes, reads):
+        self.name = name
+        self.factory = factory
+        self.writes = list(writes)
+        self.reads = list(reads)
+        self.needs_ready = needs_ready
+        self.on_give_up = on_give_up
+        self.daemon = daemon
+        self.stall_seconds = STALL_SECONDS.get(name, DEFAULT_STALL_SECONDS)
+        self.relay = _Relay(name, source) if source is not None else None
+        self.source = source
+        self.processes = []
+        self.labels = []
+        self.slots = []
+        self.restart_times = deque()
+        self.restart_at = None
+        self.down_since = None
+        self.stopped = False
+        self.gave_up = False
+        self.stats = {'restarts': 0, 'crash': 0, 'hung': 0, 'stall': 0, 'stall_seconds': 0.0,
+                      'downtime_seconds': 0.0}
+
+
+class Supervisor:
+    """
+    按阶段创建、启动并监督进程。factory 返回尚未启动的 mp.Process 列表；
+    给出 source（阶段的输入通道）时，factory 接收阶段专用的输入队列作为参数。
+    enabled 为 False 时只负责启动与等待，不中转输入也不重启。
+    """
+
+    def __init__(self, enabled=SUPERVISOR_ENABLED):
+        self.enabled = enabled
+        self.stages = []
+        self._board = mp.RawArray('d', MAX_SLOTS * len(FIELDS)) if enabled else None
+        self._free_slots = deque(range(MAX_SLOTS))
+        self._lock = threading.Lock()
+        self._shutting_down = False
+
+    def add_stage(self, name, factory, source=None, needs_ready=False, on_give_up=None, daemon=False,
+                  writes=(), reads=()):
+        """
+        needs_ready 表示阶段会在初始化完成后调用 ready()；on_give_up 在重启次数超出上限、放弃该阶段时调用。
+        writes / reads 为阶段写入和读取的通道（source 之外），重启时重置。
+        """
+        self.stages.append(_Stage(name, factory, source, needs_ready, on_give_up, daemon, writes, reads))
+
+    def _spawn(self, stage):
+        if stage.relay is not None and self.enabled:
+            capacity = getattr(stage.source, 'capacity', 0)
+            policy = getattr(stage.source, 'policy', 'block')
+            processes = stage.factory(stage.relay.new_target(capacity, policy))
+        elif stage.source is not None:
+            processes = stage.factory(stage.source)
+        else:
+            processes = stage.factory()
+        stage.labels = [f"{stage.name}[{i}]:{p._target.__name__}" for i, p in enumerate(processes)]
+        if self.enabled:
+            self._free_slots.extend(stage.slots)
+            stage.slots = [self._free_slots.popleft() for _ in processes]
+            now = time.time()
+            for slot in stage.slots:
+                # 新进程写入第一次心跳之前，以启动时刻为准
+                for field, value in ((BEAT, now), (PROGRESS, now), (BUSY, 0), (LOW_WATER, -1),
+                                     (READY, 0 if stage.needs_ready else 1)):
+                    self._board[slot * len(FIELDS) + field] = value
+            processes = [
+                mp.Process(target=_run_supervised, name=p.name, args=(self._board, slot, p._target, p._args, p._kwargs))
+                for p, slot in zip(processes, stage.slots)
+            ]
+        for process in processes:
+            process.daemon = stage.daemon
+        stage.processes = processes
+        for process in processes:
+            process.start()
+
+    def start(self, order=None):
+        """
+        按 order 给出的阶段名称顺序启动（默认按添加顺序），启用时同时启动中转线程与监督线程。
+        """
+        stages = sorted(self.stages, key=lambda s: order.index(s.name)) if order else self.stages
+        for stage in stages:
+            self._spawn(stage)
+            if stage.relay is not None and self.enabled:
+                threading.Thread(target=stage.relay.run, daemon=True).start()
+        if self.enabled:
+            threading.Thread(target=self._monitor, daemon=True).start()
+            print(f"[Supervisor]: 已启动 {len(self.stages)} 个阶段的监督 (心跳间隔 {HEARTBEAT_INTERVAL_SECONDS} 秒)。")
+
+    def processes(self):
+        """
+        返回 {标签: 进程}，标签形如 'tts[0]:convert_text_to_audio'。
+        """
+        return {label: process for stage in self.stages for label, process in zip(stage.labels, stage.processes)}
+
+    def join(self, timeout=None):
+        """
+        等待所有阶段正常结束（放弃重启的阶段视为结束），超时返回 False。
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if not self.enabled:
+            for stage in self.stages:
+                for process in stage.processes:
+                    process.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            return not any(p.is_alive() for s in self.stages for p in s.processes)
+        while not all(stage.stopped or stage.gave_up for stage in self.stages):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(CHECK_INTERVAL_SECONDS)
+        return True
+
+    def shutdown(self):
+        """
+        程序正在退出（例如终端的 Ctrl+C 同时中断了各子进程）：不再重启，只等待各阶段结束。
+        """
+        self._shutting_down = True
+
+    def terminate(self):
+        for stage in self.stages:
+            stage.stopped = True
+            for process in stage.processes:
+                if process.is_alive():
+                    process.terminate()
+
+    def _monitor(self):
+        while True:
+            time.sleep(CHECK_INTERVAL_SECONDS)
+            with self._lock:
+                for stage in self.stages:
+                    if not stage.stopped and not stage.gave_up:
+                        self._check(stage)
+
+    def _check(self, stage):
+        now = time.time()
+        if self._shutting_down:
+            stage.stopped = stage.restart_at is not None or all(p.exitcode is not None for p in stage.processes)
+            return
+        if stage.restart_at is not None:
+            if time.monotonic() >= stage.restart_at:
+                stage.restart_at = None
+                self._spawn(stage)
+            return
+        board = self._board
+        if stage.down_since is not None and all(_get(board, s, READY) for s in stage.slots):
+            downtime = now - stage.down_since
+            stage.down_since = None
+            stage.stats['downtime_seconds'] += downtime
+            print(f"[Supervisor]: 阶段 {stage.name} 已恢复，停机 {downtime:.1f} 秒，重放 "
+                  f"{stage.relay.replayed if stage.relay else 0} 条消息。")
+            trace('stage_recovered', stage=stage.name, downtime_seconds=round(downtime, 3))
+
+        exitcodes = [p.exitcode for p in stage.processes]
+        if any(code is not None and code != 0 for code in exitcodes):
+            code = next(code for code in exitcodes if code)
+            return self._restart(stage, 'crash', f"退出码 {code}", 0.0)
+        if all(code == 0 for code in exitcodes):
+            stage.stopped = True
+            return
+        for slot, code in zip(stage.slots, exitcodes):
+            if code is not None:
+                continue
+            beat = _get(board, slot, BEAT)
+            if now - beat > HEARTBEAT_TIMEOUT_SECONDS:
+                return self._restart(stage, 'hung', f"心跳已 {now - beat:.1f} 秒未更新", now - beat)
+            idle = now - _get(board, slot, PROGRESS)
+            if _get(board, slot, BUSY) > 0 and idle > stage.stall_seconds:
+                return self._restart(stage, 'stall', f"有在途工作但 {idle:.1f} 秒没有进展", idle)
+        if stage.relay is not None:
+            marks = [_get(board, s, LOW_WATER) for s, code in zip(stage.slots, exitcodes) if code is None]
+            marks = [mark for mark in marks if mark >= 0]
+            if marks:
+                stage.relay.trim(min(marks))
+
+    def _restart(self, stage, reason, detail, lost_seconds):
+        now = time.monotonic()
+        while stage.restart_times and now - stage.restart_times[0] > RESTART_WINDOW_SECONDS:
+            stage.restart_times.popleft()
+        for process in stage.processes:
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=2)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+        if stage.relay is not None:
+            # 按进程终止前最后报告的低水位删除已完成的消息，避免重放已经输出的内容
+            marks = [mark for mark in (_get(self._board, s, LOW_WATER) for s in stage.slots) if mark >= 0]
+            if marks:
+                stage.relay.trim(min(marks))
+        stage.stats[reason] += 1
+        stage.stats['stall_seconds'] += lost_seconds
+        trace('stage_restart', stage=stage.name, reason=reason, lost_seconds=round(lost_seconds, 3),
+              restarts=len(stage.restart_times))
+        exhausted = [channel for channel, drop_pending in
+                     [(c, False) for c in stage.writes] + [(c, True) for c in stage.reads]
+                     if not channel.reset(drop_pending)]
+        if exhausted or len(stage.restart_times) >= MAX_RESTARTS:
+            stage.gave_up = True
+            if exhausted:
+                print(f"!!! [Supervisor]: 阶段 {stage.name} {detail}，通道 "
+                      f"{', '.join(getattr(c, 'name', type(c).__name__) for c in exhausted)} 已没有备用队列，不再重启。")
+            else:
+                print(f"!!! [Supervisor]: 阶段 {stage.name} {detail}，{RESTART_WINDOW_SECONDS} 秒内已重启 "
+                      f"{len(stage.restart_times)} 次，不再重启。")
+            if stage.on_give_up is not None:
+                stage.on_give_up()
+            return
+        backoff = min(RESTART_BACKOFF_SECONDS * 2 ** len(stage.restart_times), MAX_BACKOFF_SECONDS)
+        stage.restart_times.append(now)
+        stage.stats['restarts'] += 1
+        if stage.down_since is None:
+            stage.down_since = time.time()
+        stage.restart_at = now + backoff
+        print(f"!!! [Supervisor]: 阶段 {stage.name} {detail}（{reason}），{backoff:.1f} 秒后重启。统计 {self.stats()}")
+
+    def stats(self):
+        stats = {}
+        for stage in self.stages:
+            stage_stats = {key: round(value, 3) if isinstance(value, float) else value
+                           for key, value in stage.stats.items()}
+            if stage.relay is not None:
+                stage_stats['replayed'] = stage.relay.replayed
+                stage_stats['journal'] = len(stage.relay.journal)
+                if stage.relay.journal_overflow:
+                    stage_stats['journal_overflow'] = stage.relay.journal_overflow
+            if stage.gave_up:
+                stage_stats['gave_up'] = True
+            stats[stage.name] = stage_stats
+        return stats
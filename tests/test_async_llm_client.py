@@ -0,0 +1,167 @@
+"""
+异步大模型客户端在脚本化服务（benchmarks/stub_llm.py）上的测试：多个会话并行、流式输出中途取消、上游出错与超时。
+并发与取消通过服务端的计数器（同时进行的流式响应数、完整输出数、断开数）判断，不断言耗时。
+"""
+import asyncio
+import queue
+import threading
+import time
+
+import pytest
+
+import async_llm_client
+from async_llm_client import AsyncLLMClient, _serve
+from stub_llm import StubLLMServer
+
+PROVIDERS = ['openai', 'ollama']
+
+
+@pytest.fixture(autouse=True)
+def no_response_cache(monkeypatch):
+    # 相同的提示词不应被回答缓存合并为一次上游请求
+    monkeypatch.setattr(async_llm_client, 'create_response_cache', lambda: None)
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        server = StubLLMServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        if server.hold is not None:
+            server.hold.set()
+        server.stop()
+
+
+def model_config(provider, address):
+    if provider == 'openai':
+        return {'name': 'stub', 'api_key': 'test', 'base_url': f"{address}/v1"}
+    return {'name': 'stub', 'host': address}
+
+
+def serve(provider, address, schedule):
+    """
+    运行 _serve，schedule 为 [(延迟秒数或等待条件, 输入消息)]，由后台线程依次放入输入队列，最后放入结束标记。
+    等待条件是一个函数，参数为界面队列，返回 True 后才放入对应的消息。
+    返回 ({会话: 界面收到的文本}, 收到结束标记的会话列表)。
+    """
+    input_queue, text_queue, ui_queue = queue.Queue(), queue.Queue(), queue.Queue()
+
+    def feed():
+        for wait, item in schedule:
+            if callable(wait):
+                wait_until(lambda: wait(ui_queue))
+            else:
+                time.sleep(wait)
+            input_queue.put(item)
+        input_queue.put(None)
+
+    threading.Thread(target=feed, daemon=True).start()
+    client = AsyncLLMClient(provider, model_config(provider, address))
+    asyncio.run(_serve(client, input_queue, text_queue, "你是一个测试助手。", ui_queue))
+
+    texts, finished = {}, []
+    while not ui_queue.empty():
+        session, text = ui_queue.get()[:2]
+        if text is None:
+            finished.append(session)
+        else:
+            texts[session] = texts.get(session, '') + text
+    return texts, finished
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def release_when(server, condition):
+    """
+    条件成立（或等待超时）后放行服务端被 hold 住的流式响应。
+    """
+    def watch():
+        wait_until(condition)
+        server.hold.set()
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+@pytest.mark.parametrize('provider', PROVIDERS)
+def test_concurrent_sessions(stub, provider):
+    # 所有回答都被 hold 住，直到三个流式请求同时在进行；依次处理的客户端只能等到超时后才被放行
+    server = stub(tokens_per_second=200, token_chars=2, reply_chars=40, first_token_delay=0, hold=threading.Event())
+    sessions = ['a', 'b', 'c']
+    release_when(server, lambda: server.active_streams == len(sessions))
+    texts, finished = serve(provider, server.address,
+                            [(0, {'session': s, 'prompt': f"会话 {s} 的问题"}) for s in sessions])
+
+    assert server.requests == len(sessions)
+    assert server.max_active_streams == len(sessions)
+    assert sorted(finished) == sessions
+    for session in sessions:
+        assert texts[session].replace(' ', '') == server.reply
+
+
+@pytest.mark.parametrize('provider', PROVIDERS)
+def test_cancel_mid_stream(stub, provider):
+    # 完整的回答需要 5 秒以上，取消后应立即结束并断开上游连接
+    server = stub(tokens_per_second=20, token_chars=2, reply_chars=200, first_token_delay=0.1)
+    texts, finished = serve(provider, server.address, [
+        (0, {'session': 'a', 'prompt': "一个很长的问题"}),
+        # 界面收到第一段文本后再取消
+        (lambda ui_queue: not ui_queue.empty(), {'session': 'a', 'cancel': True}),
+    ])
+
+    assert finished == ['a']
+    assert 0 < len(texts.get('a', '')) < len(server.reply)
+    assert wait_until(lambda: server.disconnects == 1)
+    assert server.completed == 0
+
+
+@pytest.mark.parametrize('provider', PROVIDERS)
+def test_new_prompt_interrupts_previous_answer(stub, provider):
+    server = stub(tokens_per_second=20, token_chars=2, reply_chars=200, first_token_delay=0.1)
+    # 两个会话并行，其中 b 的第二个问题中断它的第一个回答
+    _, finished = serve(provider, server.address, [
+        (0, {'session': 'a', 'prompt': "第一个问题"}),
+        (0, {'session': 'b', 'prompt': "第一个问题"}),
+        (0.5, {'session': 'b', 'prompt': "第二个问题"}),
+        (0.5, {'session': 'a', 'cancel': True}),
+    ])
+
+    assert sorted(finished) == ['a', 'b', 'b']
+    assert server.requests == 3
+    # 只有 b 的第二个回答完整输出，另外两个在中途断开
+    assert wait_until(lambda: server.disconnects == 2)
+    assert server.completed == 1
+
+
+@pytest.mark.parametrize('provider', PROVIDERS)
+def test_upstream_unreachable(provider):
+    # 没有服务在监听的端口：错误被记录，本轮仍然发出结束标记，之后的会话照常处理
+    texts, finished = serve(provider, 'http://127.0.0.1:9', [
+        (0, {'session': 'a', 'prompt': "问题"}),
+        (0, {'session': 'b', 'prompt': "问题"}),
+    ])
+
+    assert sorted(finished) == ['a', 'b']
+    assert texts == {}
+
+
+@pytest.mark.parametrize('provider', PROVIDERS)
+def test_upstream_timeout(stub, monkeypatch, provider):
+    monkeypatch.setitem(async_llm_client.LLM_CONFIG, 'timeout_seconds', 0.3)
+    # 回答一直被 hold 住，直到测试结束：_serve 能够返回说明请求已因超时而放弃
+    server = stub(first_token_delay=0, hold=threading.Event())
+    texts, finished = serve(provider, server.address, [(0, {'session': 'a', 'prompt': "问题"})])
+
+    assert finished == ['a']
+    assert texts == {}
+    assert server.completed == 0
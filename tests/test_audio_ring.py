@@ -0,0 +1,77 @@
+"""
+环形缓冲区：跨越缓冲区末尾的读写、写满时的部分写入、清空请求，以及欠载只在句子中途断流时计数。
+"""
+import numpy as np
+
+from audio_ring import AudioRingBuffer
+
+
+def read(ring, frames):
+    out = np.full(frames, -1.0, dtype=np.float32)
+    n = ring.read_into(out)
+    return n, out
+
+
+def test_write_and_read_wrap_around():
+    ring = AudioRingBuffer(8)
+    assert ring.write(np.arange(6, dtype=np.float32)) == 6
+    n, out = read(ring, 4)
+    assert n == 4 and out.tolist() == [0, 1, 2, 3]
+
+    # 写索引从 6 开始，后 3 个样本回绕到缓冲区开头
+    assert ring.write(np.arange(10, 15, dtype=np.float32)) == 5
+    n, out = read(ring, 7)
+    assert n == 7 and out.tolist() == [4, 5, 10, 11, 12, 13, 14]
+    assert ring.fill() == 0
+    assert ring.samples_played == 11
+
+
+def test_write_is_limited_by_space():
+    ring = AudioRingBuffer(4)
+    assert ring.write(np.ones(6, dtype=np.float32)) == 4
+    assert ring.space() == 0
+    assert ring.write(np.ones(1, dtype=np.float32)) == 0
+
+
+def test_clear_discards_written_samples():
+    ring = AudioRingBuffer(8)
+    ring.write(np.ones(5, dtype=np.float32))
+    ring.request_clear()
+    n, out = read(ring, 4)
+    assert n == 0 and not out.any()
+    assert ring.fill() == 0
+
+    # 清空之后写入的样本照常播放
+    ring.write(np.full(3, 2.0, dtype=np.float32))
+    n, out = read(ring, 3)
+    assert n == 3 and out.tolist() == [2, 2, 2]
+
+
+def test_int16_samples_are_read_as_float32():
+    ring = AudioRingBuffer(4, dtype=np.int16)
+    ring.write(np.array([16384, -16384], dtype=np.int16))
+    n, out = read(ring, 2)
+    assert n == 2 and np.allclose(out, [0.5, -0.5])
+
+
+def test_underrun_counts_only_mid_sentence():
+    ring = AudioRingBuffer(16)
+    # 一句话完整写入，播放到结尾后等待下一句不算欠载
+    ring.write(np.ones(4, dtype=np.float32), end_of_utterance=True)
+    read(ring, 4)
+    read(ring, 4)
+    assert ring.underruns == 0
+
+    # 句子中途数据耗尽，连续的空读只计一次
+    ring.write(np.ones(4, dtype=np.float32))
+    read(ring, 4)
+    read(ring, 4)
+    read(ring, 4)
+    assert ring.underruns == 1
+
+    # 被清空的句子不会再有后续数据
+    ring.write(np.ones(4, dtype=np.float32))
+    read(ring, 2)
+    ring.request_clear()
+    read(ring, 4)
+    assert ring.underruns == 1
@@ -0,0 +1,80 @@
+"""
+对话历史的后台压缩：摘要任务不随回答任务取消，同一会话同时只进行一次压缩，摘要期间追加的轮次保留。
+"""
+import asyncio
+
+import pytest
+
+import conversation_store
+from conversation_store import ConversationStore, compact_history_in_task
+
+
+@pytest.fixture(autouse=True)
+def history_enabled(monkeypatch):
+    monkeypatch.setattr(conversation_store, 'HISTORY_ENABLED', True)
+    monkeypatch.setattr(conversation_store, 'SUMMARIZE', True)
+
+
+def filled_store(turns=6):
+    store = ConversationStore("系统提示词", max_tokens=100)
+    for i in range(turns):
+        store.add_turn('s', f"问题{i}" * 4, f"回答{i}" * 4)
+    return store
+
+
+def test_compaction_survives_cancelled_answer():
+    store = filled_store()
+    release = asyncio.Event()
+    calls = []
+
+    async def summarize(messages):
+        calls.append(messages)
+        await release.wait()
+        return "摘要"
+
+    async def answer(started):
+        assert compact_history_in_task(store, 's', summarize) is not None
+        started.set()
+        await asyncio.Event().wait()
+
+    async def main():
+        started = asyncio.Event()
+        task = asyncio.create_task(answer(started))
+        await started.wait()
+        # 新问题到达：回答任务被取消，摘要仍在进行，同一会话不会再启动第二次压缩
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert compact_history_in_task(store, 's', summarize) is None
+        store.add_turn('s', "新问题", "新回答")
+        release.set()
+        await asyncio.gather(*store._tasks)
+
+    asyncio.run(main())
+    conversation = store._get('s')
+    assert len(calls) == 1
+    assert conversation.summary == "摘要"
+    assert conversation.compactions == 1
+    assert conversation.turns[-1] == ("新问题", "新回答")
+    assert store._compacting == set()
+
+
+def test_stale_summary_is_discarded():
+    store = filled_store()
+    release = asyncio.Event()
+
+    async def summarize(messages):
+        await release.wait()
+        return "过时的摘要"
+
+    async def main():
+        compact_history_in_task(store, 's', summarize)
+        await asyncio.sleep(0)
+        # 摘要生成期间历史被整体替换，摘要与历史对不上，不能覆盖
+        store._get('s').turns[:] = [("别的问题", "别的回答")]
+        release.set()
+        await asyncio.gather(*store._tasks)
+
+    asyncio.run(main())
+    conversation = store._get('s')
+    assert conversation.summary is None
+    assert conversation.turns == [("别的问题", "别的回答")]
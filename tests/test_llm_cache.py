@@ -0,0 +1,60 @@
+"""
+回答缓存：条目过期、按条目数和总字数的 LRU 淘汰。
+"""
+import llm_cache
+from llm_cache import CachedResponse, ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def response(text):
+    cached = CachedResponse()
+    cached.add(text)
+    return cached
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, 'monotonic', clock)
+    cache = ResponseCache(ttl_seconds=10, max_entries=4, max_chars=100)
+    cache.put('a', response("回答"))
+
+    clock.now += 9
+    assert cache.get('a') is not None
+    clock.now += 2
+    assert cache.get('a') is None
+    assert cache.stats()['expired'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_evicts_least_recently_used_entry():
+    cache = ResponseCache(ttl_seconds=0, max_entries=2, max_chars=100)
+    cache.put('a', response("一"))
+    cache.put('b', response("二"))
+    # 读取 a 后，最久未使用的是 b
+    assert cache.get('a') is not None
+    cache.put('c', response("三"))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicts_by_total_chars():
+    cache = ResponseCache(ttl_seconds=0, max_entries=10, max_chars=10)
+    cache.put('a', response("一二三四"))
+    cache.put('b', response("一二三四"))
+    cache.put('c', response("一二三四"))
+
+    assert cache.get('a') is None
+    assert cache.stats()['chars'] == 8
+    # 单条超过字数上限或为空的回答不缓存
+    cache.put('d', response("字" * 11))
+    cache.put('e', CachedResponse())
+    assert cache.get('d') is None and cache.get('e') is None
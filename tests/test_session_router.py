@@ -0,0 +1,42 @@
+"""
+WebUI 会话分发：旧代号的音频在分发时丢弃，终止按钮留下的结束标记不会结束下一轮推送。
+"""
+import queue
+
+from session_router import SessionRouter
+
+
+def test_drops_audio_from_stale_epochs():
+    ui_queue, audio_queue = queue.Queue(), queue.Queue()
+    router = SessionRouter(ui_queue, audio_queue)
+    router.reset('s', epoch=2)
+    audio_queue.put({'session': 's', 'epoch': 1, 'audio': [0.1]})
+    audio_queue.put({'session': 's', 'epoch': 1, 'end_of_turn': True})
+    audio_queue.put({'session': 's', 'epoch': 2, 'audio': [0.2]})
+
+    # 分发线程按顺序处理，收到新代号的音频时旧代号的消息已被丢弃
+    local = router.audio_queue('s')
+    item = local.get(timeout=5)
+    assert item['epoch'] == 2
+    assert local.empty()
+    ui_queue.put(None)
+    audio_queue.put(None)
+
+
+def test_queue_is_bounded():
+    router = SessionRouter(queue.Queue(), max_queued=2)
+    for i in range(3):
+        router.end_audio_turn('s', i)
+    local = router.audio_queue('s')
+    assert [local.get_nowait()['epoch'] for _ in range(local.qsize())] == [1, 2]
+
+
+def test_stale_end_marker():
+    router = SessionRouter(queue.Queue())
+    # 用户终止了代号 0 的回答，随后发送新问题进入代号 1
+    router.reset('s', epoch=1)
+    router.end_audio_turn('s', 0)
+    item = router.audio_queue('s').get_nowait()
+    assert SessionRouter.is_stale_end(item, start_epoch=router.epoch('s'))
+    assert not SessionRouter.is_stale_end({'end_of_turn': True, 'epoch': 1}, start_epoch=1)
+    assert not SessionRouter.is_stale_end({'audio': [0.1], 'epoch': 0}, start_epoch=1)
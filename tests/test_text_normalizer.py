@@ -0,0 +1,28 @@
+"""
+文本标准化：单遍实现与原调用链（benchmarks/bench_normalizer.py 中的对照组）输出一致。
+"""
+import pytest
+
+from bench_normalizer import SAMPLES, legacy_prepare
+from text_normalizer import normalize_batch, normalize_for_tts
+
+CASES = SAMPLES + [
+    "OLED电视",
+    "我出生于1995",
+    "1920年的事情",
+    "NASA在2024年发射了3颗卫星",
+    "价格是12.5元",
+    " iPhone 15 Pro ",
+    "没有数字也没有英文。",
+    "",
+]
+
+
+@pytest.mark.parametrize('text', CASES)
+def test_matches_legacy_chain(text):
+    assert normalize_for_tts(text) == legacy_prepare(text)
+
+
+def test_batch_matches_single_calls():
+    texts = ["OLED电视", "第2句。", "OLED电视"]
+    assert normalize_batch(texts) == [normalize_for_tts(text) for text in texts]
@@ -0,0 +1,37 @@
+"""
+流式分句器：与旧的逐 token re.split 做法（benchmarks/bench_segmenter.py 中的对照组）切分结果一致，
+跨片段的 <think> 标签被正确过滤。
+"""
+import pytest
+
+from bench_segmenter import legacy_segment, streaming_segment
+from text_segmenter import StreamingSegmenter, split_sentences
+
+TEXT = ("好的，我来简单介绍一下。这座城市始建于1368年，到2024年常住人口已经超过了800万。"
+        "每年春天都有大量游客前来赏花！你打算什么时候去？Try the local food! 最后一句没有标点")
+
+
+@pytest.mark.parametrize('token_size', [1, 2, 3, 7, 50])
+def test_matches_legacy_split(token_size):
+    tokens = [TEXT[i:i + token_size] for i in range(0, len(TEXT), token_size)]
+    # 旧做法用 \s* 吞掉句末标点后的空白，下游入队前同样会去掉首尾空白
+    assert [c.strip() for c in streaming_segment(tokens)] == [c.strip() for c in legacy_segment(tokens)]
+
+
+def test_filters_think_across_tokens():
+    segmenter = StreamingSegmenter(first_chunk_min_length=1)
+    visible = ''.join(segmenter.filter_think(token) for token in ["<th", "ink>想一想</thi", "nk>你好", "。"])
+    assert visible == "你好。"
+
+
+def test_first_chunk_then_sentences():
+    segmenter = StreamingSegmenter(first_chunk_min_length=4)
+    chunks = segmenter.push("你好你好，")
+    chunks += segmenter.push("第一句。第二句！！剩余")
+    chunks += segmenter.flush()
+    assert [(text, first) for text, first, _ in chunks] == [
+        ("你好你好，", True), ("第一句。", False), ("第二句！！", False), ("剩余", False)]
+
+
+def test_split_sentences_keeps_closing_quotes():
+    assert split_sentences("他说：“走吧。”然后离开了。 ") == ["他说：“走吧。”", "然后离开了。"]
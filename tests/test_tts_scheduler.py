@@ -0,0 +1,114 @@
+"""
+TTS 调度器：会话内按到达顺序输出、代号过时的任务被丢弃、被放弃的批次撤销或中途停止。
+推理由测试手动完成的 Future 代替。
+"""
+import concurrent.futures
+import queue
+
+import numpy as np
+
+from tts_scheduler import EpochTracker, TTSScheduler
+
+
+class FakeInference:
+    def __init__(self):
+        self.batches = []
+
+    def submit(self, batch, texts, params):
+        self.batches.append((batch, texts))
+        return concurrent.futures.Future()
+
+    def finish(self, index):
+        batch, texts = self.batches[index]
+        batch.started, batch.finished = 0.0, 0.1
+        batch.future.set_running_or_notify_cancel()
+        batch.future.set_result([np.full(240, 0.1, dtype=np.float32) for _ in texts])
+
+
+def make_scheduler(max_batch_size=1):
+    inference = FakeInference()
+    audio_queue = queue.Queue()
+    scheduler = TTSScheduler(audio_queue, inference.submit, lambda name: (None, None), num_workers=2,
+                             stream=False, batch_window=0.0, max_batch_size=max_batch_size, max_pending=0)
+    return scheduler, inference, audio_queue
+
+
+def drain(audio_queue):
+    messages = []
+    while not audio_queue.empty():
+        messages.append(audio_queue.get_nowait())
+    return messages
+
+
+def step(scheduler):
+    scheduler.reap_batches()
+    scheduler.submit_ready()
+    scheduler.flush_outbox()
+
+
+def test_epoch_tracker_marks_older_epochs_stale():
+    epochs = EpochTracker()
+    assert epochs.start_turn('s', 't1', 1)
+    assert not epochs.advance('s', 1)
+    assert epochs.advance('s', 2)
+    assert epochs.is_stale('s', 1)
+    assert not epochs.is_stale('s', 2)
+    assert not epochs.is_stale('s', None)
+    assert not epochs.is_stale('other', 1)
+
+
+def test_session_audio_keeps_arrival_order():
+    scheduler, inference, audio_queue = make_scheduler()
+    scheduler.receive([{'session': 's', 'text': '第一句。', 'chunk': 1, 'turn': 't'},
+                       {'session': 's', 'text': '第二句。', 'chunk': 2, 'turn': 't'}])
+    step(scheduler)
+    step(scheduler)
+    assert len(inference.batches) == 2
+
+    inference.finish(1)
+    step(scheduler)
+    assert drain(audio_queue) == []
+
+    inference.finish(0)
+    step(scheduler)
+    assert [message['chunk'] for message in drain(audio_queue)] == [1, 2]
+    assert not scheduler.busy()
+
+
+def test_clear_drops_queued_and_stale_jobs():
+    scheduler, inference, audio_queue = make_scheduler()
+    scheduler.receive([{'session': 's', 'start_of_turn': True, 'turn': 't1', 'epoch': 1},
+                       {'session': 's', 'text': '旧回答。', 'turn': 't1'}])
+    scheduler.handle_command(("CLEAR", 's', 2))
+    assert scheduler.sched_stats['queued_dropped'] == 1
+
+    # 会话清空后才从队列中取出的旧代号文本块
+    scheduler.receive([{'session': 's', 'text': '迟到的旧文本。', 'turn': 't1', 'epoch': 1}])
+    assert scheduler.sched_stats['stale_dropped'] == 1
+    step(scheduler)
+    assert inference.batches == []
+    assert drain(audio_queue) == []
+    assert not scheduler.busy()
+
+
+def test_abandoned_batch_is_cancelled_or_interrupted():
+    scheduler, inference, audio_queue = make_scheduler()
+    scheduler.receive([{'session': 's', 'text': '尚未开始。', 'epoch': 1},
+                       {'session': 's', 'text': '正在推理。', 'epoch': 1}])
+    step(scheduler)
+    step(scheduler)
+    pending, running = inference.batches[0][0], inference.batches[1][0]
+    running.future.set_running_or_notify_cancel()
+
+    scheduler.handle_command(("CLEAR", 's', 2))
+    assert pending.future.cancelled()
+    assert scheduler.sched_stats['cancelled_before_start'] == 1
+    # 已经开始的推理无法撤销，只能通知推理线程在下一个生成步骤之间停止
+    assert running.cancel.is_set()
+
+    running.started, running.finished = 0.0, 0.1
+    running.future.set_exception(concurrent.futures.CancelledError())
+    step(scheduler)
+    assert scheduler.sched_stats['interrupted'] == 1
+    assert drain(audio_queue) == []
+    assert not scheduler.busy()
@@ -0,0 +1,113 @@
+import re
+from functools import lru_cache
+
+from config_loader import config
+
+# 已标准化文本的 LRU 缓存容量（条），0 表示不缓存
+MEMO_SIZE = (config.get('tts') or {}).get('normalizer_memo_size', 4096)
+
+# 英文、数字和特定符号组成的连续片段
+_ASCII_RUN = re.compile(r"[a-zA-Z0-9\s'._-]+")
+_ACRONYM = re.compile(r'[A-Z]{2,}')
+_YEAR = re.compile(r'\b([0-9]{4})(?:年)?\b')
+_YEAR_DIGITS = str.maketrans('0123456789', '零一二三四五六七八九')
+# cn2an 的 an2cn 规则都以数字为锚点，不含数字的文本可以跳过（其日期规则会在每个位置做一次空匹配，开销很大）
+_DIGIT = re.compile(r'\d')
+
+_cn2an = None
+
+
+def _an2cn(text):
+    # cn2an 导入较慢（约 0.2 秒），推迟到第一次需要转换数字时，避免拖慢不做合成的进程
+    global _cn2an
+    if _cn2an is None:
+        import cn2an
+        _cn2an = cn2an
+    return _cn2an.transform(text, "an2cn")
+
+
+def _year_to_chinese(match):
+    chinese_year = match.group(1).translate(_YEAR_DIGITS)
+    # 原始匹配以 "年" 结尾时，转换结果中也保留 "年"
+    return chinese_year + '年' if match.group(0).endswith('年') else chinese_year
+
+
+def convert_year_in_text(text):
+    """
+    将文本中的四位数字年份转换为逐字朗读的中文格式。
+    例如: "1920年" -> "一九二零年", "我出生于1995" -> "我出生于一九九五"
+    """
+    return _YEAR.sub(_year_to_chinese, text)
+
+
+def _spaced_run(match, run):
+    # 与中文片段相邻的一侧补一个空格
+    return (' ' if match.start() else '') + run + (' ' if match.end() < len(match.string) else '')
+
+
+def _expand_acronym(match):
+    run = match.group(0)
+    stripped = run.strip()
+    if _ACRONYM.fullmatch(stripped):
+        run = ' '.join(stripped)
+    return _spaced_run(match, run)
+
+
+def _expand_run(match):
+    """
+    一次处理一个英文/数字片段：展开缩写词，或者转换其中的年份。
+    片段两侧总会补上空格（或位于文本边界），因此在片段内部匹配年份与在整句中匹配结果相同。
+    """
+    run = match.group(0)
+    stripped = run.strip()
+    if _ACRONYM.fullmatch(stripped):
+        run = ' '.join(stripped)
+    else:
+        run = _YEAR.sub(_year_to_chinese, run)
+    return _spaced_run(match, run)
+
+
+def normalize_mixed_text(text):
+    """
+    在中英文、数字之间添加空格，并特殊处理大写缩写词，以优化ChatTTS的处理效果。
+    例如："OLED电视" -> "O L E D 电视"
+    """
+    return _ASCII_RUN.sub(_expand_acronym, text).replace('  ', ' ')
+
+
+def _normalize(text):
+    # 一遍扫描完成中英文分隔、缩写词展开和年份转换，再交给 cn2an 转换其余数字
+    text = _ASCII_RUN.sub(_expand_run, text.strip()).replace('  ', ' ')
+    return _an2cn(text) if _DIGIT.search(text) else text
+
+
+_normalize_cached = lru_cache(maxsize=MEMO_SIZE)(_normalize) if MEMO_SIZE else _normalize
+
+
+def normalize_for_tts(text):
+    """
+    合成前的完整文本标准化，结果与依次调用 normalize_mixed_text、convert_year_in_text、
+    cn2an.transform 相同。重复出现的文本直接从 LRU 缓存返回。
+    """
+    return _normalize_cached(text)
+
+
+def normalize_batch(texts):
+    """
+    一次标准化多个文本块，批内重复的文本只处理一次。
+    """
+    results = {}
+    return [results[text] if text in results else results.setdefault(text, _normalize_cached(text)) for text in texts]
+
+
+def memo_stats():
+    if not MEMO_SIZE:
+        return None
+    info = _normalize_cached.cache_info()
+    total = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': round(info.hits / total, 3) if total else 0.0,
+        'size': info.currsize,
+    }
@@ -0,0 +1,149 @@
+import re
+
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+# 连续的句末标点视为一个句子结束符，例如 "！？"
+SENTENCE_END = re.compile(r'[。！？!?]+')
+# 预合成只在分句标点处截取前缀，之后到达的文本不会改变这部分内容
+CLAUSE_END = re.compile(r'[，；：,;:]')
+# 完整文本分句时，句末标点之后的右引号、右括号归入前一句
+SENTENCE_END_WITH_CLOSERS = re.compile(r'[。！？!?]+[”’」』）)"\']*')
+
+
+def split_sentences(text):
+    """
+    在句末标点处切分一段完整的文本（非流式场景），返回去除首尾空白后的非空句子。
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_WITH_CLOSERS.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    sentences.append(text[start:])
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def _partial_tag_length(text, tag, start):
+    """
+    返回 text 末尾与 tag 前缀重合的最大长度，用于处理被拆到两个流式片段中的标签。
+    """
+    for k in range(min(len(tag) - 1, len(text) - start), 0, -1):
+        if text.endswith(tag[:k]):
+            return k
+    return 0
+
+
+class StreamingSegmenter:
+    """
+    流式文本分句器。每次只扫描新到达的字符，总开销与回答长度成线性关系。
+    - filter_think(): 过滤 <think>...</think> 内容，标签跨越多个流式片段时也能正确识别；
+    - push(): 按快速响应规则切出首块（累计达到 first_chunk_min_length 即输出），
+      之后在句末标点处切分；
+    - speculate(): 从尚未结束的句子中截取以分句标点结尾的前缀，供 TTS 提前合成；
+    - flush(): 回答结束时取出剩余文本。
+    输出为 (文本, 是否为首块, 预合成标签列表) 列表。预合成标签由 speculate() 生成，
+    随包含这些前缀的完整句子一起返回。长句的进一步切分仍由 _process_and_queue_text_chunk 负责。
+    """
+
+    def __init__(self, first_chunk_min_length):
+        self.first_chunk_min_length = first_chunk_min_length
+        self._in_think = False
+        self._tag_carry = ''
+        self._parts = []
+        self._length = 0
+        self._first_pending = True
+        self._spec_length = 0
+        self._spec_tags = []
+        self._clause_seen = False
+        self.received_chars = 0
+
+    def filter_think(self, content):
+        self.received_chars += len(content)
+        text = self._tag_carry + content
+        self._tag_carry = ''
+        visible = []
+        pos = 0
+        while True:
+            tag = THINK_CLOSE if self._in_think else THINK_OPEN
+            idx = text.find(tag, pos)
+            if idx == -1:
+                keep = _partial_tag_length(text, tag, pos)
+                end = len(text) - keep
+                if not self._in_think:
+                    visible.append(text[pos:end])
+                self._tag_carry = text[end:]
+                break
+            if not self._in_think:
+                visible.append(text[pos:idx])
+            pos = idx + len(tag)
+            self._in_think = not self._in_think
+        return ''.join(visible)
+
+    def _take(self, is_first=False):
+        chunk = (''.join(self._parts), is_first, self._spec_tags)
+        self._parts = []
+        self._length = 0
+        self._spec_length = 0
+        self._spec_tags = []
+        self._clause_seen = False
+        return chunk
+
+    def push(self, visible):
+        if not visible:
+            return []
+        if self._first_pending:
+            self._parts.append(visible)
+            self._length += len(visible)
+            if self._length >= self.first_chunk_min_length:
+                self._first_pending = False
+                return [self._take(is_first=True)]
+            return []
+
+        chunks = []
+        start = 0
+        for match in SENTENCE_END.finditer(visible):
+            self._parts.append(visible[start:match.end()])
+            chunks.append(self._take())
+            start = match.end()
+        rest = visible[start:]
+        if rest:
+            self._parts.append(rest)
+            self._length += len(rest)
+            if not self._clause_seen and CLAUSE_END.search(rest):
+                self._clause_seen = True
+        return chunks
+
+    def speculate(self, min_length, new_tag):
+        """
+        若未完成的句子中新出现了分句标点，且上次预合成之后的文本不少于 min_length 个字符，
+        返回 (以分句标点结尾的前缀, 标签)，标签由 new_tag() 生成并记入该句的预合成标签；否则返回 None。
+        首块尚未输出时不做预合成（首块本身已经走快速响应路径）。
+        """
+        if self._first_pending or not self._clause_seen or self._length - self._spec_length < min_length:
+            return None
+        text = ''.join(self._parts)
+        self._parts = [text]
+        self._clause_seen = False
+        boundary = None
+        for match in CLAUSE_END.finditer(text, self._spec_length):
+            boundary = match.end()
+        if boundary is None:
+            return None
+        prefix = text[self._spec_length:boundary]
+        if len(prefix.strip()) < min_length:
+            return None
+        self._spec_length = boundary
+        tag = new_tag()
+        self._spec_tags.append(tag)
+        return prefix, tag
+
+    def pending_length(self):
+        return self._length
+
+    def flush(self):
+        if self._tag_carry and not self._in_think:
+            self._parts.append(self._tag_carry)
+        self._tag_carry = ''
+        chunk = self._take(is_first=self._first_pending)
+        self._first_pending = False
+        return [chunk] if chunk[0].strip() else []
@@ -1,161 +1,204 @@
-import ChatTTS
 import numpy as np
 import os
-from queue import Empty
 import concurrent.futures
-from collections import deque
 import time
 from config_loader import config
 import pickle
-import cn2an
-import re
+from audio_cache import AudioCache
+from text_normalizer import memo_stats
+from latency_tracer import trace
+import supervisor
+from tts_scheduler import BATCH_WINDOW_SECONDS, MAX_BATCH_SIZE, STREAM_SYNTHESIS, TTS_CONFIG, TTSScheduler
+from tts_warm_start import COMPILE_MODEL, WARMUP, WARMUP_TEXT, configure_compile_cache
+from voice_bank import DEFAULT_VOICE, VOICE_BANK_ENABLED, VoiceBank
 
 
 NUM_WORKERS = 2 
 MODEL_PATH = config['chat_tts_path']
 SPEAKER_EMB_PATH = config['speaker_embedding_path']
 
-def convert_year_in_text(text):
+CACHE_CONFIG = TTS_CONFIG.get('cache') or {}
+
+# 协作式取消：流式合成在生成步骤之间检查取消标记，被清空的任务不再继续占用 CPU。
+# 非流式合成仍然整批调用 chat.infer（逐步迭代会反复解码已生成的部分），只在推理线程开始执行批次前检查
+COOPERATIVE_CANCEL = TTS_CONFIG.get('cooperative_cancel', True)
+
+def _create_audio_cache():
+    if not CACHE_CONFIG.get('enabled', False):
+        return None
+    max_bytes = int(CACHE_CONFIG.get('max_memory_mb', 64) * 1024 * 1024)
+    disk_dir = CACHE_CONFIG.get('disk_dir') or None
+    max_disk_mb = CACHE_CONFIG.get('max_disk_mb', 512)
+    max_disk_bytes = int(max_disk_mb * 1024 * 1024) if max_disk_mb else None
+    print(f"[TTS Converter]: 短语音频缓存已启用 (内存上限 {max_bytes // (1024 * 1024)} MB, 磁盘目录: {disk_dir or '无'}"
+          f"{f', 磁盘上限 {max_disk_mb} MB' if disk_dir and max_disk_mb else ''})。")
+    return AudioCache(max_bytes, disk_dir=disk_dir, max_disk_bytes=max_disk_bytes)
+
+def _stream_infer(chat, texts, params_infer_code, frame_queues=None, cancel=None):
     """
-    更智能地将文本中的四位数字年份转换为逐字朗读的中文格式。
-    例如: "1920年" -> "一九二零年", "我出生于1995" -> "我出生于一九九五"
+    以流式方式推理一个批次，每条文本的增量音频帧实时放入各自的帧队列（如果有），结束时放入 None。
+    返回每条文本拼接后的完整音频，供缓存使用。cancel 被设置后在下一个生成步骤之前停止并抛出 CancelledError。
     """
-    digit_map = {'0': '零', '1': '一', '2': '二', '3': '三', '4': '四', '5': '五', '6': '六', '7': '七', '8': '八', '9': '九'}
-
-    def replace_year(match):
-        year_digits = match.group(1)
-        # 将每个数字转换为对应的中文字符
-        chinese_year = ''.join(digit_map[digit] for digit in year_digits)
-        
-        # 检查原始匹配的末尾是否是 "年"，如果是，则在转换后的结果中也加上 "年"
-        if match.group(0).endswith('年'):
-            return f"{chinese_year}年"
-        else:
-            return chinese_year
+    segments = [[] for _ in texts]
+    stream = chat.infer(texts, stream=True, params_infer_code=params_infer_code)
+    try:
+        for new_wavs in stream:
+            if cancel is not None and cancel.is_set():
+                raise concurrent.futures.CancelledError()
+            for i, seg in enumerate(new_wavs):
+                seg = np.asarray(seg).reshape(-1)
+                if seg.size == 0 or i >= len(segments):
+                    continue
+                segments[i].append(seg)
+                if frame_queues is not None:
+                    frame_queues[i].put(seg)
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+        for frames in frame_queues or ():
+            frames.put(None)
+    return [np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32) for parts in segments]
 
-    # 更新正则表达式：
-    # \b(\d{4})\b  -> 匹配独立的四位数字 (例如 "1995")
-    # (\d{4})年   -> 匹配后面跟着 "年" 的四位数字 (例如 "1995年")
-    # 使用 | (或) 将两种情况合并
-    # 使用非捕获组 (?:...) 来处理 "年" 的可选情况
-    return re.sub(r'\b(\d{4})(?:年)?\b', replace_year, text)
+def _run_batch(batch, infer, *args, **kwargs):
+    batch.started = time.monotonic()
+    if COOPERATIVE_CANCEL and batch.cancel.is_set():
+        # 批次在等待推理线程期间被放弃，而 future 已被线程取走、无法撤销
+        batch.finished = batch.started
+        raise concurrent.futures.CancelledError()
+    try:
+        return infer(*args, **kwargs)
+    finally:
+        batch.finished = time.monotonic()
 
-def normalize_mixed_text(text):
+def _load_saved_speaker():
+    if not os.path.exists(SPEAKER_EMB_PATH):
+        return None
+    try:
+        with open(SPEAKER_EMB_PATH, 'rb') as f: spk_emb = pickle.load(f)
+        print(f"已从 '{SPEAKER_EMB_PATH}' 加载保存的音色。")
+        return spk_emb
+    except Exception as e:
+        print(f"加载音色文件 '{SPEAKER_EMB_PATH}' 失败: {e}")
+        return None
+
+def _save_random_speaker(spk_emb):
     """
-    在中英文、数字之间添加空格，并特殊处理大写缩写词，以优化ChatTTS的处理效果。
-    例如："OLED电视" -> "O L E D 电视"
+    只在音色文件不存在时保存随机音色，已有文件（即使暂时无法读取）绝不覆盖。
+    多个工作进程同时生成时只有一个能写入，其余进程改用它写入的音色，保证各进程音色一致。
     """
-    # 使用正则表达式切分文本，保留英文、数字和特定符号的组合
-    parts = re.split(r'([a-zA-Z0-9\s\'._-]+)', text)
-    
-    processed_parts = []
-    for part in parts:
-        if not part:
-            continue
-        # 条件：完全由2个或以上大写英文字母组成
-        if re.fullmatch(r'[A-Z]{2,}', part.strip()):
-            # 是缩写词，展开为 "L E D" 的形式
-            processed_parts.append(" ".join(part.strip()))
-        else:
-            processed_parts.append(part)
-    # 重新组合，并清理多余的空格
-    return ' '.join(processed_parts).replace('  ', ' ')
+    try:
+        with open(SPEAKER_EMB_PATH, 'xb') as f: pickle.dump(spk_emb, f)
+        print(f"新音色已生成并保存到 '{SPEAKER_EMB_PATH}'。")
+        return spk_emb
+    except FileExistsError:
+        time.sleep(0.5)
+        saved = _load_saved_speaker()
+        if saved is not None:
+            return saved
+        print(f"音色文件 '{SPEAKER_EMB_PATH}' 已存在，不会覆盖，本次使用临时随机音色。")
+        return spk_emb
+    except OSError as e:
+        print(f"保存音色文件失败: {e}，本次使用临时随机音色。")
+        return spk_emb
 
-def _clear_queue(q):
-    while not q.empty():
-        try: q.get_nowait()
-        except Empty: break
+def _pending_text_count(text_queue):
+    try:
+        return text_queue.qsize()
+    except (NotImplementedError, AttributeError):
+        # macOS 上 mp.Queue 不支持 qsize
+        return None
 
-def convert_text_to_audio(text_queue, audio_queue, command_queue):
+def convert_text_to_audio(text_queue, audio_queue, command_queue, feedback=None):
     print("ChatTTS 转换器正在启动...")
+    # 启动耗时分解（秒）。模型加载期间大模型照常输出，文本块在 text_queue 中排队等待
+    startup = {}
+    started = time.monotonic()
     try:
+        configure_compile_cache()
+        import ChatTTS
+        startup['import'] = time.monotonic() - started
+
+        step = time.monotonic()
+        # 音色不依赖模型，先于模型读取。音色库以只读内存映射打开，各工作进程共享同一份页缓存
+        voice_bank = VoiceBank() if VOICE_BANK_ENABLED else None
+        spk_emb = voice_bank.get(DEFAULT_VOICE) if voice_bank is not None and DEFAULT_VOICE else None
+        if spk_emb is not None:
+            print(f"已从音色库加载默认音色 '{DEFAULT_VOICE}'。")
+        else:
+            spk_emb = _load_saved_speaker()
+        startup['speaker'] = time.monotonic() - step
+
+        step = time.monotonic()
         chat = ChatTTS.Chat()
-        chat.load(custom_path=MODEL_PATH, compile=True)
+        chat.load(custom_path=MODEL_PATH, compile=COMPILE_MODEL)
+        startup['model_load'] = time.monotonic() - step
         print("ChatTTS 模型加载成功。")
     except Exception as e:
         print(f"初始化 ChatTTS 失败: {e}")
+        if supervisor.supervised():
+            # 由监督进程重启本阶段；放弃重启时再由它通知播放器结束
+            raise SystemExit(1)
         audio_queue.put(None)
         return
 
-    if os.path.exists(SPEAKER_EMB_PATH):
-        try:
-            with open(SPEAKER_EMB_PATH, 'rb') as f: spk_emb = pickle.load(f)
-            print(f"已从 '{SPEAKER_EMB_PATH}' 加载保存的音色。")
-        except Exception as e: spk_emb = None
-    else:
-        spk_emb = None
     if spk_emb is None:
         print("未找到或加载音色文件失败，正在生成随机音色...")
-        spk_emb = chat.sample_random_speaker()
-        with open(SPEAKER_EMB_PATH, 'wb') as f: pickle.dump(spk_emb, f)
-        print(f"新音色已生成并保存到 '{SPEAKER_EMB_PATH}'。")
+        spk_emb = _save_random_speaker(chat.sample_random_speaker())
 
-    params_infer_code = ChatTTS.Chat.InferCodeParams(spk_emb=spk_emb, temperature=0.6, top_P=0.7, top_K=20)
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        future_deque = deque()
-        stop_signal_received = False
-        while not stop_signal_received or future_deque:
-            try:
-                command = command_queue.get_nowait()
-                if command == "CLEAR":
-                    print("[TTS Converter]: 收到CLEAR命令，清空待办任务。")
-                    _clear_queue(text_queue)
-                    for future in future_deque: future.cancel()
-                    future_deque.clear()
-            except Empty:
-                pass
-
-            if not stop_signal_received:
-                try:
-                    original_text = text_queue.get(timeout=0.1)
-                    if original_text is None:
-                        stop_signal_received = True
-                    else:
-                        # 1. 标准化文本，在中英文之间添加空格
-                        normalized_text = normalize_mixed_text(original_text.strip())
-                        
-                        # 2. 优先处理文本中的年份
-                        text_with_years_converted = convert_year_in_text(normalized_text)
-                        
-                        # 3. 对处理完年份的文本进行其余的数字转换
-                        text_to_speak = cn2an.transform(text_with_years_converted, "an2cn")
-
-                        if text_to_speak:
-                            print(f"\n[音频合成任务提交]: {text_to_speak} (原始文本: {original_text.strip()})")
-                            future = executor.submit(chat.infer, [text_to_speak], params_infer_code=params_infer_code)
-                            future_deque.append(future)
-                except Empty:
-                    pass
-            
-            if future_deque and future_deque[0].done():
-                future = future_deque.popleft()
-                try:
-                    wavs = future.result()
-                    
-                    print(f"[TTS DEBUG]: 转换任务完成。返回结果类型: {type(wavs)}")
-                    if isinstance(wavs, (list, tuple)):
-                        print(f"[TTS DEBUG]: 返回结果是一个列表/元组，长度为: {len(wavs)}")
-                    
-                    if isinstance(wavs, (list, tuple)) and len(wavs) > 0:
-                        audio_data = np.array(wavs[0])
-                        if isinstance(audio_data, np.ndarray) and audio_data.size > 0:
-                            print(f"[TTS DEBUG]: 成功提取音频数据 (大小: {audio_data.size})，准备放入播放队列。")
-                            audio_queue.put(audio_data)
-                        else:
-                            print("[TTS DEBUG]: 警告: 返回的列表内容无效或为空数组。")
-                    else:
-                        print("[TTS DEBUG]: 警告: TTS模型返回的结果不是有效列表或为空。音频无法播放。")
-
-                except (concurrent.futures.CancelledError, Exception) as e:
-                    if not isinstance(e, concurrent.futures.CancelledError):
-                        print(f"!!! 获取任务结果时出错: {e}")
+    def make_params(embedding):
+        return ChatTTS.Chat.InferCodeParams(spk_emb=embedding, temperature=0.6, top_P=0.7, top_K=20)
+
+    params_infer_code = make_params(spk_emb)
+    # 音色名称 -> (音色嵌入, 推理参数)。切换音色只替换推理参数，无需重新加载模型
+    voices = {None: (spk_emb, params_infer_code)}
+
+    def voice_params(name):
+        if name not in voices:
+            embedding = voice_bank.get(name) if voice_bank is not None else None
+            if embedding is None:
+                print(f"[TTS Converter]: 音色 '{name}' 不存在{'' if voice_bank is not None else '（音色库未启用）'}，使用默认音色。")
+                voices[name] = voices[None]
             else:
-                time.sleep(0.05)
-            
-            if stop_signal_received and not future_deque:
-                break
+                voices[name] = (embedding, make_params(embedding))
+        return voices[name]
+    # 首次推理会触发编译；没有文本在等待时先用短句预热，否则直接处理真实文本
+    if WARMUP and text_queue.empty():
+        step = time.monotonic()
+        try:
+            chat.infer([WARMUP_TEXT], params_infer_code=params_infer_code)
+            startup['warmup'] = time.monotonic() - step
+        except Exception as e:
+            print(f"[TTS Converter]: 预热推理失败: {e}")
+    startup = {name: round(seconds, 3) for name, seconds in startup.items()}
+    startup['total'] = round(time.monotonic() - started, 3)
+    startup['buffered_chunks'] = _pending_text_count(text_queue)
+    print(f"[TTS Converter]: 启动耗时 (秒) {startup}")
+    trace('tts_ready', **startup)
+    supervisor.ready()
+
+    print(f"[TTS Converter]: 微批调度已启用 (窗口 {BATCH_WINDOW_SECONDS * 1000:.0f} ms, 最大批量 {MAX_BATCH_SIZE})。")
+    if STREAM_SYNTHESIS:
+        print("[TTS Converter]: 流式合成已启用，音频帧将边合成边播放。")
+    cache = _create_audio_cache()
+    cache_max_text_length = CACHE_CONFIG.get('max_text_length', 30)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        def submit(batch, texts, params):
+            cancel = batch.cancel if COOPERATIVE_CANCEL else None
+            if STREAM_SYNTHESIS:
+                return executor.submit(_run_batch, batch, _stream_infer, chat, texts, params,
+                                       [job.frames for job in batch.jobs], cancel)
+            return executor.submit(_run_batch, batch, chat.infer, texts, params_infer_code=params)
+
+        scheduler = TTSScheduler(audio_queue, submit, voice_params, NUM_WORKERS, cache=cache,
+                                 cache_max_text_length=cache_max_text_length, feedback=feedback)
+        scheduler.run(text_queue, command_queue)
 
+    if cache is not None:
+        print(f"[Audio Cache]: 缓存统计 {cache.stats()}")
+    scheduler.report_stats()
+    if memo_stats() is not None:
+        print(f"[TTS Converter]: 文本标准化缓存统计 {memo_stats()}")
     print("所有TTS任务已完成，向播放器发送结束信号。")
     audio_queue.put(None)
-    print("ChatTTS 转换器已关闭。")
\ No newline at end of file
+    print("ChatTTS 转换器已关闭。")
@@ -0,0 +1,382 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+from queue import Empty
+
+try:
+    import fcntl
+except ImportError:  # Windows：只能依靠工作进程退出前发送的结束消息
+    fcntl = None
+
+from config_loader import config
+from pipeline_channel import TTS_MAX_PENDING
+import supervisor
+from tts_converter import convert_text_to_audio
+from tts_scheduler import EpochTracker
+from tts_warm_start import configure_compile_cache
+from audio_format import SAMPLE_RATE
+from shm_transport import SharedAudioChannel
+from voice_bank import prepare_voice_bank
+
+TTS_CONFIG = config.get('tts') or {}
+NUM_PROCESSES = max(1, TTS_CONFIG.get('num_processes', 1))
+REPORT_INTERVAL_SECONDS = 30
+# 调度器检查工作进程是否仍在运行的间隔
+LIVENESS_CHECK_SECONDS = 0.5
+
+
+class _TaggedQueue:
+    """
+    给工作进程输出的每条消息打上工作进程编号，使调度器能区分来源。
+    音频通道为共享内存时，音频直接写入通道的槽位，队列中只传递槽位编号（见 SharedAudioChannel.stage）。
+    """
+
+    def __init__(self, q, worker_id, audio_channel=None):
+        self._q = q
+        self._worker_id = worker_id
+        self._audio_channel = audio_channel
+
+    def put(self, item):
+        if self._audio_channel is not None and isinstance(item, dict) and item.get('audio') is not None:
+            item = self._audio_channel.stage(item)
+        self._q.put((self._worker_id, item))
+
+
+def _hold_liveness_lock(path):
+    """
+    工作进程在整个生命周期内持有 path 上的排他文件锁，进程无论以何种方式退出，锁都由操作系统释放。
+    先在临时文件上加锁再改名，调度器看到 path 时锁一定已被持有。返回需要保持打开的文件。
+    """
+    if fcntl is None:
+        return None
+    f = open(f"{path}.tmp", 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    os.replace(f"{path}.tmp", path)
+    return f
+
+
+def _worker_exited(path):
+    """
+    工作进程已经退出（包括被杀死）时返回 True；尚未启动完成时返回 False。
+    """
+    if fcntl is None or not os.path.exists(path):
+        return False
+    with open(path) as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+
+def _tts_worker(worker_id, num_threads, text_queue, result_queue, command_queue, feedback=None, audio_channel=None,
+                liveness_path=None):
+    liveness_lock = _hold_liveness_lock(liveness_path) if liveness_path else None
+    # 编译缓存的环境变量必须在导入 torch 之前设置
+    configure_compile_cache()
+    try:
+        import torch
+        # 多个进程同时推理时平分 CPU 核心，避免线程超额订阅
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    print(f"[TTS Pool]: 工作进程 {worker_id} 启动 (PID {os.getpid()}, 线程数 {num_threads})。")
+    convert_text_to_audio(text_queue, _TaggedQueue(result_queue, worker_id, audio_channel), command_queue, feedback)
+    if liveness_lock is not None:
+        liveness_lock.close()
+
+
+class _WorkerStats:
+    def __init__(self):
+        self.outstanding = 0
+        self.jobs = 0
+        self.chars = 0
+        self.audio_samples = 0
+        self.first_dispatch = None
+        self.last_done = None
+        self.alive = True
+
+    def report(self):
+        elapsed = (self.last_done - self.first_dispatch) if self.first_dispatch and self.last_done else 0.0
+        audio_seconds = self.audio_samples / SAMPLE_RATE
+        return {
+            "jobs": self.jobs,
+            "chars_per_s": round(self.chars / elapsed, 1) if elapsed else 0.0,
+            "audio_s_per_s": round(audio_seconds / elapsed, 2) if elapsed else 0.0,
+            "outstanding": self.outstanding,
+        }
+
+
+def dispatch_tts_jobs(text_queue, audio_queue, command_queue, worker_text_queues, worker_command_queues, result_queue,
+                      liveness_paths=None):
+    """
+    TTS 进程池的调度器：按各工作进程的在途任务数分发文本块，
+    再按会话内的原始顺序重排结果后放入播放队列。
+    在监督下运行时由调度器报告低水位：文本块的结果全部输出后才算处理完毕，工作进程收到的任务不带中转序号。
+    工作进程没有发送结束消息就退出时（崩溃或被杀死），由 liveness_paths 上的文件锁发现，
+    它名下的任务视为已完成，不再阻塞同一会话之后的输出。
+    """
+    num_workers = len(worker_text_queues)
+    stats = [_WorkerStats() for _ in range(num_workers)]
+    jobs = {}              # seq -> {'session', 'worker', 'chars', 'messages', 'done', 'relay_seq'}
+    assigned = {}          # seq -> 工作进程编号，CLEAR 后仍保留，用于维护在途任务数
+    order = OrderedDict()  # session -> 该会话按顺序等待输出的 seq
+    spec_route = {}        # session -> 当前句子的预合成任务所在的工作进程，完整句子必须发往同一进程
+    epochs = EpochTracker()
+    stale_dropped = 0
+    next_seq = 0
+    last_relay_seq = -1
+    exited_workers = 0
+    stop_signal_received = False
+    last_report = time.monotonic()
+    last_liveness_check = time.monotonic()
+    print(f"[TTS Pool]: 调度器已启动，共 {num_workers} 个工作进程。")
+
+    def report():
+        for worker_id, worker_stats in enumerate(stats):
+            print(f"[TTS Pool]: 工作进程 {worker_id} 吞吐: {worker_stats.report()}")
+
+    def discard(message):
+        if 'shm_slots' in message:
+            audio_queue.discard(message)
+
+    def clear(session=None):
+        for s in ([session] if session is not None else list(order) + list(spec_route)):
+            spec_route.pop(s, None)
+            for seq in order.pop(s, ()):
+                state = jobs.pop(seq, None)
+                for message in state['messages'] if state is not None else ():
+                    discard(message)
+
+    def pick_worker():
+        alive = [i for i in range(num_workers) if stats[i].alive] or list(range(num_workers))
+        return min(alive, key=lambda i: stats[i].outstanding)
+
+    def dispatch(item):
+        nonlocal next_seq, stale_dropped
+        relay_seq = item.pop('relay_seq', None) if isinstance(item, dict) else None
+        if isinstance(item, dict) and item.get('start_of_turn'):
+            session, epoch = item.get('session'), item.get('epoch')
+            if epochs.start_turn(session, item.get('turn'), epoch):
+                # 新代号先于 CLEAR 命令到达：清理本地的旧结果，并让工作进程停止旧代号的推理
+                clear(session)
+                for q in worker_command_queues:
+                    q.put(("CLEAR", session, epoch))
+            return
+        if isinstance(item, dict) and 'set_voice' in item:
+            # 音色切换广播给所有工作进程，之后同一会话的文本块无论发往哪个进程都使用新音色
+            for q in worker_text_queues:
+                q.put(dict(item))
+            return
+        session = item.get('session') if isinstance(item, dict) else None
+        end_of_turn = isinstance(item, dict) and item.get('end_of_turn')
+        turn = item.get('turn') if isinstance(item, dict) else None
+        epoch = epochs.end_turn(turn) if end_of_turn else epochs.epoch_of(turn)
+        if epochs.is_stale(session, epoch):
+            # 会话清空之后才到达的旧代号文本块，不再分发
+            stale_dropped += 1
+            return
+        if isinstance(item, dict) and item.get('speculative'):
+            # 预合成任务在被认领前不产生输出，不分配 seq，也不参与排序
+            worker_id = spec_route.get(session)
+            if worker_id is None or not stats[worker_id].alive:
+                worker_id = spec_route[session] = pick_worker()
+            worker_text_queues[worker_id].put({**item, 'epoch': epoch} if epoch is not None else dict(item))
+            return
+        seq = next_seq
+        next_seq += 1
+        order.setdefault(session, deque()).append(seq)
+        if end_of_turn:
+            # 结束标记不需要合成，直接按顺序排队输出
+            message = {'session': session, 'end_of_turn': True}
+            if epoch is not None:
+                message['epoch'] = epoch
+            jobs[seq] = {'session': session, 'worker': None, 'chars': 0, 'messages': deque([message]), 'done': True,
+                         'relay_seq': relay_seq}
+            spec_route.pop(session, None)
+            return
+        job = dict(item) if isinstance(item, dict) else {'text': item}
+        job['seq'] = seq
+        if epoch is not None:
+            job['epoch'] = epoch
+        worker_id = spec_route.pop(session, None)
+        if worker_id is None or not job.get('speculated') or not stats[worker_id].alive:
+            worker_id = pick_worker()
+        worker_stats = stats[worker_id]
+        worker_stats.outstanding += 1
+        assigned[seq] = worker_id
+        if worker_stats.first_dispatch is None:
+            worker_stats.first_dispatch = time.monotonic()
+        jobs[seq] = {'session': session, 'worker': worker_id, 'chars': len(job.get('text', '')),
+                     'messages': deque(), 'done': False, 'relay_seq': relay_seq}
+        worker_text_queues[worker_id].put(job)
+
+    def worker_exited(worker_id):
+        nonlocal exited_workers
+        if not stats[worker_id].alive:
+            return
+        exited_workers += 1
+        stats[worker_id].alive = False
+        # 工作进程提前退出（例如模型加载失败）时，不让它名下的任务阻塞后续输出
+        for state in jobs.values():
+            if state['worker'] == worker_id:
+                state['done'] = True
+
+    def handle_result(worker_id, item):
+        if item is None:
+            worker_exited(worker_id)
+            return
+        seq = item.get('seq')
+        if item.get('job_done') and assigned.pop(seq, None) is not None:
+            stats[worker_id].outstanding -= 1
+        state = jobs.get(seq)
+        if state is None:
+            # 已被 CLEAR 丢弃的任务
+            discard(item)
+            return
+        if item.get('job_done'):
+            state['done'] = True
+            worker_stats = stats[worker_id]
+            worker_stats.jobs += 1
+            worker_stats.chars += state['chars']
+            worker_stats.last_done = time.monotonic()
+            return
+        if item.get('audio') is not None:
+            stats[worker_id].audio_samples += len(item['audio'])
+        elif 'shm_slots' in item:
+            stats[worker_id].audio_samples += sum(n for _, n in item['shm_slots'])
+        item.pop('seq', None)
+        state['messages'].append(item)
+
+    def flush():
+        for session in list(order):
+            seqs = order[session]
+            while seqs:
+                state = jobs[seqs[0]]
+                while state['messages']:
+                    message = state['messages'].popleft()
+                    if 'shm_slots' in message:
+                        audio_queue.publish(message)
+                    else:
+                        audio_queue.put(message)
+                    supervisor.progress()
+                if not state['done']:
+                    break
+                del jobs[seqs.popleft()]
+            if not seqs:
+                del order[session]
+
+    while exited_workers < num_workers:
+        try:
+            command = command_queue.get_nowait()
+            for q in worker_command_queues:
+                q.put(command)
+            if command == "CLEAR":
+                while not text_queue.empty():
+                    try: text_queue.get_nowait()
+                    except Empty: break
+                clear()
+            elif isinstance(command, tuple) and command[0] == "CLEAR":
+                epoch = command[2] if len(command) > 2 else None
+                if epoch is None or epochs.advance(command[1], epoch):
+                    clear(command[1])
+        except Empty:
+            pass
+
+        while not stop_signal_received:
+            if TTS_MAX_PENDING and sum(s.outstanding for s in stats) >= TTS_MAX_PENDING * num_workers:
+                # 工作进程的积压已达上限，暂停分发，让文本留在有界的文本通道中形成反压
+                break
+            try:
+                item = text_queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                stop_signal_received = True
+                for q in worker_text_queues:
+                    q.put(None)
+            else:
+                if supervisor.relay_seq(item) is not None:
+                    last_relay_seq = item['relay_seq']
+                dispatch(item)
+
+        try:
+            worker_id, item = result_queue.get(timeout=0.01)
+            handle_result(worker_id, item)
+            # 尽量一次处理完已到达的结果
+            while True:
+                worker_id, item = result_queue.get_nowait()
+                handle_result(worker_id, item)
+        except Empty:
+            pass
+        if liveness_paths and time.monotonic() - last_liveness_check >= LIVENESS_CHECK_SECONDS:
+            last_liveness_check = time.monotonic()
+            for worker_id, path in enumerate(liveness_paths):
+                if stats[worker_id].alive and _worker_exited(path):
+                    # 先取出它退出前已经发出的结果，再把剩余的任务标记为完成
+                    try:
+                        while True:
+                            handle_result(*result_queue.get_nowait())
+                    except Empty:
+                        pass
+                    if stats[worker_id].alive:
+                        print(f"!!! [TTS Pool]: 工作进程 {worker_id} 已意外退出，它名下的任务不再等待。")
+                        worker_exited(worker_id)
+        flush()
+        if supervisor.supervised():
+            marks = [state['relay_seq'] for state in jobs.values() if state['relay_seq'] is not None]
+            supervisor.report(len(jobs), min(marks) if marks else (last_relay_seq + 1 if last_relay_seq >= 0 else None))
+
+        if time.monotonic() - last_report >= REPORT_INTERVAL_SECONDS and any(s.jobs for s in stats):
+            report()
+            last_report = time.monotonic()
+
+    flush()
+    if not stop_signal_received:
+        print("[TTS Pool]: 所有工作进程均已退出。")
+    report()
+    if stale_dropped:
+        print(f"[TTS Pool]: 丢弃了 {stale_dropped} 个过时的文本块。")
+    audio_queue.put(None)
+    if liveness_paths:
+        shutil.rmtree(os.path.dirname(liveness_paths[0]), ignore_errors=True)
+    print("[TTS Pool]: 调度器已关闭。")
+
+
+def create_tts_processes(text_queue, audio_queue, command_queue, num_processes=NUM_PROCESSES, feedback=None):
+    """
+    创建 TTS 阶段的进程列表，进程数默认取 tts.num_processes。
+    feedback 为自适应分块的 ChunkFeedback，各工作进程向其报告合成耗时。
+    只有一个进程时沿用 convert_text_to_audio；多个进程时返回调度器和各工作进程。
+    所有进程都由主进程直接创建，便于它们以守护进程方式运行；调度器因此无法用 Process.is_alive()
+    检查兄弟进程，改用各工作进程持有的文件锁。
+    音频通道为共享内存时，工作进程直接把音频写入通道，调度器只转发槽位编号。
+    """
+    # 音色库只由主进程写入，TTS 进程启动后以只读方式共享
+    prepare_voice_bank()
+    if num_processes <= 1:
+        return [mp.Process(target=convert_text_to_audio, args=(text_queue, audio_queue, command_queue, feedback))]
+
+    num_threads = max(1, (os.cpu_count() or num_processes) // num_processes)
+    result_queue = mp.Queue()
+    worker_text_queues = [mp.Queue() for _ in range(num_processes)]
+    worker_command_queues = [mp.Queue() for _ in range(num_processes)]
+    audio_channel = audio_queue if isinstance(audio_queue, SharedAudioChannel) else None
+    liveness_dir = tempfile.mkdtemp(prefix='tts_pool_')
+    liveness_paths = [os.path.join(liveness_dir, f"worker_{worker_id}.lock") for worker_id in range(num_processes)]
+    processes = [mp.Process(
+        target=dispatch_tts_jobs,
+        args=(text_queue, audio_queue, command_queue, worker_text_queues, worker_command_queues, result_queue,
+              liveness_paths),
+    )]
+    for worker_id in range(num_processes):
+        processes.append(mp.Process(
+            target=_tts_worker,
+            args=(worker_id, num_threads, worker_text_queues[worker_id], result_queue, worker_command_queues[worker_id],
+                  feedback, audio_channel, liveness_paths[worker_id]),
+        ))
+    print(f"TTS 进程池: {num_processes} 个工作进程，每个使用 {num_threads} 个线程。")
+    return processes
@@ -0,0 +1,753 @@
+"""
+TTS 进程内的任务调度，与模型无关：
+    组批      在 batch_window_ms 窗口内到达的文本块合并为一次推理，多个会话之间轮转，新一轮回答的首块优先
+    预合成    句子前缀的预合成任务在完整句子到达后核对并认领，其余的丢弃
+    代号      会话被清空后，旧代号的文本块、尚未推理的任务和进行中的批次都被放弃（见 EpochTracker）
+    输出      每个会话的任务按到达顺序输出音频，流式任务边合成边转发音频帧
+推理由构造时传入的 submit(batch, texts, params) 交给推理线程执行，返回 concurrent.futures.Future，
+因此调度与取消逻辑可以脱离 ChatTTS 单独测试。
+"""
+import concurrent.futures
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from queue import Empty
+
+import numpy as np
+
+import audio_format
+import supervisor
+from audio_cache import AudioCache
+from config_loader import config
+from latency_tracer import TRACE_ENABLED, trace
+from pipeline_channel import TTS_MAX_PENDING
+from text_normalizer import normalize_batch
+
+TTS_CONFIG = config.get('tts') or {}
+# 微批调度：在窗口期内到达的文本块合并为一次 chat.infer 调用
+BATCH_WINDOW_SECONDS = TTS_CONFIG.get('batch_window_ms', 40) / 1000.0
+MAX_BATCH_SIZE = max(1, TTS_CONFIG.get('max_batch_size', 4))
+# 流式合成：边推理边把增量音频帧送往播放器，缩短首音延迟
+STREAM_SYNTHESIS = TTS_CONFIG.get('stream', False)
+
+
+def _clear_queue(q):
+    while not q.empty():
+        try: q.get_nowait()
+        except Empty: break
+
+
+class TTSJob:
+    """
+    一个待合成的文本块。属于同一会话的任务按到达顺序输出音频；
+    end_of_turn 任务不需要合成，只用于在音频流中标记一轮回答的结束。
+    seq 由 TTS 进程池的调度器分配，非空时会附在输出消息上，并在任务结束后发送 job_done 标记。
+    chunk/turn 为延迟追踪用的 ID，同样会附在输出消息上。
+    speculative 任务是句子前缀的预合成，只有被后续完整句子（speculated 中列出其 chunk ID）认领后才会输出。
+    voice 为音色库中的音色名称，None 表示默认音色。
+    epoch 为任务所属回答的代号（见 EpochTracker），会附在输出消息上，下游据此丢弃过时的音频。
+    relay_seq 为监督进程中转时给文本块加上的序号，用于报告低水位（见 supervisor）。
+    """
+    __slots__ = ('text', 'source', 'session', 'first', 'end_of_turn', 'seq', 'chunk', 'turn', 'enqueued',
+                 'speculative', 'speculated', 'report_done', 'discarded', 'voice', 'epoch', 'relay_seq',
+                 'cache_key', 'future', 'batch', 'index', 'frames', 'resampler', 'wav')
+
+    def __init__(self, text, session=None, first=False, end_of_turn=False, seq=None, chunk=None, turn=None,
+                 speculative=False, speculated=None, epoch=None):
+        self.text = text
+        self.source = text
+        self.session = session
+        self.first = first
+        self.end_of_turn = end_of_turn
+        self.seq = seq
+        self.chunk = chunk
+        self.turn = turn
+        self.enqueued = False
+        self.speculative = speculative
+        self.speculated = speculated
+        # 被认领的预合成任务与完整句子共用同一个 seq，只有最后一个任务发送 job_done
+        self.report_done = True
+        self.discarded = False
+        self.voice = None
+        self.epoch = epoch
+        self.relay_seq = None
+        self.cache_key = None
+        self.future = None
+        # 与其他任务同批推理时 future 是共享的，只有整批任务都被放弃后才能取消
+        self.batch = None
+        self.index = 0
+        self.frames = None
+        self.resampler = None
+        self.wav = None
+
+    @classmethod
+    def from_item(cls, item):
+        """
+        文本队列中的元素既可以是字符串，也可以是
+        {'text': ..., 'first': ..., 'session': ..., 'end_of_turn': ...} 形式的字典。
+        """
+        if not isinstance(item, dict):
+            return cls(item)
+        job = cls(
+            item.get('text', ''), session=item.get('session'),
+            first=item.get('first', False), end_of_turn=item.get('end_of_turn', False),
+            seq=item.get('seq'), chunk=item.get('chunk'), turn=item.get('turn'),
+            speculative=item.get('speculative', False), speculated=item.get('speculated'), epoch=item.get('epoch'),
+        )
+        job.relay_seq = item.get('relay_seq')
+        return job
+
+
+class Batch:
+    """
+    一次推理调用及其包含的任务。cancel 被设置后，流式推理在下一个生成步骤之间停止，
+    尚未开始的非流式推理不再执行。
+    started/finished 由执行推理的线程记录，用于估算每字符的合成耗时和统计被节省或浪费的算力。
+    """
+    __slots__ = ('jobs', 'chars', 'future', 'cancel', 'started', 'finished', 'reaped')
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.chars = sum(len(job.text) for job in jobs)
+        self.future = None
+        self.cancel = threading.Event()
+        self.started = None
+        self.finished = None
+        self.reaped = False
+
+
+class EpochTracker:
+    """
+    记录每个会话的当前代号以及每轮回答所属的代号，TTS 进程与进程池的调度器各持有一份。
+    WebUI 每次终止会话（浏览器模式下每次发送新问题）都会让会话进入更大的代号，
+    代号随提示词、本轮的开始标记和 CLEAR 命令传递；属于旧代号的任务与音频在 TTS、调度器和播放端都会被直接丢弃。
+    没有代号的任务（终端、基准测试）不受影响。
+    """
+
+    def __init__(self):
+        self.current = {}
+        self.turns = {}
+
+    def advance(self, session, epoch):
+        """
+        返回 True 表示会话进入了新的代号，调用方需要清理该会话的旧任务。
+        """
+        if epoch is None or epoch <= self.current.get(session, 0):
+            return False
+        self.current[session] = epoch
+        return True
+
+    def start_turn(self, session, turn, epoch):
+        """
+        登记一轮回答的代号（来自本轮的开始标记），返回值同 advance。
+        """
+        self.turns[turn] = epoch
+        return self.advance(session, epoch)
+
+    def epoch_of(self, turn):
+        return self.turns.get(turn)
+
+    def end_turn(self, turn):
+        return self.turns.pop(turn, None)
+
+    def is_stale(self, session, epoch):
+        return epoch is not None and epoch < self.current.get(session, 0)
+
+
+def _trace_batch_done(batch, submitted_at):
+    """
+    返回一个 future 回调：推理完成时为批内每个文本块记录 tts_done 事件。
+    real-time factor 按整个批次计算，因为批内文本共享同一次推理耗时。
+    流式合成的首帧在推理完成之前就已入队，事件带上 streamed 标记，汇总时单独统计。
+    """
+    def on_done(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        synth_seconds = time.time() - submitted_at
+        durations = [np.asarray(wav).size / audio_format.MODEL_SAMPLE_RATE for wav in future.result()]
+        batch_audio_seconds = sum(durations)
+        for job, audio_seconds in zip(batch, durations):
+            trace('tts_done', chunk=job.chunk, turn=job.turn, synth_seconds=round(synth_seconds, 4),
+                  audio_seconds=round(audio_seconds, 4), batch_audio_seconds=round(batch_audio_seconds, 4),
+                  batch_size=len(batch), streamed=STREAM_SYNTHESIS)
+    return on_done
+
+
+def _batch_audio_seconds(batch):
+    return sum(np.asarray(wav).size for wav in batch.future.result()) / audio_format.MODEL_SAMPLE_RATE
+
+
+class TTSScheduler:
+    """
+    一个 TTS 进程的调度状态。run() 是进程的主循环；receive / handle_command / submit_ready / reap_batches /
+    flush_outbox 是其中的各个步骤，测试可以直接调用。
+    submit(batch, texts, params) 把批次交给推理线程并返回 future；stream=True 时提交前已为每个任务准备好帧队列，
+    推理线程把增量音频帧放入 job.frames，结束时放入 None。
+    voice_params(name) 返回音色的 (嵌入, 推理参数)；cache 为短语音频缓存（AudioCache）；
+    feedback 为自适应分块的 ChunkFeedback；num_workers 为推理线程数，同时进行的推理不超过该数量。
+    """
+
+    def __init__(self, audio_queue, submit, voice_params, num_workers, cache=None, cache_max_text_length=30,
+                 feedback=None, stream=STREAM_SYNTHESIS, batch_window=BATCH_WINDOW_SECONDS,
+                 max_batch_size=MAX_BATCH_SIZE, max_pending=TTS_MAX_PENDING):
+        self.audio_queue = audio_queue
+        self.submit = submit
+        self.voice_params = voice_params
+        self.num_workers = num_workers
+        self.cache = cache
+        self.cache_max_text_length = cache_max_text_length
+        self.feedback = feedback
+        self.stream = stream
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        # waiting: 每个会话尚未提交推理的任务；outbox: 每个会话按顺序等待输出的任务
+        # 多个会话共享同一个模型，组批时在会话之间轮转，保证公平
+        self.waiting = OrderedDict()
+        self.outbox = OrderedDict()
+        # speculative: 每个会话尚未被认领的预合成任务 (chunk ID -> 任务)
+        self.speculative = OrderedDict()
+        # 每个会话当前选择的音色，由大模型客户端发出的 {'session': ..., 'set_voice': ...} 消息设置
+        self.session_voices = {}
+        self.epochs = EpochTracker()
+        # running: 正在推理的批次。同时进行的推理不超过 num_workers 个，其余任务留在 waiting 中，
+        # 这样新一轮回答的首块仍能排到旧回答剩余句子的前面
+        self.running = []
+        self.spec_stats = {'speculated': 0, 'hits': 0, 'discarded': 0, 'wasted': 0, 'wasted_chars': 0}
+        # 调度统计：到达时已过时而丢弃的任务、清空时尚未推理的任务、被撤销或中途停止的批次、
+        # 因此节省的字符数与估算秒数，以及已经花在过时任务上的推理秒数
+        self.sched_stats = {'stale_dropped': 0, 'queued_dropped': 0, 'cancelled_before_start': 0, 'interrupted': 0,
+                            'stale_completed': 0, 'saved_chars': 0, 'wasted_seconds': 0.0,
+                            'first_chunk_promotions': 0, 'intake_pauses': 0}
+        # 每字符合成耗时的滑动平均，由正常完成的批次更新，用于估算取消所节省的时间
+        self.seconds_per_char = None
+        # 中途停止的批次 (字符数, 已花费秒数)，退出时按最终的每字符耗时估算节省的时间
+        self.interrupted_work = []
+        self.batch_opened_at = 0.0
+        self.flush_now = False
+        self.intake_paused = False
+        self.stop_signal_received = False
+        # 最近读取的文本块的中转序号，没有在途任务时低水位为它的下一个
+        self.last_relay_seq = -1
+
+    def waiting_count(self):
+        return sum(len(jobs) for jobs in self.waiting.values())
+
+    def pending_count(self):
+        return self.waiting_count() + sum(len(jobs) for jobs in self.outbox.values())
+
+    def busy(self):
+        return bool(self.waiting or self.outbox)
+
+    def _estimated_seconds(self, chars):
+        return chars * self.seconds_per_char if self.seconds_per_char is not None else 0.0
+
+    # ---- 输出 ----
+
+    def _put_audio(self, job, audio_data, partial=False):
+        # 缓存命中的音频可能是旧版本以 float32 写入磁盘的，统一转换为存储格式
+        message = {'session': job.session, 'audio': audio_format.to_storage(audio_data)}
+        if partial:
+            # 流式合成的音频帧：同一句话还有后续音频
+            message['partial'] = True
+        if job.epoch is not None:
+            message['epoch'] = job.epoch
+        if job.seq is not None:
+            message['seq'] = job.seq
+        if job.chunk is not None:
+            message['chunk'] = job.chunk
+            message['turn'] = job.turn
+        if not job.enqueued:
+            job.enqueued = True
+            trace('enqueue', chunk=job.chunk, turn=job.turn)
+        self.audio_queue.put(message)
+        supervisor.progress()
+
+    def _mark_job_done(self, job):
+        if job.seq is not None and job.report_done:
+            self.audio_queue.put({'session': job.session, 'seq': job.seq, 'job_done': True})
+
+    def _drain_stream_frames(self, job):
+        while True:
+            try:
+                seg = job.frames.get_nowait()
+            except queue.Empty:
+                return
+            if seg is None:
+                # 结束消息携带重采样剩余的样本（可能为空），播放器据此知道这句话已经结束
+                self._put_audio(job, job.resampler.flush())
+                return
+            audio_data = audio_format.prepare(seg, trim=False, resampler=job.resampler)
+            if audio_data.size:
+                self._put_audio(job, audio_data, partial=True)
+
+    def _finish_job(self, job):
+        """
+        输出一个已完成任务的音频（流式任务的帧已经送出，这里只负责写缓存）。
+        """
+        try:
+            self._output_job_audio(job)
+        finally:
+            self._mark_job_done(job)
+
+    def _output_job_audio(self, job):
+        if job.wav is not None:
+            self._put_audio(job, job.wav)
+            return
+        try:
+            wavs = job.future.result()
+        except concurrent.futures.CancelledError:
+            return
+        except Exception as e:
+            print(f"!!! 获取任务结果时出错: {e}")
+            return
+
+        if not isinstance(wavs, (list, tuple)) or len(wavs) <= job.index:
+            print("[TTS DEBUG]: 警告: TTS模型返回的结果不是有效列表或数量不足。音频无法播放。")
+            return
+        # 转换为紧凑的存储格式（可选裁剪首尾静音、重采样），之后的通道、播放器与缓存都保存这份数据
+        audio_data = audio_format.prepare(wavs[job.index])
+        if audio_data.size == 0:
+            print("[TTS DEBUG]: 警告: 返回的列表内容无效或为空数组。")
+            return
+        if job.frames is not None:
+            self._drain_stream_frames(job)
+        else:
+            print(f"[TTS DEBUG]: 成功提取音频数据 (大小: {audio_data.size})，准备放入播放队列。")
+            self._put_audio(job, audio_data)
+        if self.cache is not None and job.cache_key is not None:
+            self.cache.put(job.cache_key, audio_data)
+
+    def flush_outbox(self):
+        """
+        按会话内的顺序输出已经完成的任务，遇到尚未完成的任务时停下（流式任务先转发已到达的音频帧）。
+        """
+        for session in list(self.outbox):
+            jobs = self.outbox[session]
+            while jobs:
+                job = jobs[0]
+                if job.end_of_turn:
+                    message = {'session': session, 'end_of_turn': True}
+                    if job.epoch is not None:
+                        message['epoch'] = job.epoch
+                    self.audio_queue.put(message)
+                elif job.wav is not None or (job.future is not None and job.future.done()):
+                    self._finish_job(job)
+                else:
+                    if job.frames is not None:
+                        self._drain_stream_frames(job)
+                    break
+                jobs.popleft()
+            if not jobs:
+                del self.outbox[session]
+
+    # ---- 组批与推理 ----
+
+    def submit_ready(self):
+        """
+        窗口到期、积累了一整批、首块在等待或已收到结束信号时，在有空闲推理线程的前提下提交一个批次。
+        """
+        if self.waiting and len(self.running) < self.num_workers and (
+            self.flush_now
+            or self.stop_signal_received
+            or self.waiting_count() >= self.max_batch_size
+            or time.monotonic() - self.batch_opened_at >= self.batch_window
+        ):
+            self.submit_batch()
+            if self.waiting:
+                self.batch_opened_at = time.monotonic()
+
+    def submit_batch(self):
+        picked = []
+        waiting = self.waiting
+        # 新一轮回答的首块优先：首块所在的会话排在最前，旧回答的剩余句子让位
+        lead = next((s for s, jobs in waiting.items() if jobs[0].first), None)
+        if lead is not None and lead != next(iter(waiting)):
+            self.sched_stats['first_chunk_promotions'] += 1
+        # 一次推理只能使用一个音色：以领头会话的音色为准，只从使用相同音色的会话中组批
+        voice = waiting[lead if lead is not None else next(iter(waiting))][0].voice
+        while len(picked) < self.max_batch_size:
+            candidates = [s for s, jobs in waiting.items() if jobs[0].voice == voice]
+            if not candidates:
+                break
+            session = next((s for s in candidates if waiting[s][0].first), candidates[0])
+            jobs = waiting[session]
+            picked.append(jobs.popleft())
+            # 取完一个任务后把该会话移到末尾，下一个名额让给其他会话
+            if jobs:
+                waiting.move_to_end(session)
+            else:
+                del waiting[session]
+        self.flush_now = any(job.first for jobs in waiting.values() for job in jobs)
+
+        batch = Batch(picked)
+        texts = [job.text for job in picked]
+        print(f"[TTS Converter]: 提交批次，共 {len(texts)} 条文本。")
+        if self.stream:
+            for job in picked:
+                job.frames = queue.Queue()
+                # 重采样的状态在同一任务的帧之间延续
+                job.resampler = audio_format.StreamResampler()
+        future = self.submit(batch, texts, self.voice_params(voice)[1])
+        batch.future = future
+        self.running.append(batch)
+        for index, job in enumerate(picked):
+            job.future = future
+            job.batch = batch
+            job.index = index
+            trace('tts_submit', chunk=job.chunk, turn=job.turn, batch_size=len(picked))
+        if TRACE_ENABLED:
+            future.add_done_callback(_trace_batch_done(picked, time.time()))
+        return batch
+
+    def _record_stale_batch(self, batch):
+        elapsed = batch.finished - batch.started
+        interrupted = isinstance(batch.future.exception(), concurrent.futures.CancelledError)
+        saved = 0.0
+        if interrupted:
+            # 中途停止：已经花费的时间算作浪费，预计剩余的时间算作节省
+            saved = max(self._estimated_seconds(batch.chars) - elapsed, 0.0)
+            self.sched_stats['interrupted'] += 1
+            self.interrupted_work.append((batch.chars, elapsed))
+        else:
+            self.sched_stats['stale_completed'] += 1
+        self.sched_stats['wasted_seconds'] += elapsed
+        trace('tts_cancel', kind='interrupted' if interrupted else 'completed', chars=batch.chars,
+              saved_seconds=round(saved, 4), wasted_seconds=round(elapsed, 4))
+
+    def reap_batches(self):
+        """
+        回收已结束的批次：过时的批次计入浪费/节省统计，正常完成的批次更新每字符合成耗时。
+        """
+        for batch in [b for b in self.running if b.future.done()]:
+            self.running.remove(batch)
+            batch.reaped = True
+            supervisor.progress()
+            if batch.future.cancelled():
+                continue
+            if all(job.discarded for job in batch.jobs):
+                self._record_stale_batch(batch)
+            elif batch.future.exception() is None and batch.chars:
+                rate = (batch.finished - batch.started) / batch.chars
+                self.seconds_per_char = rate if self.seconds_per_char is None else 0.8 * self.seconds_per_char + 0.2 * rate
+                if self.feedback is not None:
+                    # 供自适应分块使用：批次的合成耗时与生成的音频时长
+                    self.feedback.record_synthesis(batch.chars, batch.finished - batch.started,
+                                                   _batch_audio_seconds(batch))
+
+    # ---- 取消 ----
+
+    def _abandon(self, job):
+        """
+        放弃一个已进入输出队列的任务。同批任务全部被放弃时取消整批推理：尚未开始的直接撤销，
+        正在进行的在下一个生成步骤之间停止。返回该任务是否已经（或必然会）消耗推理算力。
+        """
+        job.discarded = True
+        batch = job.batch
+        if batch is None:
+            return False
+        if all(j.discarded for j in batch.jobs):
+            if batch.future.cancel():
+                self.sched_stats['cancelled_before_start'] += 1
+                self.sched_stats['saved_chars'] += batch.chars
+                trace('tts_cancel', kind='before_start', chars=batch.chars,
+                      saved_seconds=round(self._estimated_seconds(batch.chars), 4), wasted_seconds=0.0)
+                return False
+            if batch.reaped:
+                # 推理已经完成并回收，只是结果还没来得及输出
+                self._record_stale_batch(batch)
+            else:
+                batch.cancel.set()
+        return True
+
+    def _drop_queued(self, job):
+        job.discarded = True
+        self.sched_stats['queued_dropped'] += 1
+        self.sched_stats['saved_chars'] += len(job.text)
+
+    def clear_session(self, session, epoch=None):
+        """
+        清空会话的待办任务。给出 epoch 时只清理代号更小的任务：进程池中新代号的任务可能先于 CLEAR 命令到达。
+        """
+        def stale(job):
+            return epoch is None or job.epoch is None or job.epoch < epoch
+
+        pending = self.speculative.pop(session, None) or OrderedDict()
+        for chunk_id, job in list(pending.items()):
+            if stale(job):
+                del pending[chunk_id]
+                self._discard_speculative(job)
+        if pending:
+            self.speculative[session] = pending
+        jobs = self.waiting.pop(session, None) or ()
+        for job in jobs:
+            if stale(job):
+                self._drop_queued(job)
+        kept = deque(job for job in jobs if not job.discarded)
+        if kept:
+            self.waiting[session] = kept
+        jobs = self.outbox.pop(session, None) or ()
+        for job in jobs:
+            if not stale(job):
+                continue
+            if not job.discarded:
+                self._abandon(job)
+            # 进程池的调度器依靠 job_done 维护各工作进程的在途任务数
+            self._mark_job_done(job)
+        kept = deque(job for job in jobs if not stale(job))
+        if kept:
+            self.outbox[session] = kept
+
+    def handle_command(self, command):
+        """
+        处理 "CLEAR"（清空全部会话）或 ("CLEAR", session, epoch)（清空一个会话中代号更小的任务）。
+        """
+        if command == "CLEAR":
+            print("[TTS Converter]: 收到CLEAR命令，清空待办任务。")
+            for session in list(self.waiting) + list(self.outbox) + list(self.speculative):
+                self.clear_session(session)
+            self.flush_now = False
+        elif isinstance(command, tuple) and command[0] == "CLEAR":
+            # ("CLEAR", session, epoch)：会话的新代号可能已经随本轮开始标记先到达，此时无需重复清理
+            epoch = command[2] if len(command) > 2 else None
+            if epoch is None or self.epochs.advance(command[1], epoch):
+                print(f"[TTS Converter]: 收到会话 {command[1]} 的CLEAR命令，清空其待办任务。")
+                self.clear_session(command[1], epoch)
+
+    # ---- 预合成 ----
+
+    def _discard_speculative(self, job):
+        """
+        丢弃一个预合成任务。尚未开始推理的任务不计入浪费。
+        """
+        job.discarded = True
+        jobs = self.waiting.get(job.session)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self.waiting[job.session]
+            wasted = False
+        else:
+            wasted = self._abandon(job)
+        self.spec_stats['discarded'] += 1
+        if wasted:
+            self.spec_stats['wasted'] += 1
+            self.spec_stats['wasted_chars'] += len(job.source)
+        trace('spec_discard', chunk=job.chunk, turn=job.turn, wasted=wasted)
+
+    def _discard_speculation(self, session):
+        for job in (self.speculative.pop(session, None) or {}).values():
+            self._discard_speculative(job)
+
+    def _claim_speculative(self, job):
+        """
+        核对完整句子与其预合成前缀：逐个匹配成功的前缀任务被认领，job.text 缩减为剩余部分。
+        该会话中其余未被认领的预合成任务已经过时，直接丢弃。返回被认领的任务列表。
+        """
+        pending = self.speculative.pop(job.session, None) or {}
+        pieces = []
+        remainder = job.text.strip()
+        for chunk_id in job.speculated or ():
+            piece = pending.get(chunk_id)
+            prefix = piece.source.strip() if piece is not None else ''
+            if not prefix or piece.voice != job.voice or not remainder.startswith(prefix):
+                break
+            del pending[chunk_id]
+            pieces.append(piece)
+            remainder = remainder[len(prefix):].lstrip()
+        for piece in pending.values():
+            self._discard_speculative(piece)
+        for piece in pieces:
+            trace('spec_hit', chunk=piece.chunk, turn=job.turn, chars=len(piece.source))
+            # 被认领的前缀以完整句子的身份输出
+            piece.chunk, piece.seq, piece.first, piece.report_done = job.chunk, job.seq, job.first, False
+        if pieces and not remainder:
+            pieces[-1].report_done = True
+        self.spec_stats['hits'] += len(pieces)
+        job.text = remainder
+        return pieces
+
+    # ---- 接收文本 ----
+
+    def _accept_job(self, job, prepared_text):
+        """
+        使用标准化后的文本查询缓存；未命中的任务进入待组批队列。文本为空时返回 False。
+        """
+        original_text = job.text
+        job.text = prepared_text
+        if not job.text:
+            return False
+
+        if self.cache is not None and len(job.text) <= self.cache_max_text_length:
+            # 缓存的是存储格式的音频，采样率、样本格式或静音裁剪设置改变后不能复用
+            job.cache_key = AudioCache.make_key(job.text, *self.voice_params(job.voice), audio_format.describe())
+            job.wav = self.cache.get(job.cache_key)
+            if job.wav is not None:
+                print(f"\n[音频缓存命中]: {job.text}")
+                trace('tts_cache_hit', chunk=job.chunk, turn=job.turn)
+                return True
+
+        label = "预合成任务提交" if job.speculative else "音频合成任务提交"
+        print(f"\n[{label}]: {job.text} (原始文本: {original_text.strip()})")
+        if not self.waiting:
+            self.batch_opened_at = time.monotonic()
+        self.waiting.setdefault(job.session, deque()).append(job)
+        # 快速响应首块无需等待批次窗口
+        if job.first:
+            self.flush_now = True
+        return True
+
+    def receive(self, items):
+        """
+        处理从文本通道读到的一组元素：音色切换、本轮开始标记（可能带来新代号）、文本块与结束标记。
+        末尾的 None 为结束信号。旧代号的文本块直接丢弃，其余的标准化后进入待组批队列或输出队列。
+        """
+        items = list(items)
+        if items and items[-1] is None:
+            self.stop_signal_received = True
+            items.pop()
+        epochs = self.epochs
+        jobs = []
+        for item in items:
+            if supervisor.relay_seq(item) is not None:
+                self.last_relay_seq = item['relay_seq']
+            if isinstance(item, dict) and 'set_voice' in item:
+                # 音色切换对该会话之后到达的文本块生效
+                if item['set_voice']:
+                    self.session_voices[item.get('session')] = item['set_voice']
+                else:
+                    self.session_voices.pop(item.get('session'), None)
+                continue
+            if isinstance(item, dict) and item.get('start_of_turn'):
+                if epochs.start_turn(item.get('session'), item.get('turn'), item.get('epoch')):
+                    # 新代号随本轮开始标记先于 CLEAR 命令到达，同样清理该会话的旧任务
+                    self.clear_session(item.get('session'), item.get('epoch'))
+                continue
+            job = TTSJob.from_item(item)
+            job.voice = self.session_voices.get(job.session)
+            if job.epoch is None:
+                # 进程池的调度器会直接在任务上标注代号
+                job.epoch = epochs.end_turn(job.turn) if job.end_of_turn else epochs.epoch_of(job.turn)
+            elif epochs.advance(job.session, job.epoch):
+                self.clear_session(job.session, job.epoch)
+            jobs.append(job)
+        # 属于旧代号的文本块（会话已被清空后才从队列中取出）不再合成
+        for job in [job for job in jobs if epochs.is_stale(job.session, job.epoch)]:
+            jobs.remove(job)
+            self.sched_stats['stale_dropped'] += 1
+            self._mark_job_done(job)
+        # 先按到达顺序登记预合成任务并核对完整句子，确定每个任务实际需要合成的文本
+        claimed = {}
+        for job in jobs:
+            if job.speculative:
+                self.speculative.setdefault(job.session, OrderedDict())[job.chunk] = job
+                self.spec_stats['speculated'] += 1
+            elif job.end_of_turn:
+                self._discard_speculation(job.session)
+            elif job.speculated or job.session in self.speculative:
+                claimed[id(job)] = self._claim_speculative(job)
+
+        accepted = [job for job in jobs if not job.end_of_turn and not job.discarded]
+        prepared = dict(zip(map(id, accepted), normalize_batch([job.text for job in accepted])))
+        for job in jobs:
+            if job.discarded:
+                continue
+            if job.speculative:
+                if not self._accept_job(job, prepared[id(job)]):
+                    self.speculative.get(job.session, {}).pop(job.chunk, None)
+                continue
+            pieces = claimed.get(id(job), ())
+            if pieces:
+                self.outbox.setdefault(job.session, deque()).extend(pieces)
+            if job.end_of_turn or (job.text and self._accept_job(job, prepared[id(job)])):
+                self.outbox.setdefault(job.session, deque()).append(job)
+            elif not pieces:
+                self._mark_job_done(job)
+        if self.stop_signal_received:
+            for session in list(self.speculative):
+                self._discard_speculation(session)
+
+    def _read_text(self, text_queue):
+        # 批次已打开且有空闲的推理线程时，只等待到窗口结束为止
+        if self.waiting and len(self.running) < self.num_workers:
+            timeout = max(self.batch_opened_at + self.batch_window - time.monotonic(), 0.001)
+        elif self.waiting or (self.stream and self.outbox):
+            # 等待推理线程空出，或流式任务进行中需要及时转发音频帧
+            timeout = 0.01
+        else:
+            timeout = 0.1
+        items = []
+        if self.max_pending and self.pending_count() >= self.max_pending:
+            # 内部积压已达上限：暂停读取，后续文本留在有界的文本通道中，通道满后反压到大模型客户端
+            if not self.intake_paused:
+                self.sched_stats['intake_pauses'] += 1
+                self.intake_paused = True
+            time.sleep(timeout)
+            return items
+        self.intake_paused = False
+        try:
+            items.append(text_queue.get(timeout=timeout))
+            # 顺带取出已经到达的文本块，一次完成标准化
+            while items[-1] is not None and len(items) < self.max_batch_size:
+                items.append(text_queue.get_nowait())
+        except Empty:
+            pass
+        return items
+
+    def report_health(self):
+        in_flight = [job for jobs in self.waiting.values() for job in jobs]
+        in_flight += [job for jobs in self.outbox.values() for job in jobs]
+        in_flight += [job for jobs in self.speculative.values() for job in jobs.values()]
+        marks = [job.relay_seq for job in in_flight if job.relay_seq is not None]
+        if marks:
+            low_water = min(marks)
+        else:
+            low_water = self.last_relay_seq + 1 if self.last_relay_seq >= 0 else None
+        supervisor.report(len(in_flight) + len(self.running), low_water)
+
+    def run(self, text_queue, command_queue):
+        """
+        主循环：处理命令、回收批次、读取文本、提交批次、输出音频，直到收到结束信号且所有任务都已输出。
+        """
+        while not self.stop_signal_received or self.busy():
+            try:
+                command = command_queue.get_nowait()
+                if command == "CLEAR":
+                    _clear_queue(text_queue)
+                self.handle_command(command)
+            except Empty:
+                pass
+
+            self.reap_batches()
+            if not self.stop_signal_received:
+                self.receive(self._read_text(text_queue))
+            self.submit_ready()
+            self.flush_outbox()
+
+            if supervisor.supervised():
+                self.report_health()
+
+            if self.stop_signal_received and self.outbox:
+                time.sleep(0.01 if self.stream else 0.05)
+
+    def report_stats(self):
+        """
+        退出前打印预合成与调度统计。
+        """
+        spec_stats = self.spec_stats
+        if spec_stats['speculated']:
+            spec_stats['hit_rate'] = round(spec_stats['hits'] / spec_stats['speculated'], 3)
+            spec_stats['waste_rate'] = round(spec_stats['wasted'] / spec_stats['speculated'], 3)
+            print(f"[TTS Converter]: 预合成统计 {spec_stats}")
+        sched_stats = dict(self.sched_stats)
+        if any(sched_stats.values()):
+            if self.seconds_per_char is not None:
+                sched_stats['saved_seconds'] = sched_stats['saved_chars'] * self.seconds_per_char + sum(
+                    max(chars * self.seconds_per_char - elapsed, 0.0) for chars, elapsed in self.interrupted_work)
+            else:
+                # 没有正常完成的批次，无法估算
+                sched_stats['saved_seconds'] = None
+            sched_stats = {name: round(value, 3) if isinstance(value, float) else value
+                           for name, value in sched_stats.items()}
+            print(f"[TTS Converter]: 调度统计 {sched_stats}")
@@ -0,0 +1,28 @@
+"""
+TTS 进程的冷启动设置：ChatTTS/torch 只在 TTS 进程内导入，torch.compile 的编译产物持久化到磁盘，重启后复用。
+单进程的 convert_text_to_audio 与进程池的工作进程共用这些设置。
+"""
+import os
+
+from config_loader import config
+
+WARM_START_CONFIG = (config.get('tts') or {}).get('warm_start') or {}
+COMPILE_MODEL = WARM_START_CONFIG.get('compile', True)
+COMPILE_CACHE_DIR = WARM_START_CONFIG.get('compile_cache_dir', './cache/torch_compile')
+WARMUP = WARM_START_CONFIG.get('warmup', True)
+WARMUP_TEXT = "你好。"
+
+
+def configure_compile_cache():
+    """
+    让 torch.compile 的编译产物（inductor/triton 缓存）写入项目目录，重启后直接复用。
+    必须在导入 torch 之前调用；已经设置的环境变量不会被覆盖。
+    """
+    if not COMPILE_MODEL or not COMPILE_CACHE_DIR:
+        return
+    cache_dir = os.path.abspath(COMPILE_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
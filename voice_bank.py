@@ -0,0 +1,188 @@
+"""
+音色库：把多个音色嵌入存放在一个紧凑的数据文件中，按名称切换音色而无需重新加载模型。
+
+    voices.bin   所有音色嵌入依次追加存放（只追加，不修改已写入的内容）
+    voices.json  索引: 名称 -> 偏移、长度、类型
+
+TTS 进程以只读内存映射方式打开数据文件，多个工作进程共享操作系统的页缓存，不会各自复制一份。
+
+命令行:
+    python voice_bank.py list
+    python voice_bank.py import NAME speaker.pkl [--overwrite]
+    python voice_bank.py export NAME speaker.pkl
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+from config_loader import config
+
+VOICE_BANK_CONFIG = config.get('voice_bank') or {}
+VOICE_BANK_ENABLED = VOICE_BANK_CONFIG.get('enabled', False)
+VOICE_BANK_DIR = VOICE_BANK_CONFIG.get('path', './cache/voice_bank')
+DEFAULT_VOICE = VOICE_BANK_CONFIG.get('default') or None
+# 数组类型的嵌入按该字节数对齐存放
+_ALIGNMENT = 16
+
+
+def _serialize(embedding):
+    """
+    返回 (数据, 索引中的附加字段)。ChatTTS 的音色嵌入通常是字符串；数组按原始字节存放，
+    其他对象（例如 torch.Tensor）使用 pickle。
+    """
+    if isinstance(embedding, str):
+        return embedding.encode('utf-8'), {'kind': 'str'}
+    if isinstance(embedding, np.ndarray):
+        array = np.ascontiguousarray(embedding)
+        return array.tobytes(), {'kind': 'array', 'dtype': array.dtype.str, 'shape': list(array.shape)}
+    return pickle.dumps(embedding, protocol=pickle.HIGHEST_PROTOCOL), {'kind': 'pickle'}
+
+
+class VoiceBank:
+    """
+    音色库的读写接口。写入只应由一个进程进行（主进程启动时或命令行工具），
+    读取的进程在遇到未知名称时会重新加载索引和内存映射。
+    """
+
+    def __init__(self, directory=VOICE_BANK_DIR):
+        self.directory = directory
+        self.data_path = os.path.join(directory, 'voices.bin')
+        self.index_path = os.path.join(directory, 'voices.json')
+        self._index = {}
+        self._data = None
+        self._decoded = {}
+        self._reload()
+
+    def _reload(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                self._index = json.load(f).get('voices', {})
+        size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r') if size else None
+
+    def names(self):
+        return sorted(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def get(self, name):
+        """
+        返回音色嵌入；名称不存在时返回 None。数组类型直接返回内存映射上的只读视图。
+        """
+        if name in self._decoded:
+            return self._decoded[name]
+        if name not in self._index:
+            # 其他进程可能刚刚追加了新音色
+            self._reload()
+            if name not in self._index:
+                return None
+        entry = self._index[name]
+        view = self._data[entry['offset']:entry['offset'] + entry['length']]
+        if entry['kind'] == 'str':
+            embedding = bytes(view).decode('utf-8')
+        elif entry['kind'] == 'array':
+            embedding = view.view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+        else:
+            embedding = pickle.loads(view)
+        self._decoded[name] = embedding
+        return embedding
+
+    def add(self, name, embedding, overwrite=False):
+        """
+        追加一个音色。名称已存在时除非 overwrite=True 否则抛出 ValueError，避免误覆盖。
+        覆盖只更新索引，旧数据仍留在文件中，正在使用它的进程不受影响。
+        """
+        if name in self._index and not overwrite:
+            raise ValueError(f"音色 '{name}' 已存在。")
+        payload, entry = _serialize(embedding)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            padding = -offset % _ALIGNMENT
+            f.write(b'\0' * padding)
+            f.write(payload)
+        entry.update(offset=offset + padding, length=len(payload))
+        self._index[name] = entry
+        self._decoded.pop(name, None)
+        # 先写临时文件再原子替换，读取方不会看到写了一半的索引
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'voices': self._index}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+        self._reload()
+
+    def import_pickle(self, name, path, overwrite=False):
+        with open(path, 'rb') as f:
+            self.add(name, pickle.load(f), overwrite=overwrite)
+
+
+def prepare_voice_bank():
+    """
+    在主进程中调用：把 voice_bank.voices 中配置的音色文件导入音色库（已存在的名称保持不变）。
+    音色库未启用时返回 None。
+    """
+    if not VOICE_BANK_ENABLED:
+        return None
+    bank = VoiceBank()
+    for name, path in (VOICE_BANK_CONFIG.get('voices') or {}).items():
+        if name in bank:
+            continue
+        if not os.path.exists(path):
+            print(f"[Voice Bank]: 音色文件 '{path}' 不存在，跳过 '{name}'。")
+            continue
+        try:
+            bank.import_pickle(name, path)
+            print(f"[Voice Bank]: 已导入音色 '{name}' ({path})。")
+        except Exception as e:
+            print(f"[Voice Bank]: 导入音色 '{name}' 失败: {e}")
+    return bank
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list')
+    p_import = sub.add_parser('import')
+    p_import.add_argument('name')
+    p_import.add_argument('path')
+    p_import.add_argument('--overwrite', action='store_true')
+    p_export = sub.add_parser('export')
+    p_export.add_argument('name')
+    p_export.add_argument('path')
+    args = parser.parse_args(argv[1:])
+
+    bank = VoiceBank()
+    if args.command == 'list':
+        for name in bank.names():
+            print(name)
+    elif args.command == 'import':
+        try:
+            bank.import_pickle(args.name, args.path, overwrite=args.overwrite)
+        except ValueError as e:
+            print(f"{e} 如需替换请加上 --overwrite。")
+            return 1
+        print(f"已导入音色 '{args.name}'。")
+    else:
+        embedding = bank.get(args.name)
+        if embedding is None:
+            print(f"音色 '{args.name}' 不存在。")
+            return 1
+        if isinstance(embedding, np.ndarray):
+            embedding = np.array(embedding)
+        try:
+            with open(args.path, 'xb') as f:
+                pickle.dump(embedding, f)
+        except FileExistsError:
+            print(f"文件 '{args.path}' 已存在，不会覆盖。")
+            return 1
+        print(f"已导出音色 '{args.name}' 到 '{args.path}'。")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))